@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from functools import partial
 import logging
 import os
 
@@ -20,7 +21,11 @@ from subiquitycore.controller import BaseController
 from subiquitycore.ui.dummy import DummyView
 from subiquitycore.ui.error import ErrorView
 
-from subiquity.models.filesystem import humanize_size
+from subiquity.models.diskbench import DiskBenchmarks
+from subiquity.models.diskdetails import DiskDetailsService
+from subiquity.models.filesystem import dehumanize_size, humanize_size
+from subiquity.models.swap import SWAP_KINDS, SWAP_POLICIES
+from subiquity.models.validation import StorageValidator
 from subiquity.ui.views import (
     BcacheView,
     DiskInfoView,
@@ -30,18 +35,23 @@ from subiquity.ui.views import (
     GuidedDiskSelectionView,
     GuidedFilesystemView,
     LVMVolumeGroupView,
+    LogicalVolumeView,
     PartitionView,
+    ProbingView,
     RaidView,
     )
 
 
 log = logging.getLogger("subiquitycore.controller.filesystem")
 
-BIOS_GRUB_SIZE_BYTES = 2 * 1024 * 1024   # 2MiB
-UEFI_GRUB_SIZE_BYTES = 512 * 1024 * 1024  # 512MiB EFI partition
-
 
 class FilesystemController(BaseController):
+    signals = [
+        ('filesystem:add-raid-dev', 'add_raid_dev'),
+        ('filesystem:add-lvm-volgroup', 'add_lvm_volgroup'),
+        ('filesystem:add-bcache-dev', 'add_bcache_dev'),
+        ('filesystem:manual', 'manual'),
+    ]
 
     def __init__(self, common):
         super().__init__(common)
@@ -50,30 +60,123 @@ class FilesystemController(BaseController):
         self.answers.setdefault('guided', False)
         self.answers.setdefault('guided-index', 0)
         self.answers.setdefault('manual', False)
+        self.answers.setdefault('benchmark', False)
+        self.model.mkfs_overrides = self.answers.get('mkfs-options', {})
+        self._swap_answers()
+        self.validator = StorageValidator()
+        self.disk_details = DiskDetailsService()
+        self.disk_benchmarks = DiskBenchmarks()
         # self.iscsi_model = IscsiDiskModel()
         # self.ceph_model = CephDiskModel()
-        self.model.probe()  # probe before we complete
+        # The storage probe was started when the application started;
+        # populate the model once it completes.
+        self.probed = False
+        self.probing_view = None
+        self.storage_observer = None
+        self.storage_watches = []
+        self.call_when_done(
+            self.prober.start_storage_probe(), self._probe_complete)
+
+    def _swap_answers(self):
+        # Check these now: a bad answer would otherwise only be noticed
+        # once a disk has been chosen, with the UI already running.
+        policy = self.answers.get('swap-policy', 'ratio')
+        if policy not in SWAP_POLICIES:
+            raise ValueError("unknown swap-policy {!r}".format(policy))
+        kind = self.answers.get('swap-kind', 'partition')
+        if kind not in SWAP_KINDS:
+            raise ValueError("unknown swap-kind {!r}".format(kind))
+        size = self.answers.get('swap-size')
+        if isinstance(size, str):
+            size = dehumanize_size(size)
+        self.model.swap_policy = policy
+        self.model.swap_fixed_size = size
+        self.model.swap_kind = kind
+
+    def _probe_complete(self, fut):
+        try:
+            fut.result()
+        except Exception:
+            log.exception("storage probe failed")
+        else:
+            self.model.probe()
+            # Look up the details of every disk now, so they are ready
+            # by the time anyone looks at them.
+            if self.prober.storage_is_live:
+                for disk in self.model.all_disks():
+                    self.disk_details.lookup(self._sysfs_name(disk))
+            if self.answers['benchmark']:
+                self.benchmark_disks()
+            self.storage_observer, fds = self.prober.probe_storage_events(
+                self.model)
+            for fd in fds:
+                self.storage_watches.append(self.loop.watch_file(
+                    fd, partial(self._storage_data_ready, fd)))
+        self.probed = True
+        if self.probing_view is not None:
+            waiting = self.ui.frame.body is self.probing_view
+            self.probing_view = None
+            if waiting:
+                self.default()
+
+    def _storage_data_ready(self, fd):
+        self.storage_observer.data_ready(fd)
+        v = self.ui.frame.body
+        disk = getattr(v, 'disk', None)
+        if disk is not None and self.model.get_disk(disk.path) is not disk:
+            # The disk being looked at has gone away.
+            self.manual()
+            return
+        if hasattr(v, 'refresh_model_inputs'):
+            v.refresh_model_inputs()
+
+    def _stop_storage_events(self):
+        for handle in self.storage_watches:
+            self.loop.remove_watch_file(handle)
+        self.storage_watches = []
 
     def default(self):
+        if not self.probed:
+            self.ui.set_header(_("Filesystem setup"))
+            self.ui.set_footer("")
+            self.probing_view = ProbingView(self)
+            self.ui.set_body(self.probing_view)
+            return
         title = _("Filesystem setup")
         footer = (_("Choose guided or manual partitioning"))
         self.ui.set_header(title)
         self.ui.set_footer(footer)
         self.ui.set_body(GuidedFilesystemView(self))
-        if self.answers['guided']:
+        if 'layout' in self.answers:
+            self.layout()
+        elif self.answers['guided']:
             self.guided()
         elif self.answers['manual']:
             self.manual()
 
     def manual(self):
         title = _("Filesystem setup")
-        footer = (_("Select available disks to format and mount"))
+        footer = (_("Select available disks to format and mount, "
+                    "u to undo and r to redo"))
         self.ui.set_header(title)
         self.ui.set_footer(footer)
         self.ui.set_body(FilesystemView(self.model, self))
-        if self.answers['guided']:
+        if self.answers['guided'] or 'layout' in self.answers:
             self.finish()
 
+    def layout(self):
+        try:
+            self.model.apply_layout(self.answers['layout'], self.is_uefi())
+        except Exception as e:
+            # As well as LayoutError for a template that does not fit
+            # the disks, the model raises plain exceptions for things
+            # it cannot build, such as a RAID over too few devices.
+            log.exception("cannot apply storage layout")
+            self.ui.set_footer(_("Storage layout error"))
+            self.ui.set_body(ErrorView(self.signal, str(e)))
+            return
+        self.manual()
+
     def guided(self):
         title = _("Filesystem setup")
         footer = (_("Choose the installation target"))
@@ -82,8 +185,12 @@ class FilesystemController(BaseController):
         v = GuidedDiskSelectionView(self.model, self)
         self.ui.set_body(v)
         if self.answers['guided']:
-            index = self.answers['guided-index']
-            disk = self.model.all_disks()[index]
+            if 'guided-policy' in self.answers:
+                disk = self.model.guided_disk(self.answers['guided-policy'])
+            else:
+                # Index the disks in the order the view lists them.
+                index = self.answers['guided-index']
+                disk = self.model.ranked_disks()[index]
             v.choose_disk(None, disk)
 
     def reset(self):
@@ -91,6 +198,16 @@ class FilesystemController(BaseController):
         self.model.reset()
         self.manual()
 
+    def undo(self):
+        if self.model.undo():
+            log.info("Undid last filesystem change")
+            self.manual()
+
+    def redo(self):
+        if self.model.redo():
+            log.info("Redid filesystem change")
+            self.manual()
+
     def cancel(self):
         self.signal.emit_signal('prev-screen')
 
@@ -103,6 +220,17 @@ class FilesystemController(BaseController):
         self.ui.set_body(ErrorView(self.signal, error_msg))
 
     def finish(self):
+        # Catch mistakes in the config now rather than when curtin runs.
+        errors = self.validator.validate(
+            self.model.render(), uefi=self.is_uefi(),
+            disk_sizes=self.model.disk_sizes())
+        if errors:
+            for error in errors:
+                log.error("storage config: %s", error)
+            self.ui.set_body(FilesystemView(self.model, self, errors))
+            return
+        # The configuration is final now, stop tracking disk changes.
+        self._stop_storage_events()
         # start curtin install in background
         self.signal.emit_signal('installprogress:filesystem-config-done')
         # switch to next screen
@@ -134,53 +262,39 @@ class FilesystemController(BaseController):
         adp_view = PartitionView(self.model, self, disk, partition)
         self.ui.set_body(adp_view)
 
+    def preserve_existing(self, disk):
+        log.debug("preserve_existing {}".format(disk.path))
+        self.model.preserve_existing(disk, self.is_uefi())
+        self.partition_disk(disk)
+
     def delete_partition(self, part):
-        old_fs = part.fs()
-        if old_fs is not None:
-            self.model._filesystems.remove(old_fs)
-            part._fs = None
-            mount = old_fs.mount()
-            if mount is not None:
-                old_fs._mount = None
-                self.model._mounts.remove(mount)
-        part.device.partitions().remove(part)
-        self.model._partitions.remove(part)
+        self.model.remove_partition(part)
         self.partition_disk(part.device)
 
     def partition_disk_handler(self, disk, partition, spec):
+        # Everything done for one form is undone together.
+        with self.model.journal.step():
+            self._partition_disk_handler(disk, partition, spec)
+        self.partition_disk(disk)
+
+    def _partition_disk_handler(self, disk, partition, spec):
         log.debug('spec: {}'.format(spec))
         log.debug('disk.freespace: {}'.format(disk.free))
 
         if partition is not None:
-            partition.number = spec['partnum']
-            partition.size = spec['size']
-            old_fs = partition.fs()
-            if old_fs is not None:
-                self.model._filesystems.remove(old_fs)
-                partition._fs = None
-                mount = old_fs.mount()
-                if mount is not None:
-                    old_fs._mount = None
-                    self.model._mounts.remove(mount)
-            if spec['fstype'].label is not None:
-                fs = self.model.add_filesystem(partition, spec['fstype'].label)
-                if spec['mount']:
-                  self.model.add_mount(fs, spec['mount'])
-            self.partition_disk(disk)
+            if not partition.preserve:
+                self.model.update_partition(
+                    partition, spec['partnum'], spec['size'])
+            self.model.set_format(
+                partition, spec['fstype'].label, spec['mount'],
+                spec.get('mount_profile'), spec.get('existing', False))
             return
 
         system_bootable = self.model.bootable()
         log.debug('model has bootable device? {}'.format(system_bootable))
         if not system_bootable and len(disk.partitions()) == 0:
-            if self.is_uefi():
-                log.debug('Adding EFI partition first')
-                part = self.model.add_partition(disk=disk, partnum=1, size=UEFI_GRUB_SIZE_BYTES, flag='boot')
-                fs = self.model.add_filesystem(part, 'fat32')
-                self.model.add_mount(fs, '/boot/efi')
-            else:
-                log.debug('Adding grub_bios gpt partition first')
-                part = self.model.add_partition(disk=disk, partnum=1, size=BIOS_GRUB_SIZE_BYTES, flag='bios_grub')
-            disk.grub_device = True
+            log.debug('Adding boot partition first')
+            part = self.model.add_boot_partition(disk, self.is_uefi())
 
             # adjust downward the partition size to accommodate
             # the offset and bios/grub partition
@@ -191,29 +305,19 @@ class FilesystemController(BaseController):
             spec['size'] -= part.size
             spec['partnum'] = 2
 
-        part = self.model.add_partition(disk=disk, partnum=spec["partnum"], size=spec["size"])
-        if spec['fstype'].label is not None:
-            fs = self.model.add_filesystem(part, spec['fstype'].label)
-            if spec['mount']:
-                self.model.add_mount(fs, spec['mount'])
+        part = self.model.add_partition(
+            disk=disk, partnum=spec["partnum"], size=spec["size"])
+        self.model.set_format(
+            part, spec['fstype'].label, spec['mount'],
+            spec.get('mount_profile'))
 
         log.info("Successfully added partition")
-        self.partition_disk(disk)
 
     def add_format_handler(self, volume, spec, back):
         log.debug('add_format_handler')
-        old_fs = volume.fs()
-        if old_fs is not None:
-            self.model._filesystems.remove(old_fs)
-            volume._fs = None
-            mount = old_fs.mount()
-            if mount is not None:
-                old_fs._mount = None
-                self.model._mounts.remove(mount)
-        if spec['fstype'].label is not None:
-            fs = self.model.add_filesystem(volume, spec['fstype'].label)
-            if spec['mount']:
-                self.model.add_mount(fs, spec['mount'])
+        self.model.set_format(
+            volume, spec['fstype'].label, spec['mount'],
+            spec.get('mount_profile'), spec.get('existing', False))
         back()
 
     def connect_iscsi_disk(self, *args, **kwargs):
@@ -270,10 +374,60 @@ class FilesystemController(BaseController):
         self.ui.set_body(BcacheView(self.model,
                                     self.signal))
 
+    def _add_device(self, add, result, error):
+        # The model rejects selections it cannot build, such as a RAID
+        # over too few devices. Say why and leave the form up so the
+        # selection can be fixed.
+        try:
+            add(result)
+        except Exception as e:
+            log.debug('cannot add device: %s', e)
+            self.ui.set_footer(error.format(e))
+            return
+        self.manual()
+
     def add_raid_dev(self, result):
         log.debug('add_raid_dev: result={}'.format(result))
-        self.model.add_raid_device(result)
-        self.signal.prev_signal()
+        self._add_device(
+            self.model.add_raid_device, result, _("Cannot create RAID: {}"))
+
+    def add_lvm_volgroup(self, result):
+        log.debug('add_lvm_volgroup: result={}'.format(result))
+        self._add_device(
+            self.model.add_lvm_volgroup, result,
+            _("Cannot create volume group: {}"))
+
+    def add_bcache_dev(self, result):
+        log.debug('add_bcache_dev: result={}'.format(result))
+        self._add_device(
+            self.model.add_bcache_device, result,
+            _("Cannot create bcache device: {}"))
+
+    def add_logical_volume(self, vg):
+        log.debug("add_logical_volume {}".format(vg.name))
+        self.ui.set_header(_("Add a logical volume to {}").format(vg.name))
+        self.ui.set_footer(_("Create, format and mount a logical volume."))
+        self.ui.set_body(LogicalVolumeView(self.model, self, vg))
+
+    def _add_logical_volume(self, vg, spec):
+        with self.model.journal.step():
+            lv = self.model.add_logical_volume(vg, spec['name'], spec['size'])
+            self.model.set_format(
+                lv, spec['fstype'].label, spec['mount'],
+                spec.get('mount_profile'))
+
+    def add_logical_volume_handler(self, vg, spec):
+        log.debug('add_logical_volume_handler: spec={}'.format(spec))
+        self._add_device(
+            partial(self._add_logical_volume, vg), spec,
+            _("Cannot create logical volume: {}"))
+
+    def format_volume(self, volume):
+        log.debug("format_volume {}".format(volume.path))
+        self.ui.set_header(_("Format and/or mount {}").format(volume.path))
+        self.ui.set_footer(_("Format or mount the whole device."))
+        self.ui.set_body(
+            FormatEntireView(self.model, self, volume, self.manual))
 
     def format_entire(self, disk):
         log.debug("format_entire {}".format(disk.serial))
@@ -313,34 +467,109 @@ class FilesystemController(BaseController):
         next_device = available[next_idx]
         self.show_disk_information(next_device)
 
+    def _sysfs_name(self, disk):
+        return os.path.basename(disk._info.devpath or disk.path)
+
+    def benchmark_disks(self):
+        """Start measuring the read speed of every disk."""
+        if not self.prober.storage_is_live:
+            # The disks come from a machine config or a dry run, and a
+            # host device of the same name is a different disk.
+            log.debug("not benchmarking disks that are not this machine's")
+            return
+        for disk in self.model.all_disks():
+            fut = self.disk_benchmarks.start(disk.path, disk._info.size)
+            if fut is not None:
+                self.call_when_done(fut, self._benchmark_done)
+
+    def _benchmark_done(self, fut):
+        v = self.ui.frame.body
+        if isinstance(v, DiskInfoView):
+            self.show_disk_information(v.disk)
+        elif hasattr(v, 'refresh_model_inputs'):
+            v.refresh_model_inputs()
+
+    def benchmark_summary(self, disk):
+        """Describe how fast disk is, or return None if not measured."""
+        result = self.disk_benchmarks.get(disk.path)
+        if result is not None:
+            return result.summary()
+        if self.disk_benchmarks.running(disk.path):
+            return 'measuring...'
+        return None
+
+    def _disk_details_ready(self, disk, fut):
+        v = self.ui.frame.body
+        if isinstance(v, DiskInfoView) and v.disk is disk:
+            self.show_disk_information(disk)
+
     def show_disk_information(self, disk):
-        """ Show disk information, requires sudo/root
-        """
-        bus = disk._info.raw.get('ID_BUS', None)
-        major = disk._info.raw.get('MAJOR', None)
-        if bus is None and major == '253':
-            bus = 'virtio'
+        """ Show what is known about disk.
 
-        devpath = disk._info.raw.get('DEVPATH', disk.path)
-        rotational = '1'
-        try:
-            dev = os.path.basename(devpath)
-            rfile = '/sys/class/block/{}/queue/rotational'.format(dev)
-            rotational = open(rfile, 'r').read().strip()
-        except (PermissionError, FileNotFoundError, IOError):
-            log.exception('WARNING: Failed to read file {}'.format(rfile))
-            pass
+        Everything shown comes from the probe or from disk_details, so
+        this never waits for the disk itself. Details that are still
+        being looked up are shown once they arrive. They are only looked
+        up for the host's own disks.
+        """
+        info = disk._info
+        devpath = info.devpath
+        rotational = info.rotational
+        holders = []
+        block_index = self.model.block_index
+        if block_index is not None:
+            blockdev = block_index.get(os.path.basename(devpath))
+            if blockdev is not None:
+                if rotational is None:
+                    rotational = blockdev.rotational
+                holders = block_index.holders(blockdev.name)
+
+        name = self._sysfs_name(disk)
+        details = self.disk_details.get(name)
+        if details is None and not self.prober.storage_is_live:
+            # The disk comes from a machine config or a dry run, so the
+            # host's sysfs and smartctl know nothing about it.
+            queue = discard = link_speed = smart = 'unknown'
+        elif details is None:
+            fut = self.disk_details.lookup(name)
+            if fut is not None:
+                self.call_when_done(
+                    fut, partial(self._disk_details_ready, disk))
+            unknown = 'looking up...'
+            queue = discard = link_speed = smart = unknown
+        else:
+            if rotational is None:
+                rotational = details.rotational
+            queue = (
+                '{} byte logical / {} byte physical blocks, '
+                '{}KiB max request, {} requests, {} scheduler').format(
+                    details.logical_block_size,
+                    details.physical_block_size,
+                    details.max_sectors_kb, details.nr_requests,
+                    details.scheduler)
+            discard = {True: 'yes', False: 'no'}.get(
+                details.discard, 'unknown')
+            link_speed = details.link_speed or 'unknown'
+            smart = details.smart or 'unavailable'
+        if rotational is None:
+            rotational = True
 
         dinfo = {
-            'bus': bus,
+            'bus': info.bus,
             'devname': disk.path,
             'devpath': devpath,
             'model': disk.model,
             'serial': disk.serial,
             'size': disk.size,
             'humansize': humanize_size(disk.size),
-            'vendor': disk._info.vendor,
-            'rotational': 'true' if rotational == '1' else 'false',
+            'vendor': info.vendor,
+            'rotational': 'true' if rotational else 'false',
+            'holders': ', '.join(holders) or 'none',
+            'paths': ', '.join((disk.path,) + info.paths),
+            'queue': queue,
+            'discard': discard,
+            'link_speed': link_speed,
+            'smart': smart,
+            'speed': self.benchmark_summary(disk) or 'not measured',
         }
 
         template = """\n
@@ -350,7 +579,14 @@ class FilesystemController(BaseController):
  SerialNo: {serial}
  Size: {humansize} ({size}B)
  Bus: {bus}
+ Link speed: {link_speed}
  Rotational: {rotational}
+ Queue: {queue}
+ Discard: {discard}
+ SMART: {smart}
+ Read speed: {speed}
+ Holders: {holders}
+ Device nodes: {paths}
  Path: {devpath}
 """
         result = template.format(**dinfo)
@@ -0,0 +1,224 @@
+import concurrent.futures
+import unittest
+from unittest import mock
+
+from subiquitycore.testing import view_helpers
+
+from subiquity.controllers.filesystem import FilesystemController
+from subiquity.models.filesystem import FilesystemModel
+from subiquity.models.tests.test_filesystem import FakeProber, fake_disk_data
+from subiquity.ui.views.filesystem.guided import GuidedDiskSelectionView
+
+
+class TestProbeComplete(unittest.TestCase):
+
+    def make_controller(self, answers=None):
+        prober = mock.Mock()
+        prober.start_storage_probe.return_value = concurrent.futures.Future()
+        prober.probe_storage_events.return_value = (None, [])
+        base_model = mock.Mock()
+        base_model.filesystem.all_disks.return_value = []
+        common = {
+            'ui': mock.Mock(),
+            'signal': mock.Mock(),
+            'opts': mock.Mock(),
+            'loop': mock.Mock(),
+            'prober': prober,
+            'controllers': {},
+            'pool': mock.Mock(),
+            'base_model': base_model,
+            'answers': {'Filesystem': answers or {}},
+            'input_filter': mock.Mock(),
+            }
+        controller = FilesystemController(common)
+        controller.default = mock.Mock()
+        return controller
+
+    def done(self, result=None, exc=None):
+        fut = concurrent.futures.Future()
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(result)
+        return fut
+
+    def test_starts_probe(self):
+        controller = self.make_controller()
+        controller.prober.start_storage_probe.assert_called_once_with()
+        self.assertFalse(controller.probed)
+
+    def test_success(self):
+        controller = self.make_controller()
+        controller._probe_complete(self.done({}))
+        self.assertTrue(controller.probed)
+        controller.model.probe.assert_called_once_with()
+        controller.prober.probe_storage_events.assert_called_once_with(
+            controller.model)
+        controller.default.assert_not_called()
+
+    def test_details_only_for_live_disks(self):
+        controller = self.make_controller()
+        controller.disk_details = mock.Mock()
+        disk = mock.Mock(path='/dev/sda')
+        disk._info.devpath = '/devices/pci0000:00/block/sda'
+        controller.model.all_disks.return_value = [disk]
+        controller.prober.storage_is_live = False
+        controller._probe_complete(self.done({}))
+        controller.disk_details.lookup.assert_not_called()
+        controller.prober.storage_is_live = True
+        controller._probe_complete(self.done({}))
+        controller.disk_details.lookup.assert_called_once_with('sda')
+
+    def test_benchmarks_only_live_disks(self):
+        controller = self.make_controller()
+        controller.disk_benchmarks = mock.Mock()
+        controller.disk_benchmarks.start.return_value = None
+        disk = mock.Mock(path='/dev/sda')
+        disk._info.size = 8 << 20
+        controller.model.all_disks.return_value = [disk]
+        controller.prober.storage_is_live = False
+        controller.benchmark_disks()
+        controller.disk_benchmarks.start.assert_not_called()
+        controller.prober.storage_is_live = True
+        controller.benchmark_disks()
+        controller.disk_benchmarks.start.assert_called_once_with(
+            '/dev/sda', 8 << 20)
+
+    def test_failure(self):
+        controller = self.make_controller()
+        controller._probe_complete(self.done(exc=OSError("boom")))
+        self.assertTrue(controller.probed)
+        controller.model.probe.assert_not_called()
+        controller.prober.probe_storage_events.assert_not_called()
+
+    def test_handoff_from_probing_view(self):
+        controller = self.make_controller()
+        view = object()
+        controller.probing_view = view
+        controller.ui.frame.body = view
+        controller._probe_complete(self.done({}))
+        self.assertIsNone(controller.probing_view)
+        controller.default.assert_called_once_with()
+
+    def test_handoff_after_failure(self):
+        controller = self.make_controller()
+        view = object()
+        controller.probing_view = view
+        controller.ui.frame.body = view
+        controller._probe_complete(self.done(exc=OSError("boom")))
+        controller.default.assert_called_once_with()
+
+    def test_no_handoff_once_user_moved_on(self):
+        controller = self.make_controller()
+        controller.probing_view = object()
+        controller.ui.frame.body = object()
+        controller._probe_complete(self.done({}))
+        self.assertIsNone(controller.probing_view)
+        controller.default.assert_not_called()
+
+
+class TestAddDevice(unittest.TestCase):
+
+    make_controller = TestProbeComplete.make_controller
+
+    def test_add_raid(self):
+        controller = self.make_controller()
+        controller.manual = mock.Mock()
+        controller.add_raid_dev({'devices': ['/dev/sda', '/dev/sdb']})
+        controller.manual.assert_called_once_with()
+
+    def test_add_raid_error(self):
+        controller = self.make_controller()
+        controller.manual = mock.Mock()
+        controller.model.add_raid_device.side_effect = ValueError(
+            "RAID1 needs at least 2 devices")
+        controller.add_raid_dev({'devices': ['/dev/sda']})
+        controller.manual.assert_not_called()
+        controller.ui.set_footer.assert_called_with(
+            "Cannot create RAID: RAID1 needs at least 2 devices")
+
+    def test_add_volgroup_error(self):
+        controller = self.make_controller()
+        controller.manual = mock.Mock()
+        controller.model.add_lvm_volgroup.side_effect = ValueError(
+            "a volume group needs at least one device")
+        controller.add_lvm_volgroup({'devices': [], 'volgroup': 'vg0'})
+        controller.manual.assert_not_called()
+
+    def test_add_logical_volume(self):
+        controller = self.make_controller()
+        controller.manual = mock.Mock()
+        controller.model.journal = mock.MagicMock()
+        vg = mock.Mock()
+        controller.add_logical_volume_handler(vg, {
+            'name': 'lv0', 'size': 1 << 30, 'fstype': mock.Mock(label='xfs'),
+            'mount': '/srv'})
+        lv = controller.model.add_logical_volume.return_value
+        controller.model.add_logical_volume.assert_called_once_with(
+            vg, 'lv0', 1 << 30)
+        controller.model.set_format.assert_called_once_with(
+            lv, 'xfs', '/srv', None)
+        controller.manual.assert_called_once_with()
+
+
+class TestSwapAnswers(unittest.TestCase):
+
+    make_controller = TestProbeComplete.make_controller
+
+    def test_defaults(self):
+        model = self.make_controller().model
+        self.assertEqual(model.swap_policy, 'ratio')
+        self.assertIsNone(model.swap_fixed_size)
+        self.assertEqual(model.swap_kind, 'partition')
+
+    def test_human_size(self):
+        model = self.make_controller({
+            'swap-policy': 'fixed',
+            'swap-size': '4G',
+            'swap-kind': 'file',
+            }).model
+        self.assertEqual(model.swap_policy, 'fixed')
+        self.assertEqual(model.swap_fixed_size, 4 << 30)
+        self.assertEqual(model.swap_kind, 'file')
+        model = self.make_controller({'swap-size': 1 << 30}).model
+        self.assertEqual(model.swap_fixed_size, 1 << 30)
+
+    def test_bad_answers(self):
+        for answers in [
+                {'swap-policy': 'lots'},
+                {'swap-kind': 'zram'},
+                {'swap-size': 'huge'},
+                ]:
+            with self.subTest(answers=answers):
+                with self.assertRaises(ValueError):
+                    self.make_controller(answers)
+
+
+class TestGuided(unittest.TestCase):
+
+    make_controller = TestProbeComplete.make_controller
+
+    def test_answered_index_is_position_on_screen(self):
+        # The larger disk ranks first but sorts last by serial.
+        model = FilesystemModel(FakeProber({
+            '/dev/fakea': fake_disk_data('/dev/fakea', 10 << 30),
+            '/dev/fakeb': fake_disk_data('/dev/fakeb', 100 << 30),
+            }))
+        model.probe()
+        for index in 0, 1:
+            controller = self.make_controller()
+            controller.model = model
+            controller.benchmark_summary = mock.Mock(return_value=None)
+            controller.answers['guided'] = True
+            controller.answers['guided-index'] = index
+            with mock.patch.object(
+                    GuidedDiskSelectionView, 'choose_disk',
+                    autospec=True) as choose_disk:
+                controller.guided()
+                [view], _ = controller.ui.set_body.call_args
+                answered = choose_disk.call_args[0][2]
+                button, _ = view.disk_list.contents[index]
+                view_helpers.click(
+                    view_helpers.find_button_matching(button, ''))
+                shown = choose_disk.call_args[0][2]
+            self.assertIs(answered, shown)
@@ -42,3 +42,6 @@ class Subiquity(Application):
     def __init__(self, ui, opts):
         super().__init__(ui, opts)
         self.common['ui'].progress_completion += 1
+        # Probe storage in the background so the screens before the
+        # filesystem screen can be shown while it runs.
+        self.common['prober'].start_storage_probe()
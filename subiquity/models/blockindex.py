@@ -0,0 +1,180 @@
+# Copyright 2018 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import sys
+
+import attr
+
+
+log = logging.getLogger('subiquity.models.blockindex')
+
+SYS_CLASS_BLOCK = '/sys/class/block'
+
+
+def _read_sysfs(path):
+    try:
+        with open(path) as fp:
+            return fp.read().strip()
+    except OSError:
+        return None
+
+
+def _read_sysfs_int(path):
+    value = _read_sysfs(path)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@attr.s
+class BlockDevice:
+    name = attr.ib()  # as in /sys/class/block, eg sda1
+    parent = attr.ib(default=None)  # name of the disk, for a partition
+    partitions = attr.ib(default=attr.Factory(list))  # [name]
+    holders = attr.ib(default=attr.Factory(list))  # [name], eg dm-0, md0
+    mountpoints = attr.ib(default=attr.Factory(list))
+    swap = attr.ib(default=False)
+    rotational = attr.ib(default=None)
+
+    @property
+    def path(self):
+        return '/dev/' + self.name.replace('!', '/')
+
+
+class BlockIndex:
+    """A snapshot of the block devices on the system.
+
+    This is built with one pass over /sys/class/block, /proc/mounts and
+    /proc/swaps and records, for each block device, its partitions or
+    parent disk, the devices (device mapper, md, bcache...) holding it
+    and whether it is mounted or used as swap.
+
+    Passing None for a path skips reading it, so BlockIndex(None, None,
+    None) is an empty index for storage that is not this machine's.
+    """
+
+    def __init__(self, sys_block=SYS_CLASS_BLOCK, proc_mounts='/proc/mounts',
+                 proc_swaps='/proc/swaps'):
+        self.sys_block = sys_block
+        self.devices = {}
+        if sys_block is not None:
+            self._scan_sysfs()
+        if proc_mounts is not None:
+            self._scan_mounts(proc_mounts)
+        if proc_swaps is not None:
+            self._scan_swaps(proc_swaps)
+
+    def _scan_sysfs(self):
+        try:
+            names = os.listdir(self.sys_block)
+        except OSError:
+            log.exception("could not list %s", self.sys_block)
+            return
+        for name in names:
+            devdir = os.path.join(self.sys_block, name)
+            dev = self.devices[name] = BlockDevice(name=name)
+            if os.path.exists(os.path.join(devdir, 'partition')):
+                dev.parent = os.path.basename(
+                    os.path.dirname(os.path.realpath(devdir)))
+            else:
+                rotational = _read_sysfs(
+                    os.path.join(devdir, 'queue', 'rotational'))
+                if rotational is not None:
+                    dev.rotational = rotational == '1'
+            try:
+                dev.holders = sorted(
+                    os.listdir(os.path.join(devdir, 'holders')))
+            except OSError:
+                pass
+        for dev in self.devices.values():
+            if dev.parent in self.devices:
+                self.devices[dev.parent].partitions.append(dev.name)
+
+    def _device_for_node(self, node):
+        # Resolve symlinks such as /dev/mapper/vg-root or
+        # /dev/disk/by-uuid/... to the kernel's name for the device.
+        node = os.path.realpath(node)
+        if not node.startswith('/dev/'):
+            return None
+        return self.devices.get(node[5:].replace('/', '!'))
+
+    def _scan_mounts(self, proc_mounts):
+        try:
+            with open(proc_mounts, encoding=sys.getfilesystemencoding()) as pm:
+                for line in pm:
+                    if not line.startswith('/dev/'):
+                        continue
+                    node, mountpoint = line.split()[:2]
+                    dev = self._device_for_node(node)
+                    if dev is not None:
+                        dev.mountpoints.append(mountpoint)
+        except OSError:
+            log.exception("could not read %s", proc_mounts)
+
+    def _scan_swaps(self, proc_swaps):
+        try:
+            with open(proc_swaps, encoding=sys.getfilesystemencoding()) as ps:
+                next(ps, None)  # skip the header line
+                for line in ps:
+                    dev = self._device_for_node(line.split()[0])
+                    if dev is not None:
+                        dev.swap = True
+        except OSError:
+            log.exception("could not read %s", proc_swaps)
+
+    def get(self, path):
+        """Look up a device by name (sda) or path (/dev/sda)."""
+        if path.startswith('/dev/'):
+            path = path[5:].replace('/', '!')
+        return self.devices.get(path)
+
+    def is_in_use(self, path):
+        """Is the device, one of its partitions or anything holding
+        them (such as an LVM volume or RAID array) mounted or in use as
+        swap?"""
+        dev = self.get(path)
+        if dev is None:
+            return False
+        seen = set()
+        todo = [dev.name]
+        while todo:
+            name = todo.pop()
+            if name in seen or name not in self.devices:
+                continue
+            seen.add(name)
+            dev = self.devices[name]
+            if dev.mountpoints or dev.swap:
+                return True
+            todo.extend(dev.partitions)
+            todo.extend(dev.holders)
+        return False
+
+    def holders(self, path):
+        """The names of the devices holding the device or its partitions."""
+        dev = self.get(path)
+        if dev is None:
+            return []
+        r = list(dev.holders)
+        for part in dev.partitions:
+            r.extend(self.devices[part].holders)
+        return r
+
+    def in_use_disks(self):
+        return set(
+            dev.path for dev in self.devices.values()
+            if dev.parent is None and self.is_in_use(dev.name))
@@ -0,0 +1,185 @@
+# Copyright 2018 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A quick measurement of how fast a disk can be read, to help choose
+# between disks that look alike on paper. Disks are only ever opened
+# read-only: nothing here writes to them.
+
+import concurrent.futures
+import logging
+import mmap
+import os
+import random
+import time
+
+import attr
+
+from .filesystem import humanize_size
+
+
+log = logging.getLogger('subiquity.models.diskbench')
+
+SEQUENTIAL_CHUNK = 1 << 20
+SEQUENTIAL_BYTES = 128 << 20
+RANDOM_BLOCK = 4096
+RANDOM_READS = 512
+# Each half of the benchmark stops after this many seconds, however
+# slow the disk is.
+PHASE_TIME_LIMIT = 2.0
+
+
+@attr.s
+class BenchmarkResult:
+    sequential = attr.ib(default=None)  # bytes per second
+    random_iops = attr.ib(default=None)
+    random_latency = attr.ib(default=None)  # mean, in seconds
+    random_latency_p99 = attr.ib(default=None)
+    error = attr.ib(default=None)
+
+    def summary(self):
+        if self.error is not None:
+            return "failed: " + self.error
+        return "{}/s sequential, {:.0f} IOPS, {:.2f}ms latency".format(
+            humanize_size(self.sequential), self.random_iops,
+            self.random_latency * 1000)
+
+
+def _read_at(fd, buf, offset):
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.readv(fd, [buf])
+
+
+def _sequential(fd, buf, size):
+    end = min(SEQUENTIAL_BYTES, size - size % SEQUENTIAL_CHUNK)
+    done = 0
+    start = time.monotonic()
+    while done < end:
+        n = _read_at(fd, buf, done)
+        if n <= 0:
+            break
+        done += n
+        if time.monotonic() - start > PHASE_TIME_LIMIT:
+            break
+    elapsed = time.monotonic() - start
+    return done / elapsed if elapsed > 0 else 0
+
+
+def _random(fd, buf, size, rng):
+    block = memoryview(buf)[:RANDOM_BLOCK]
+    blocks = size // RANDOM_BLOCK
+    latencies = []
+    start = time.monotonic()
+    for i in range(RANDOM_READS):
+        offset = rng.randrange(blocks) * RANDOM_BLOCK
+        t = time.monotonic()
+        _read_at(fd, block, offset)
+        latencies.append(time.monotonic() - t)
+        if t - start > PHASE_TIME_LIMIT:
+            break
+    elapsed = time.monotonic() - start
+    latencies.sort()
+    return (
+        len(latencies) / elapsed if elapsed > 0 else 0,
+        sum(latencies) / len(latencies),
+        latencies[int(0.99 * (len(latencies) - 1))],
+        )
+
+
+def benchmark_device(path, size, direct=True, rng=None):
+    """Measure sequential and random read speed of the first size bytes.
+
+    With direct, the page cache is bypassed with O_DIRECT so that the
+    disk rather than memory is measured.
+    """
+    if size < SEQUENTIAL_CHUNK:
+        return BenchmarkResult(error="too small to measure")
+    if rng is None:
+        rng = random.Random()
+    flags = os.O_RDONLY
+    if direct:
+        flags |= os.O_DIRECT
+    try:
+        fd = os.open(path, flags)
+    except OSError as e:
+        return BenchmarkResult(error=e.strerror)
+    # O_DIRECT needs aligned buffers; an anonymous mmap is page aligned.
+    buf = mmap.mmap(-1, SEQUENTIAL_CHUNK)
+    try:
+        result = BenchmarkResult(sequential=_sequential(fd, buf, size))
+        (result.random_iops, result.random_latency,
+         result.random_latency_p99) = _random(fd, buf, size, rng)
+    except OSError as e:
+        log.exception("benchmarking %s failed", path)
+        result = BenchmarkResult(error=e.strerror)
+    finally:
+        buf.close()
+        os.close(fd)
+    log.debug("benchmark of %s: %s", path, result)
+    return result
+
+
+class DiskBenchmarks:
+    """Benchmarks disks in a worker thread and remembers the results.
+
+    There is only one worker, so disks are measured one at a time and
+    do not compete for a shared controller or bus.
+    """
+
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._results = {}  # {path: BenchmarkResult}
+        self._failures = {}  # {path: BenchmarkResult}, the last failed run
+        self._pending = {}  # {path: Future}
+
+    def get(self, path):
+        """The result for path, or of its last failed run if it has none."""
+        result = self._results.get(path)
+        if result is None:
+            result = self._failures.get(path)
+        return result
+
+    def running(self, path):
+        fut = self._pending.get(path)
+        return fut is not None and not fut.done()
+
+    def start(self, path, size):
+        """Queue a benchmark of path, unless it has been done already.
+
+        Returns a future that completes when the result is available
+        from get(), or None if it already is. A disk whose last run
+        failed is measured again.
+        """
+        if path in self._results:
+            return None
+        fut = self._pending.get(path)
+        if fut is None or fut.done():
+            fut = self._pending[path] = self._executor.submit(
+                self._run, path, size)
+        return fut
+
+    def _run(self, path, size):
+        try:
+            result = benchmark_device(path, size)
+            if result.error is None:
+                self._results[path] = result
+                self._failures.pop(path, None)
+            else:
+                self._failures[path] = result
+            return result
+        finally:
+            # Otherwise a failed run would look like it is still going.
+            # The run can also finish before start() has stored its
+            # future, which is why running() checks fut.done() too.
+            self._pending.pop(path, None)
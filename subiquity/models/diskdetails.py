@@ -0,0 +1,186 @@
+# Copyright 2018 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+
+import attr
+
+from .blockindex import SYS_CLASS_BLOCK, _read_sysfs, _read_sysfs_int
+
+
+log = logging.getLogger('subiquity.models.diskdetails')
+
+SMARTCTL_TIMEOUT = 10
+
+
+@attr.s
+class DiskDetails:
+    """Things about a disk that are too slow to find out while probing."""
+    rotational = attr.ib(default=None)
+    logical_block_size = attr.ib(default=None)
+    physical_block_size = attr.ib(default=None)
+    max_sectors_kb = attr.ib(default=None)
+    nr_requests = attr.ib(default=None)
+    scheduler = attr.ib(default=None)
+    discard = attr.ib(default=None)
+    link_speed = attr.ib(default=None)
+    smart = attr.ib(default=None)
+
+
+def _link_speed(devdir):
+    # Walk up from the disk towards the root of the device tree and
+    # report the first link whose speed the kernel knows.
+    path = os.path.realpath(os.path.join(devdir, 'device'))
+    while os.path.dirname(path) != path:
+        base = os.path.basename(path)
+        m = re.match(r'ata(\d+)$', base)
+        if m is not None:
+            link = 'link' + m.group(1)
+            speed = _read_sysfs(
+                os.path.join(path, link, 'ata_link', link, 'sata_spd'))
+            if speed and speed != '<unknown>':
+                return 'SATA ' + speed
+        if os.path.exists(os.path.join(path, 'idVendor')):
+            speed = _read_sysfs(os.path.join(path, 'speed'))
+            if speed:
+                return 'USB {} Mbit/s'.format(speed)
+        speed = _read_sysfs(os.path.join(path, 'current_link_speed'))
+        if speed:
+            width = _read_sysfs(os.path.join(path, 'current_link_width'))
+            if width:
+                return 'PCIe {} x{}'.format(speed, width)
+            return 'PCIe ' + speed
+        path = os.path.dirname(path)
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _smartctl():
+    # JSON output (-j) arrived in smartmontools 7.0.
+    smartctl = shutil.which('smartctl')
+    if smartctl is None:
+        return None
+    try:
+        cp = subprocess.run(
+            [smartctl, '--version'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+            timeout=SMARTCTL_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log.debug("running smartctl --version failed: %s", e)
+        return None
+    m = re.match(rb'smartctl (\d+)\.', cp.stdout)
+    if m is None or int(m.group(1)) < 7:
+        log.debug("smartctl is too old to report JSON, not using it")
+        return None
+    return smartctl
+
+
+def _smart_summary(devnode):
+    smartctl = _smartctl()
+    if smartctl is None or not os.path.exists(devnode):
+        return None
+    try:
+        cp = subprocess.run(
+            [smartctl, '-H', '-A', '-j', devnode], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+            timeout=SMARTCTL_TIMEOUT)
+        data = json.loads(cp.stdout.decode('utf-8', 'replace'))
+    except (OSError, subprocess.TimeoutExpired, ValueError) as e:
+        log.debug("running smartctl on %s failed: %s", devnode, e)
+        return None
+    r = []
+    passed = data.get('smart_status', {}).get('passed')
+    if passed is not None:
+        r.append('PASSED' if passed else 'FAILED')
+    temperature = data.get('temperature', {}).get('current')
+    if temperature is not None:
+        r.append('{}C'.format(temperature))
+    hours = data.get('power_on_time', {}).get('hours')
+    if hours is not None:
+        r.append('{} hours powered on'.format(hours))
+    return ', '.join(r) or None
+
+
+def gather_disk_details(name, sys_block=SYS_CLASS_BLOCK):
+    """Look up the DiskDetails of the disk called name in sys_block."""
+    devdir = os.path.join(sys_block, name)
+    queue = os.path.join(devdir, 'queue')
+    details = DiskDetails()
+    rotational = _read_sysfs(os.path.join(queue, 'rotational'))
+    if rotational is not None:
+        details.rotational = rotational == '1'
+    for limit in ('logical_block_size', 'physical_block_size',
+                  'max_sectors_kb', 'nr_requests'):
+        setattr(details, limit, _read_sysfs_int(os.path.join(queue, limit)))
+    scheduler = _read_sysfs(os.path.join(queue, 'scheduler'))
+    if scheduler is not None:
+        # The scheduler in use is the one in brackets.
+        m = re.search(r'\[(.*?)\]', scheduler)
+        details.scheduler = m.group(1) if m else scheduler
+    discard = _read_sysfs_int(os.path.join(queue, 'discard_max_bytes'))
+    if discard is not None:
+        details.discard = discard > 0
+    details.link_speed = _link_speed(devdir)
+    details.smart = _smart_summary('/dev/' + name.replace('!', '/'))
+    return details
+
+
+class DiskDetailsService:
+    """Gathers DiskDetails in a worker thread and remembers them.
+
+    The worker is separate from the application's thread pool so that
+    a slow smartctl never holds up probing or the install.
+    """
+
+    def __init__(self, sys_block=SYS_CLASS_BLOCK):
+        self.sys_block = sys_block
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._details = {}  # {name: DiskDetails}
+        self._pending = {}  # {name: Future}
+
+    def get(self, name):
+        """The details of the disk called name, or None if not known yet."""
+        return self._details.get(name)
+
+    def lookup(self, name):
+        """Start looking up name, unless that has been done already.
+
+        Returns a future that completes when the details are available
+        from get(), or None if they are already.
+        """
+        if name in self._details:
+            return None
+        fut = self._pending.get(name)
+        if fut is None:
+            fut = self._pending[name] = self._executor.submit(
+                self._gather, name)
+        return fut
+
+    def _gather(self, name):
+        try:
+            details = gather_disk_details(name, self.sys_block)
+        except Exception:
+            log.exception("looking up details of %s failed", name)
+            details = DiskDetails()
+        self._details[name] = details
+        self._pending.pop(name, None)
+        return details
@@ -0,0 +1,168 @@
+# Copyright 2018 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+
+
+class FreeExtents:
+    """The unallocated byte ranges of a disk.
+
+    Ranges are kept sorted by start offset and adjacent ranges are
+    always merged, so the number of entries is the number of gaps.
+    New allocations start and end at offsets that are skew more than a
+    multiple of grain, so they stay aligned however the gaps around
+    existing allocations fall.
+    """
+
+    def __init__(self, start, end, grain=1, skew=0):
+        self.start = start
+        self.end = end
+        self.grain = grain
+        self.skew = skew % grain
+        self._starts = []
+        self._ends = []
+        self.total = 0
+        if end > start:
+            self._starts.append(start)
+            self._ends.append(end)
+            self.total = end - start
+
+    def __iter__(self):
+        return iter(zip(self._starts, self._ends))
+
+    def __len__(self):
+        return len(self._starts)
+
+    def _aligned(self, start, end):
+        # The aligned part of [start, end), as (start, end).
+        start += (self.skew - start) % self.grain
+        end -= (end - self.skew) % self.grain
+        return start, max(start, end)
+
+    def largest(self):
+        r = 0
+        for start, end in self:
+            start, end = self._aligned(start, end)
+            r = max(r, end - start)
+        return r
+
+    def _find(self, size, fit):
+        best = None
+        best_length = None
+        for i, (start, end) in enumerate(self):
+            start, end = self._aligned(start, end)
+            length = end - start
+            if length < size:
+                continue
+            if fit == 'first':
+                return i
+            if best is None or length < best_length:
+                best, best_length = i, length
+        return best
+
+    def _containing(self, offset, size):
+        i = bisect.bisect_right(self._starts, offset) - 1
+        if i >= 0 and offset + size <= self._ends[i]:
+            return i
+        return None
+
+    def allocate(self, size, fit='first', at=None):
+        """Take size bytes out of a gap and return the offset, or None.
+
+        fit is 'first' for the lowest gap whose aligned part is big
+        enough or 'best' for the smallest such gap, and the allocation
+        starts at the first aligned offset in it. If at is given the
+        allocation must start exactly there.
+        """
+        if at is not None:
+            i = self._containing(at, size)
+        else:
+            i = self._find(size, fit)
+        if i is None:
+            return None
+        start, end = self._starts[i], self._ends[i]
+        if at is None:
+            at = self._aligned(start, end)[0]
+        del self._starts[i], self._ends[i]
+        if at + size < end:
+            self._starts.insert(i, at + size)
+            self._ends.insert(i, end)
+        if start < at:
+            self._starts.insert(i, start)
+            self._ends.insert(i, at)
+        self.total -= size
+        return at
+
+    def reserve(self, offset, size):
+        """Mark whatever is free in [offset, offset + size) as used.
+
+        Unlike allocate(), the range need not be free or even lie within
+        the disk's usable space. Returns the number of bytes taken.
+        """
+        start, end = offset, offset + size
+        taken = 0
+        i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        while i < len(self) and self._starts[i] < end:
+            s, e = self._starts[i], self._ends[i]
+            if e <= start:
+                i += 1
+                continue
+            lo, hi = max(s, start), min(e, end)
+            taken += hi - lo
+            del self._starts[i], self._ends[i]
+            if hi < e:
+                self._starts.insert(i, hi)
+                self._ends.insert(i, e)
+            if s < lo:
+                self._starts.insert(i, s)
+                self._ends.insert(i, lo)
+                i += 1
+            i += 1 if hi < e else 0
+        self.total -= taken
+        return taken
+
+    def release(self, offset, size):
+        """Return [offset, offset + size) to the free ranges.
+
+        Any part of the range outside the usable space is ignored.
+        """
+        start = max(offset, self.start)
+        end = min(offset + size, self.end)
+        if end <= start:
+            return
+        size = end - start
+        i = bisect.bisect_left(self._starts, start)
+        if i < len(self) and self._starts[i] == end:
+            end = self._ends[i]
+            del self._starts[i], self._ends[i]
+        if i > 0 and self._ends[i - 1] == start:
+            i -= 1
+            start = self._starts[i]
+            del self._starts[i], self._ends[i]
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+        self.total += size
+
+    def free_around(self, offset, size):
+        """The size [offset, offset + size) could grow to in place."""
+        start, end = offset, offset + size
+        i = bisect.bisect_left(self._starts, end)
+        if i < len(self) and self._starts[i] == end:
+            end = self._ends[i]
+        i = bisect.bisect_left(self._ends, start)
+        if i < len(self) and self._ends[i] == start:
+            start = self._starts[i]
+        start, end = self._aligned(start, end)
+        return end - start
@@ -14,16 +14,46 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
-import glob
+import fnmatch
 import logging
 import math
 import os
-import sys
+import shlex
 
 import attr
 
+from .blockindex import BlockIndex
+from .extents import FreeExtents
+from .fstuning import (
+    RAID_DEFAULT_CHUNK,
+    mkfs_options,
+    mount_options,
+    suggest_mount_profile,
+    )
+from .journal import (
+    Journal,
+    JournaledDict,
+    journaled,
+    record,
+    )
+from .swap import (
+    read_memtotal,
+    swap_size,
+    )
+
 
 HUMAN_UNITS = ['B', 'K', 'M', 'G', 'T', 'P']
+PARTITION_ALIGN = 1 << 20
+MAX_PARTITION_ALIGN = 64 << 20
+BIOS_GRUB_SIZE_BYTES = 2 * 1024 * 1024   # 2MiB
+UEFI_GRUB_SIZE_BYTES = 512 * 1024 * 1024  # 512MiB EFI partition
+BUS_SCORES = {
+    'nvme': 400,
+    'virtio': 250,
+    'ata': 200,
+    'scsi': 200,
+    'usb': 0,
+    }
 log = logging.getLogger('subiquity.models.filesystem')
 
 
@@ -91,18 +121,232 @@ def id_factory(name):
     return attr.Factory(factory)
 
 
+_public_fields = {}
+
+
+def public_fields(cls):
+    names = _public_fields.get(cls)
+    if names is None:
+        names = _public_fields[cls] = [
+            field.name for field in attr.fields(cls)
+            if not field.name.startswith('_')]
+    return names
+
+
 def asdict(inst):
     r = collections.OrderedDict()
-    for field in attr.fields(type(inst)):
-        if field.name.startswith('_'):
-            continue
-        v = getattr(inst, field.name)
-        if v:
+    for name in public_fields(type(inst)):
+        v = getattr(inst, name)
+        # Leave out unset fields, but not zeroes such as raidlevel 0.
+        if v or (v == 0 and not isinstance(v, bool)):
             if hasattr(v, 'id'):
                 v = v.id
-            r[field.name] = v
+            elif isinstance(v, list):
+                v = [getattr(x, 'id', x) for x in v]
+            r[name] = v
     return r
 
+
+class CachedRender:
+    """Mixin that remembers asdict() of an object until it is changed.
+
+    Assigning to any public attribute throws the cached dict away, so
+    mutable field values must be replaced rather than modified in place.
+    Assignments are also recorded in the model's journal; code that
+    changes a private container in place must call record() first.
+    """
+
+    _rendered = None
+    _journal_caches = ('_rendered',)
+
+    def __setattr__(self, name, value):
+        record(self, name)
+        super().__setattr__(name, value)
+        if not name.startswith('_'):
+            super().__setattr__('_rendered', None)
+
+    def render(self):
+        if self._rendered is None:
+            self._rendered = asdict(self)
+        return self._rendered
+
+
+# Partition types, from ID_PART_ENTRY_TYPE, that map to curtin flags.
+PARTITION_TYPE_FLAGS = {
+    'c12a7328-f81f-11d2-ba4b-00a0c93ec93b': 'boot',
+    '21686148-6449-6e6f-744e-656564454649': 'bios_grub',
+    '0xef': 'boot',
+    '0x5': 'extended',
+    '0xf': 'extended',
+    '0x85': 'extended',
+    }
+
+# Filesystem types, from ID_FS_TYPE, that subiquity can handle.
+PROBED_FSTYPES = {
+    'ext4': 'ext4',
+    'xfs': 'xfs',
+    'btrfs': 'btrfs',
+    'swap': 'swap',
+    'vfat': 'fat32',
+    }
+
+
+@attr.s(slots=True)
+class ExistingPartition:
+    """A partition found on a disk when it was probed."""
+
+    number = attr.ib()
+    offset = attr.ib()
+    size = attr.ib()
+    flag = attr.ib(default=None)
+    fstype = attr.ib(default=None)  # as in FilesystemModel.fs_by_name
+    uuid = attr.ib(default=None)
+    label = attr.ib(default=None)
+
+    @classmethod
+    def from_probe_data(cls, data):
+        number = int(data['ID_PART_ENTRY_NUMBER'])
+        flag = PARTITION_TYPE_FLAGS.get(data.get('ID_PART_ENTRY_TYPE'))
+        scheme = data.get('ID_PART_ENTRY_SCHEME')
+        if flag is None and scheme == 'dos' and number > 4:
+            flag = 'logical'
+        fstype = PROBED_FSTYPES.get(data.get('ID_FS_TYPE'))
+        if fstype == 'fat32' and data.get('ID_FS_VERSION') != 'FAT32':
+            fstype = None
+        return cls(
+            number=number,
+            offset=int(data['ID_PART_ENTRY_OFFSET']) * 512,
+            size=int(data['ID_PART_ENTRY_SIZE']) * 512,
+            flag=flag,
+            fstype=fstype,
+            uuid=data.get('ID_FS_UUID'),
+            label=data.get('ID_FS_LABEL'),
+            )
+
+
+def _partition_disk(data):
+    # The path of the disk a partition is on, from its probe data.
+    return '/dev/' + os.path.basename(os.path.dirname(data['DEVPATH']))
+
+
+def _int_attr(attrs, name):
+    try:
+        return int(attrs[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+@attr.s(slots=True)
+class DiskInfo:
+    """The parts of a disk's probe data that subiquity looks at.
+
+    The full udev data for a disk is large and mostly irrelevant, so
+    only these fields are kept once a disk has been probed.
+    """
+
+    name = attr.ib()
+    size = attr.ib()
+    serial = attr.ib(default=None)
+    model = attr.ib(default=None)
+    vendor = attr.ib(default=None)
+    bus = attr.ib(default=None)
+    major = attr.ib(default=None)
+    devpath = attr.ib(default=None)
+    rotational = attr.ib(default=None)  # True, False or None if not known
+    removable = attr.ib(default=False)
+    ptable = attr.ib(default=None)  # 'gpt', 'msdos' or None if not partitioned
+    wwid = attr.ib(default=None)  # set for disks reachable by several paths
+    dm_name = attr.ib(default=None)  # the map's name, for a multipath disk
+    paths = attr.ib(default=())  # other device nodes for the same disk
+    partitions = attr.ib(default=())  # (ExistingPartition,)
+    # I/O topology from the disk's queue limits, in bytes.
+    physical_block_size = attr.ib(default=None)
+    minimum_io_size = attr.ib(default=None)
+    optimal_io_size = attr.ib(default=None)
+    alignment_offset = attr.ib(default=None)
+
+    @classmethod
+    def from_storage_info(cls, info, partitions=()):
+        # Everything here comes from the probe data, not the running
+        # system, so a machine config ranks and aligns disks the same
+        # way wherever it is loaded.
+        raw = info.raw
+        attrs = raw.get('attrs', {})
+        bus = raw.get('ID_BUS')
+        # udev sets no ID_BUS for virtio disks. Their major number is
+        # allocated dynamically (and 253 is often device mapper's), so
+        # look for the virtio device they hang off instead.
+        if bus is None and ('/virtio' in raw.get('DEVPATH', '')
+                            or 'virtio' in raw.get('ID_PATH', '')):
+            bus = 'virtio'
+        if bus is None and info.name.startswith('/dev/nvme'):
+            bus = 'nvme'
+        rotational = None
+        rpm = raw.get('ID_ATA_ROTATION_RATE_RPM')
+        if rpm is not None:
+            rotational = rpm != '0'
+        elif attrs.get('queue/rotational') is not None:
+            rotational = attrs['queue/rotational'] == '1'
+        return cls(
+            name=info.name,
+            size=info.size,
+            serial=info.serial,
+            model=info.model,
+            vendor=info.vendor,
+            bus=bus,
+            major=raw.get('MAJOR'),
+            devpath=raw.get('DEVPATH', info.name),
+            rotational=rotational,
+            removable=attrs.get('removable') == '1',
+            dm_name=raw.get('DM_NAME') if _is_multipath_map(raw) else None,
+            ptable={'dos': 'msdos'}.get(
+                raw.get('ID_PART_TABLE_TYPE'), raw.get('ID_PART_TABLE_TYPE')),
+            partitions=tuple(sorted(partitions, key=lambda p: p.number)),
+            physical_block_size=_int_attr(
+                attrs, 'queue/physical_block_size'),
+            minimum_io_size=_int_attr(attrs, 'queue/minimum_io_size'),
+            optimal_io_size=_int_attr(attrs, 'queue/optimal_io_size'),
+            alignment_offset=_int_attr(attrs, 'alignment_offset'),
+            )
+
+    def score(self):
+        """A rough measure of how good a disk is to install to.
+
+        Solid state beats spinning disks, faster buses beat slower ones
+        and larger disks beat smaller ones. Removable disks come last.
+        """
+        score = BUS_SCORES.get(self.bus, 100)
+        if self.rotational is False:
+            score += 300
+        elif self.rotational is None:
+            score += 100
+        if self.size > 0:
+            score += min(100, int(10 * math.log(max(self.size >> 30, 1), 2)))
+        if self.removable or self.bus == 'usb':
+            score -= 1000
+        return score
+
+    def partition_alignment(self):
+        """The granularity partition starts and sizes should follow.
+
+        This is 1MiB, stretched to a multiple of any I/O sizes the
+        device reports. Implausibly large results (some USB bridges
+        report nonsense optimal_io_size values) are ignored.
+        """
+        grain = PARTITION_ALIGN
+        for size in (self.physical_block_size, self.minimum_io_size,
+                     self.optimal_io_size):
+            if not size or size < 0:
+                continue
+            g = grain * size // math.gcd(grain, size)
+            if g > MAX_PARTITION_ALIGN:
+                log.debug(
+                    "%s: ignoring I/O size %s for alignment", self.name, size)
+                continue
+            grain = g
+        return grain
+
+
 # This code is not going to make much sense unless you have read
 # http://curtin.readthedocs.io/en/latest/topics/storage.html. The
 # Disk, Partition etc classes correspond to entries in curtin's
@@ -111,7 +355,7 @@ def asdict(inst):
 
 
 @attr.s
-class Disk:
+class Disk(CachedRender):
 
     id = attr.ib(default=id_factory("disk"))
     type = attr.ib(default="disk")
@@ -124,30 +368,99 @@ class Disk:
     name = attr.ib(default="")
     grub_device = attr.ib(default=False)
 
-    _partitions = attr.ib(default=attr.Factory(list), repr=False) # [Partition]
+    # {id: Partition}
+    _partitions = attr.ib(
+        default=attr.Factory(collections.OrderedDict), repr=False)
     _fs = attr.ib(default=None, repr=False) # Filesystem
+    # Raid, LVMVolGroup or Bcache
+    _constructed_device = attr.ib(default=None, repr=False)
     def partitions(self):
-        return self._partitions
+        return list(self._partitions.values())
     def fs(self):
         return self._fs
 
-    _info = attr.ib(default=None)
+    def constructed_device(self):
+        return self._constructed_device
+
+    # Running totals maintained by FilesystemModel as partitions are
+    # added, changed and removed, so that the properties below do not
+    # need to look at every partition.
+    _partitions_size = attr.ib(default=0, repr=False)
+    _partnums = attr.ib(default=attr.Factory(collections.Counter), repr=False)
+    _lowest_free_partnum = attr.ib(default=1, repr=False)
+    _extents = attr.ib(default=None, repr=False)  # FreeExtents, made on demand
+    _journal_caches = ('_rendered', '_extents')
+    # What was probed from the disk. Undo is for the user's changes,
+    # not to put back what the hardware looked like before an event.
+    _journal_skip = ('_info', 'serial', 'path', 'model')
+
+    _info = attr.ib(default=None)  # DiskInfo
 
     @classmethod
-    def from_info(self, info):
-        d = Disk(info=info)
+    def from_info(self, info, partitions=()):
+        d = Disk(info=DiskInfo.from_storage_info(info, partitions))
         d.serial = info.serial
         d.path = info.name
         d.model = info.model
         return d
 
     def reset(self):
+        self.ptable = 'gpt'
         self.wipe = None
         self.preserve = False
         self.name = ''
         self.grub_device = ''
-        self._partitions = []
+        self._partitions = collections.OrderedDict()
         self._fs = None
+        self._constructed_device = None
+        self._partitions_size = 0
+        self._partnums = collections.Counter()
+        self._lowest_free_partnum = 1
+        self._extents = None
+
+    @property
+    def alignment(self):
+        return self._info.partition_alignment()
+
+    def _free_extents(self):
+        # Partitions start at least 1MiB into the disk, at an offset that
+        # is aligned for the device, and stay clear of the last 1MiB.
+        if self._extents is None:
+            grain = self.alignment
+            skew = (self._info.alignment_offset or 0) % grain
+            start = align_up(PARTITION_ALIGN - skew, grain) + skew
+            end = start + align_down(
+                max(self._info.size - PARTITION_ALIGN - start, 0), grain)
+            self._extents = FreeExtents(start, end, grain, skew)
+            for p in self._partitions.values():
+                if p.offset is not None:
+                    self._extents.reserve(p.offset, p.size)
+        return self._extents
+
+    def _take_partnum(self, partnum):
+        record(self, '_partnums')
+        self._partnums[partnum] += 1
+        while self._lowest_free_partnum in self._partnums:
+            self._lowest_free_partnum += 1
+
+    def _release_partnum(self, partnum):
+        record(self, '_partnums')
+        self._partnums[partnum] -= 1
+        if self._partnums[partnum] <= 0:
+            del self._partnums[partnum]
+            self._lowest_free_partnum = min(self._lowest_free_partnum, partnum)
+
+    def _add_partition(self, part):
+        record(self, '_partitions')
+        self._partitions[part.id] = part
+        self._partitions_size += part.size
+        self._take_partnum(part.number)
+
+    def _remove_partition(self, part):
+        record(self, '_partitions')
+        del self._partitions[part.id]
+        self._partitions_size -= part.size
+        self._release_partnum(part.number)
 
     @property
     def available(self):
@@ -155,13 +468,7 @@ class Disk:
 
     @property
     def next_partnum(self):
-        partnums = set()
-        for p in self._partitions:
-            partnums.add(p.number)
-        i = 1
-        while i in partnums:
-            i += 1
-        return i
+        return self._lowest_free_partnum
 
     @property
     def size(self):
@@ -172,34 +479,55 @@ class Disk:
 
     @property
     def used(self):
-        if self._fs is not None:
+        if self._fs is not None or self._constructed_device is not None:
             return self.size
-        r = 0
-        for p in self._partitions:
-            r += p.size
-        return r
+        return self._partitions_size
 
     @property
     def free(self):
-        return self.size - self.used
+        if self._fs is not None or self._constructed_device is not None:
+            return 0
+        return self._free_extents().total
+
+    @property
+    def largest_free_extent(self):
+        if self._fs is not None or self._constructed_device is not None:
+            return 0
+        return self._free_extents().largest()
+
+    def max_partition_size(self, partition=None):
+        """The largest size partition could be given, or a new partition."""
+        r = self.largest_free_extent
+        if partition is None:
+            return r
+        if partition.offset is None:
+            return r + partition.size
+        return max(r, self._free_extents().free_around(
+            partition.offset, partition.size))
 
 
 @attr.s
-class Partition:
+class Partition(CachedRender):
 
     id = attr.ib(default=id_factory("part"))
     type = attr.ib(default="partition")
     number = attr.ib(default=0)
     device = attr.ib(default=None) # Disk
     size = attr.ib(default=None)
+    offset = attr.ib(default=None)
     wipe = attr.ib(default=None)
     flag = attr.ib(default=None)
     preserve = attr.ib(default=False)
 
     _fs = attr.ib(default=None, repr=False) # Filesystem
+    # Raid, LVMVolGroup or Bcache
+    _constructed_device = attr.ib(default=None, repr=False)
     def fs(self):
         return self._fs
 
+    def constructed_device(self):
+        return self._constructed_device
+
     def desc(self):
         return "partition of {}".format(self.device.desc())
 
@@ -207,6 +535,8 @@ class Partition:
     def available(self):
         if self.flag == 'bios_grub':
             return False
+        if self._constructed_device is not None:
+            return False
         if self._fs is None:
             return True
         if self._fs._mount is None:
@@ -216,18 +546,277 @@ class Partition:
 
     @property
     def path(self):
+        info = getattr(self.device, '_info', None)
+        if info is not None and info.dm_name is not None:
+            # kpartx names partitions of a device-mapper map after it.
+            return "/dev/mapper/%s-part%s" % (info.dm_name, self.number)
+        if self.device.path[-1].isdigit():
+            # As the kernel does for nvme0n1p1, md0p1 and so on.
+            return "%sp%s" % (self.device.path, self.number)
         return "%s%s"%(self.device.path, self.number)
 
 
+# Levels and the minimum number of active devices each needs.
+RAID_LEVELS = collections.OrderedDict([
+    (0, 2),
+    (1, 2),
+    (5, 3),
+    (6, 4),
+    (10, 2),
+    ])
+
+
+def _md_data_offset(size):
+    # mdadm's default space reserved at the start of each member for a
+    # v1.2 superblock: 128MiB, halved until it is at most 1/1024th of
+    # the device.
+    offset = 128 << 20
+    while offset << 10 > size and offset > PARTITION_ALIGN:
+        offset >>= 1
+    return offset
+
+
+def raid_size(level, sizes, chunk_size=RAID_DEFAULT_CHUNK):
+    """The usable size of an md array of devices with the given sizes.
+
+    Spare devices do not add capacity and should not be included.
+    """
+    if level not in RAID_LEVELS:
+        raise ValueError("unsupported RAID level {!r}".format(level))
+    if len(sizes) < RAID_LEVELS[level]:
+        raise ValueError("RAID{} needs at least {} devices".format(
+            level, RAID_LEVELS[level]))
+    member = min(sizes)
+    member -= _md_data_offset(member)
+    if level != 1:
+        member = align_down(member, chunk_size)
+    member = max(member, 0)
+    n = len(sizes)
+    if level == 0:
+        return member * n
+    elif level == 1:
+        return member
+    elif level == 5:
+        return member * (n - 1)
+    elif level == 6:
+        return member * (n - 2)
+    else:  # 10, with mdadm's default near=2 layout
+        return align_down(member * n // 2, chunk_size)
+
+
 @attr.s
-class Filesystem:
+class Raid(CachedRender):
+    id = attr.ib(default=id_factory("raid"))
+    type = attr.ib(default="raid")
+    name = attr.ib(default=None)
+    raidlevel = attr.ib(default=None)
+    devices = attr.ib(default=attr.Factory(list))  # [Partition or Disk]
+    spare_devices = attr.ib(default=attr.Factory(list))  # [Partition or Disk]
+    preserve = attr.ib(default=False)
+
+    _fs = attr.ib(default=None, repr=False)  # Filesystem
+    # LVMVolGroup or Bcache
+    _constructed_device = attr.ib(default=None, repr=False)
+
+    def fs(self):
+        return self._fs
+
+    def constructed_device(self):
+        return self._constructed_device
+
+    def desc(self):
+        return "software RAID {}".format(self.raidlevel)
+
+    @property
+    def size(self):
+        return raid_size(self.raidlevel, [d.size for d in self.devices])
+
+    @property
+    def available(self):
+        if self._constructed_device is not None:
+            return False
+        if self._fs is None:
+            return True
+        if self._fs._mount is None:
+            fs_obj = FilesystemModel.fs_by_name[self._fs.fstype]
+            return fs_obj.is_mounted
+        return False
+
+    @property
+    def path(self):
+        return "/dev/%s" % (self.name,)
+
+
+BCACHE_CACHE_MODES = ['writethrough', 'writeback', 'writearound']
+BCACHE_DATA_OFFSET = 8 << 10  # make-bcache's default
+
+
+@attr.s
+class Bcache(CachedRender):
+    id = attr.ib(default=id_factory("bcache"))
+    type = attr.ib(default="bcache")
+    name = attr.ib(default=None)
+    backing_device = attr.ib(default=None)  # Partition, Disk or Raid
+    cache_device = attr.ib(default=None)  # Partition, Disk or Raid
+    cache_mode = attr.ib(default=None)
+
+    _fs = attr.ib(default=None, repr=False)  # Filesystem
+    _constructed_device = attr.ib(default=None, repr=False)  # LVMVolGroup
+
+    def fs(self):
+        return self._fs
+
+    def constructed_device(self):
+        return self._constructed_device
+
+    def desc(self):
+        return "bcache ({})".format(self.cache_mode or BCACHE_CACHE_MODES[0])
+
+    @property
+    def size(self):
+        return max(self.backing_device.size - BCACHE_DATA_OFFSET, 0)
+
+    @property
+    def available(self):
+        if self._constructed_device is not None:
+            return False
+        if self._fs is None:
+            return True
+        if self._fs._mount is None:
+            fs_obj = FilesystemModel.fs_by_name[self._fs.fstype]
+            return fs_obj.is_mounted
+        return False
+
+    @property
+    def path(self):
+        return "/dev/%s" % (self.name,)
+
+
+LVM_EXTENT_SIZE = 4 << 20  # vgcreate's default physical extent size
+LVM_PV_METADATA = 1 << 20  # pvcreate's default start of data
+
+
+@attr.s
+class LVMVolGroup(CachedRender):
+    id = attr.ib(default=id_factory("vg"))
+    type = attr.ib(default="lvm_volgroup")
+    name = attr.ib(default=None)
+    # [Partition, Disk, Raid or Bcache]
+    devices = attr.ib(default=attr.Factory(list))
+    preserve = attr.ib(default=False)
+
+    _extent_size = attr.ib(default=LVM_EXTENT_SIZE, repr=False)
+    # {pv id: extents}
+    _pv_used = attr.ib(default=attr.Factory(dict), repr=False)
+    # {id: LVMLogicalVolume}
+    _volumes = attr.ib(
+        default=attr.Factory(collections.OrderedDict), repr=False)
+
+    def volumes(self):
+        return list(self._volumes.values())
+
+    def desc(self):
+        return "LVM volume group"
+
+    @property
+    def path(self):
+        return "/dev/%s" % (self.name,)
+
+    def pv_extents(self, pv):
+        return max(pv.size - LVM_PV_METADATA, 0) // self._extent_size
+
+    def pv_free_extents(self, pv):
+        return self.pv_extents(pv) - self._pv_used.get(pv.id, 0)
+
+    @property
+    def extents(self):
+        return sum(self.pv_extents(pv) for pv in self.devices)
+
+    @property
+    def free_extents(self):
+        return self.extents - sum(self._pv_used.values())
+
+    @property
+    def size(self):
+        return self.extents * self._extent_size
+
+    @property
+    def free(self):
+        return self.free_extents * self._extent_size
+
+    @property
+    def available(self):
+        return self.free_extents > 0
+
+    def _allocate(self, extents):
+        # Work out which PVs a new volume of this many extents would use,
+        # filling PVs in order as lvcreate does for linear volumes.
+        allocation = {}
+        remaining = extents
+        for pv in self.devices:
+            take = min(self.pv_free_extents(pv), remaining)
+            if take > 0:
+                allocation[pv.id] = take
+                remaining -= take
+        if remaining > 0:
+            return None
+        return allocation
+
+    def _take(self, allocation):
+        record(self, '_pv_used')
+        for pv_id, extents in allocation.items():
+            self._pv_used[pv_id] = self._pv_used.get(pv_id, 0) + extents
+
+    def _release(self, allocation):
+        record(self, '_pv_used')
+        for pv_id, extents in allocation.items():
+            self._pv_used[pv_id] -= extents
+
+
+@attr.s
+class LVMLogicalVolume(CachedRender):
+    id = attr.ib(default=id_factory("lv"))
+    type = attr.ib(default="lvm_partition")
+    name = attr.ib(default=None)
+    volgroup = attr.ib(default=None)  # LVMVolGroup
+    size = attr.ib(default=None)
+    preserve = attr.ib(default=False)
+
+    # {pv id: extents}
+    _allocation = attr.ib(default=attr.Factory(dict), repr=False)
+    _fs = attr.ib(default=None, repr=False)  # Filesystem
+
+    def fs(self):
+        return self._fs
+
+    def desc(self):
+        return "LVM logical volume"
+
+    @property
+    def available(self):
+        if self._fs is None:
+            return True
+        if self._fs._mount is None:
+            fs_obj = FilesystemModel.fs_by_name[self._fs.fstype]
+            return fs_obj.is_mounted
+        return False
+
+    @property
+    def path(self):
+        return "/dev/%s/%s" % (self.volgroup.name, self.name)
+
+
+@attr.s
+class Filesystem(CachedRender):
 
     id = attr.ib(default=id_factory("fs"))
     type = attr.ib(default="format")
     fstype = attr.ib(default=None)
-    volume = attr.ib(default=None) # Partition or Disk
+    # Partition, Disk, Raid, Bcache or LVMLogicalVolume
+    volume = attr.ib(default=None)
     label = attr.ib(default=None)
     uuid = attr.ib(default=None)
+    extra_options = attr.ib(default=None)  # [str], passed to mkfs
     preserve = attr.ib(default=False)
 
     _mount = attr.ib(default=None, repr=False) # Mount
@@ -236,15 +825,79 @@ class Filesystem:
 
 
 @attr.s
-class Mount:
+class Mount(CachedRender):
     id = attr.ib(default=id_factory("mount"))
     type = attr.ib(default="mount")
     device = attr.ib(default=None) # Filesystem
     path = attr.ib(default=None)
+    options = attr.ib(default=None)
+
+    # None if chosen automatically
+    _profile = attr.ib(default=None, repr=False)
+
+    def profile(self):
+        return self._profile
+
+
+def _is_multipath_map(data):
+    return data.get('DM_UUID', '').startswith('mpath-')
+
+
+def align_up(size, block_size=PARTITION_ALIGN):
+    return (size + block_size - 1) // block_size * block_size
+
 
+def align_down(size, block_size=PARTITION_ALIGN):
+    return size // block_size * block_size
 
-def align_up(size, block_size=1 << 20):
-    return (size + block_size - 1) & ~(block_size - 1)
+
+class LayoutError(Exception):
+    """A layout template cannot be applied to the disks present."""
+
+
+def layout_size(spec, total):
+    """Bytes for a size in a layout template, or None for 'the rest'.
+
+    Sizes are a number of bytes, a human size such as '20G' or a
+    percentage of total.
+    """
+    if spec is None or spec == 'rest':
+        return None
+    if isinstance(spec, int):
+        return spec
+    spec = str(spec).strip()
+    try:
+        if spec.endswith('%'):
+            return int(total * float(spec[:-1]) / 100)
+        return dehumanize_size(spec)
+    except ValueError as e:
+        raise LayoutError("bad size {!r}: {}".format(spec, e))
+
+
+def disk_matches(info, match):
+    """Whether the disk described by info passes a template's match rules."""
+    for key, want in match.items():
+        if key == 'min-size':
+            if info.size < layout_size(want, info.size):
+                return False
+        elif key == 'max-size':
+            if info.size > layout_size(want, info.size):
+                return False
+        elif key == 'rotational':
+            if info.rotational is None or info.rotational != bool(want):
+                return False
+        elif key == 'bus':
+            if isinstance(want, str):
+                want = [want]
+            if info.bus not in want:
+                return False
+        elif key in ('model', 'vendor', 'serial', 'path'):
+            value = info.name if key == 'path' else getattr(info, key)
+            if value is None or not fnmatch.fnmatchcase(value, str(want)):
+                return False
+        else:
+            raise LayoutError("unknown match rule {!r}".format(key))
+    return True
 
 
 class FilesystemModel(object):
@@ -272,88 +925,830 @@ class FilesystemModel(object):
             fs_by_name[fs.label] = fs
     fs_by_name['fat32'] = FS('fat322', True)
 
+    # What the journal saves of the model itself; the objects in the
+    # containers are saved separately as they are changed.
+    _journal_fields = (
+        '_disks', '_filesystems', '_partitions', '_raids', '_bcaches',
+        '_volgroups', '_logical_volumes', '_mounts', '_objects',
+        '_swapfile_size',
+        )
+
     def __init__(self, prober):
         self.prober = prober
+        self.block_index = None
+        self.journal = Journal()
+        # mkfs options to use instead of the tuned defaults, keyed by
+        # mount point.
+        self.mkfs_overrides = {}
+        # How guided layouts get swap: the sizing policy, the size for
+        # the 'fixed' policy and whether to use a partition or a file.
+        self.swap_policy = 'ratio'
+        self.swap_fixed_size = None
+        self.swap_kind = 'partition'
+        self.memtotal = None
         self._available_disks = {} # keyed by path, eg /dev/sda
         self.reset()
+        # There is nothing to undo yet.
+        self.journal.clear()
 
+    @journaled
     def reset(self):
-        self._disks = collections.OrderedDict() # only gets populated when something uses the disk
-        self._filesystems = []
-        self._partitions = []
-        self._mounts = []
+        record(self)
+        # Only gets populated when something uses the disk.
+        self._disks = JournaledDict()
+        # The configured objects of each type, keyed by id, in the order
+        # they were created. _objects indexes all of them by id.
+        self._filesystems = JournaledDict()
+        self._partitions = JournaledDict()
+        self._raids = JournaledDict()
+        self._bcaches = JournaledDict()
+        self._volgroups = JournaledDict()
+        self._logical_volumes = JournaledDict()
+        self._mounts = JournaledDict()
+        self._mounts_by_depth = None
+        self._objects = JournaledDict()
+        self._swapfile_size = 0
         for k, d in self._available_disks.items():
             self._available_disks[k].reset()
 
     def render(self):
+        # Each object caches its own piece of the config, so this only
+        # does real work for objects that changed since the last call.
+        # The returned dicts are shared with those caches and must not
+        # be modified.
+        # A mount with no cached render has been changed since the last
+        # call, possibly by assigning to its path, so sort them again.
+        if self._mounts_by_depth is None or any(
+                m._rendered is None for m in self._mounts_by_depth):
+            self._mounts_by_depth = sorted(
+                self._mounts.values(), key=lambda m: len(m.path))
         r = []
         for d in self._disks.values():
-            r.append(asdict(d))
-        for p in self._partitions:
-            r.append(asdict(p))
-        for f in self._filesystems:
-            r.append(asdict(f))
-        for m in sorted(self._mounts, key=lambda m:len(m.path)):
-            r.append(asdict(m))
+            r.append(d.render())
+        for p in self._partitions.values():
+            r.append(p.render())
+        for raid in self._raids.values():
+            r.append(raid.render())
+        for bcache in self._bcaches.values():
+            r.append(bcache.render())
+        for vg in self._volgroups.values():
+            r.append(vg.render())
+        for lv in self._logical_volumes.values():
+            r.append(lv.render())
+        for f in self._filesystems.values():
+            r.append(f.render())
+        for m in self._mounts_by_depth:
+            r.append(m.render())
         return r
 
-    def _get_system_mounted_disks(self):
-        # This assumes a fairly vanilla setup. It won't list as
-        # mounted a disk that is only mounted via lvm, for example.
-        mounted_devs = []
-        with open('/proc/mounts', encoding=sys.getfilesystemencoding()) as pm:
-            for line in pm:
-                if line.startswith('/dev/'):
-                    mounted_devs.append(line.split()[0][5:])
-        mounted_disks = set()
-        for dev in mounted_devs:
-            if os.path.exists('/sys/block/{}'.format(dev)):
-                mounted_disks.add('/dev/' + dev)
-            else:
-                paths = glob.glob('/sys/block/*/{}/partition'.format(dev))
-                if len(paths) == 1:
-                    mounted_disks.add('/dev/' + paths[0].split('/')[3])
-        return mounted_disks
+    def _is_available_disk(self, path, data, currently_mounted):
+        if path in currently_mounted:
+            return False
+        if data['DEVTYPE'] != 'disk':
+            return False
+        if data["DEVPATH"].startswith('/devices/virtual') and \
+                not _is_multipath_map(data):
+            return False
+        return data["MAJOR"] != "2" and data['attrs'].get('ro') != "1"
+
+    def _multipath_key(self, path, data, storage):
+        # The WWID identifying the LUN that path leads to, if multipath
+        # has claimed it. Identical serials alone prove nothing: cheap
+        # USB enclosures often all report the same one.
+        if _is_multipath_map(data):
+            return data['DM_UUID'][len('mpath-'):]
+        blockdev = self.block_index.get(path)
+        if blockdev is not None:
+            for holder in blockdev.holders:
+                holder_data = storage.get('/dev/' + holder)
+                if holder_data is not None and _is_multipath_map(holder_data):
+                    return holder_data['DM_UUID'][len('mpath-'):]
+        if data.get('DM_MULTIPATH_DEVICE_PATH') == '1':
+            return data.get('ID_SERIAL') or data.get('ID_WWN')
+        return None
+
+    def _group_paths(self, paths, storage):
+        """Group paths that lead to the same disk.
+
+        Returns a list of (wwid, paths) with the path to use for the
+        disk first: the device-mapper multipath device if there is one,
+        otherwise the first path by name.
+        """
+        groups = collections.OrderedDict()
+        for path in sorted(paths):
+            key = self._multipath_key(path, storage[path], storage)
+            groups.setdefault(key or path, (key, []))[1].append(path)
+        r = []
+        for key, group in groups.values():
+            group.sort(key=lambda p: not _is_multipath_map(storage[p]))
+            r.append((key, group))
+        return r
+
+    def _existing_partitions(self, storage):
+        # Group the partitions in the probe data by the disk they are on.
+        r = collections.defaultdict(list)
+        for path, data in storage.items():
+            if data.get('DEVTYPE') != 'partition':
+                continue
+            if 'ID_PART_ENTRY_NUMBER' not in data:
+                continue
+            try:
+                r[_partition_disk(data)].append(
+                    ExistingPartition.from_probe_data(data))
+            except (KeyError, ValueError):
+                log.exception("could not read partition %s", path)
+        return r
+
+    def _scan_block_devices(self):
+        if self.prober.storage_is_live:
+            return BlockIndex()
+        return BlockIndex(None, None, None)
 
     def probe(self):
         storage = self.prober.get_storage()
-        currently_mounted = self._get_system_mounted_disks()
+        self.block_index = self._scan_block_devices()
+        self.memtotal = read_memtotal()
+        currently_mounted = self.block_index.in_use_disks()
+        existing_partitions = self._existing_partitions(storage)
+        candidates = []
         for path, data in storage.items():
             log.debug("fs probe %s", path)
-            if path in currently_mounted:
-                continue
-            if data['DEVTYPE'] == 'disk' \
-              and not data["DEVPATH"].startswith('/devices/virtual') \
-              and data["MAJOR"] != "2" \
-              and data['attrs'].get('ro') != "1":
+            if self._is_available_disk(path, data, currently_mounted):
                 #log.debug('disk={}\n{}'.format(
                 #    path, json.dumps(data, indent=4, sort_keys=True)))
-                info = self.prober.get_storage_info(path)
-                self._available_disks[path] = Disk.from_info(info)
+                candidates.append(path)
+        for wwid, paths in self._group_paths(candidates, storage):
+            path = paths[0]
+            if len(paths) > 1:
+                log.debug("%s is also reachable as %s", path, paths[1:])
+            info = self.prober.get_storage_info(path)
+            disk = Disk.from_info(info, existing_partitions.get(path, ()))
+            disk._info.wwid = wwid
+            disk._info.paths = tuple(paths[1:])
+            self._available_disks[path] = disk
+        # Everything needed has been copied out of the probe data now.
+        self.prober.release_storage()
+
+    # The methods below are called as udev reports block devices
+    # appearing, changing and disappearing after the initial probe.
+
+    def new_device(self, path, data):
+        if data.get('DEVTYPE') == 'partition':
+            self._partitions_changed(data)
+            return
+        if path in self._available_disks:
+            self.update_device(path, data)
+            return
+        self.block_index = self._scan_block_devices()
+        in_use = self.block_index.in_use_disks()
+        if not self._is_available_disk(path, data, in_use):
+            return
+        # The multipath map holding path is another device, so the key
+        # has to be looked up in everything probed, not just path.
+        storage = self.prober.get_storage()
+        try:
+            wwid = self._multipath_key(path, data, storage)
+            for disk in self._available_disks.values():
+                if wwid is not None and disk._info.wwid == wwid:
+                    log.debug("new path %s to %s", path, disk.path)
+                    disk._info.paths += (path,)
+                    return
+            log.debug("new disk %s", path)
+            info = self.prober.get_storage_info(path, data)
+            disk = Disk.from_info(
+                info, self._existing_partitions(storage).get(path, ()))
+            disk._info.wwid = wwid
+            self._available_disks[path] = disk
+        finally:
+            self.prober.release_storage()
+
+    def update_device(self, path, data):
+        if data.get('DEVTYPE') == 'partition':
+            self._partitions_changed(data)
+            return
+        disk = self._available_disks.get(path)
+        if disk is None:
+            self.new_device(path, data)
+            return
+        log.debug("updating disk %s", path)
+        storage = self.prober.get_storage()
+        old = disk._info
+        disk._info = DiskInfo.from_storage_info(
+            self.prober.get_storage_info(path, data),
+            self._existing_partitions(storage).get(path, ()))
+        disk._info.wwid = old.wwid
+        disk._info.paths = old.paths
+        self.prober.release_storage()
+        # The free space follows the new size and partitions.
+        disk._extents = None
+        if disk.path not in self._disks:
+            return
+        if disk.preserve:
+            stale = disk._info.partitions != old.partitions
+        else:
+            end = disk._free_extents().end
+            stale = any(
+                p.offset + p.size > end for p in disk.partitions())
+        if stale:
+            # The configuration of the disk no longer matches it, so
+            # start it again from what is on it now.
+            log.debug("configuration of %s is out of date", path)
+            preserve = disk.preserve and disk._info.ptable is not None
+            self._unuse_disk(disk)
+            disk.reset()
+            if preserve:
+                self.preserve_existing(disk)
+            # Undoing past this point could bring back the old layout.
+            self.journal.clear()
+
+    def _partitions_changed(self, data):
+        # Partitions are reported separately from the disk they are on,
+        # so look at the disk again when one is added or changed.
+        # Removing partitions also makes udev report a change to the
+        # disk itself.
+        path = _partition_disk(data)
+        disk = self._available_disks.get(path)
+        if disk is not None:
+            disk_data = self.prober.get_storage().get(path)
+            if disk_data is not None:
+                self.update_device(path, disk_data)
+
+    def del_device(self, path):
+        disk = self._available_disks.pop(path, None)
+        if disk is None:
+            for disk in self._available_disks.values():
+                if path in disk._info.paths:
+                    log.debug("path %s to %s removed", path, disk.path)
+                    disk._info.paths = tuple(
+                        p for p in disk._info.paths if p != path)
+            return
+        log.debug("disk %s removed", path)
+        self._unuse_disk(disk)
+        # Undoing past this point could bring the disk back.
+        self.journal.clear()
+
+    def undo(self):
+        """Undo the last change to the configuration, if there is one."""
+        if not self.journal.undo():
+            return False
+        self._mounts_by_depth = None
+        return True
+
+    def redo(self):
+        if not self.journal.redo():
+            return False
+        self._mounts_by_depth = None
+        return True
 
     def _use_disk(self, disk):
         if disk.path not in self._disks:
             self._disks[disk.path] = disk
+            self._objects[disk.id] = disk
+
+    def _unuse_disk(self, disk):
+        for p in disk.partitions():
+            self._remove_partition(p)
+        if disk._constructed_device is not None:
+            self._remove_constructed_device(disk._constructed_device, disk)
+        if disk._fs is not None:
+            self.remove_filesystem(disk._fs)
+        self._disks.pop(disk.path, None)
+        self._objects.pop(disk.id, None)
+
+    def get_object(self, id):
+        return self._objects.get(id)
+
+    def all_partitions(self):
+        return list(self._partitions.values())
+
+    def all_filesystems(self):
+        return list(self._filesystems.values())
+
+    def all_mounts(self):
+        return list(self._mounts.values())
 
     def all_disks(self):
         return sorted(self._available_disks.values(), key=lambda x:x.serial)
 
+    def all_devices(self):
+        """The disks, then the RAIDs, bcaches and volume groups.
+
+        These are everything that can be formatted or hold partitions
+        or logical volumes.
+        """
+        return (
+            self.all_disks() + self.all_raids() + self.all_bcaches() +
+            self.all_volgroups())
+
+    def ranked_disks(self):
+        """The available disks, best first."""
+        return sorted(
+            self._available_disks.values(),
+            key=lambda d: (-d._info.score(), d.serial or ''))
+
+    guided_policies = ['fastest', 'largest', 'largest-ssd']
+
+    def guided_disk(self, policy):
+        """Pick the disk a guided install should use, or None."""
+        if policy not in self.guided_policies:
+            raise ValueError("unknown guided policy {!r}".format(policy))
+        disks = self.ranked_disks()
+        fixed = [
+            d for d in disks
+            if not (d._info.removable or d._info.bus == 'usb')]
+        if fixed:
+            disks = fixed
+        if policy == 'largest-ssd':
+            ssds = [d for d in disks if d._info.rotational is False]
+            if ssds:
+                disks = ssds
+            policy = 'largest'
+        if policy == 'largest':
+            disks = sorted(disks, key=lambda d: -d.size)
+        if disks:
+            return disks[0]
+        return None
+
     def get_disk(self, path):
         return self._available_disks.get(path)
 
-    def add_partition(self, disk, partnum, size, flag=""):
+    @journaled
+    def apply_layout(self, template, uefi=False):
+        """Configure the disks as a layout template describes.
+
+        Each entry under 'disks' takes the best of the unused disks its
+        match rules accept, then 'raids' and 'volgroups' are built from
+        the disks, partitions and raids named so far. Raises LayoutError,
+        leaving the model as it was, if the template cannot be met.
+        """
+        self.reset()
+        names = {}
+        unused = self.ranked_disks()
+        for spec in template.get('disks', []):
+            match = spec.get('match', {})
+            disks = [d for d in unused if disk_matches(d._info, match)]
+            count = spec.get('count', 1)
+            if count != 'all':
+                if len(disks) < count:
+                    raise LayoutError(
+                        "{} disks wanted for {} but {} match".format(
+                            count, spec.get('name', 'a disk entry'),
+                            len(disks)))
+                disks = disks[:count]
+            elif not disks:
+                raise LayoutError("no disks match for {}".format(
+                    spec.get('name', 'a disk entry')))
+            for i, disk in enumerate(disks):
+                unused.remove(disk)
+                boot = spec.get('boot') and i == 0
+                self._layout_disk(disk, spec, names, boot, uefi)
+        for spec in template.get('raids', []):
+            raid = self.add_raid(
+                spec['level'], self._layout_devices(spec['devices'], names),
+                self._layout_devices(spec.get('spare-devices', []), names),
+                name=spec.get('name'))
+            self._layout_name(names, spec, raid)
+            self._layout_format(raid, spec)
+        for spec in template.get('volgroups', []):
+            vg = self.add_volgroup(
+                spec['name'], self._layout_devices(spec['devices'], names))
+            volumes = spec.get('volumes', [])
+            sizes = [layout_size(v.get('size'), vg.size) for v in volumes]
+            if sizes.count(None) > 1:
+                raise LayoutError(
+                    "more than one volume in {} takes the rest".format(
+                        vg.name))
+            for i, (volume, size) in enumerate(zip(volumes, sizes)):
+                if size is None:
+                    size = vg.free - sum(
+                        align_up(s, vg._extent_size) for s in sizes[i + 1:])
+                lv = self.add_logical_volume(vg, volume['name'], size)
+                self._layout_format(lv, volume)
+        if '/' not in self.get_mountpoint_to_devpath_mapping():
+            raise LayoutError("the layout does not mount anything at /")
+
+    def _layout_name(self, names, spec, volume):
+        if 'name' in spec:
+            names.setdefault(spec['name'], []).append(volume)
+
+    def _layout_devices(self, refs, names):
+        devices = []
+        for ref in refs:
+            if ref not in names:
+                raise LayoutError("{!r} does not name anything".format(ref))
+            devices.extend(names[ref])
+        return devices
+
+    def _layout_format(self, volume, spec):
+        fstype = spec.get('fstype')
+        if fstype is None:
+            return
+        if fstype not in self.fs_by_name:
+            raise LayoutError("unknown filesystem {!r}".format(fstype))
+        fs = self.add_filesystem(volume, fstype)
+        if spec.get('mount'):
+            self.add_mount(fs, spec['mount'], spec.get('mount-profile'))
+
+    def _layout_disk(self, disk, spec, names, boot, uefi):
+        self._layout_name(names, spec, disk)
+        parts = spec.get('partitions')
+        if not parts:
+            if boot:
+                raise LayoutError("a boot disk needs partitions")
+            self._layout_format(disk, spec)
+            return
+        disk.ptable = spec.get('ptable', 'gpt')
+        if boot:
+            self.add_boot_partition(disk, uefi)
+        sizes = [layout_size(p.get('size'), disk.free) for p in parts]
+        if sizes.count(None) > 1:
+            raise LayoutError(
+                "more than one partition on {} takes the rest".format(
+                    disk.path))
+        rest = disk.free - sum(
+            align_up(s, disk.alignment) for s in sizes if s is not None)
+        if rest < 0 or (None in sizes and rest <= 0):
+            raise LayoutError(
+                "the partitions wanted do not fit on {}".format(disk.path))
+        for p, size in zip(parts, sizes):
+            if size is None:
+                size = rest
+            part = self.add_partition(
+                disk, disk.next_partnum, size, flag=p.get('flag', ''))
+            self._layout_name(names, p, part)
+            self._layout_format(part, p)
+
+    def add_boot_partition(self, disk, uefi):
+        """Add what disk needs to boot from, and make it the grub device."""
+        with self.journal.step():
+            if uefi:
+                part = self.add_partition(
+                    disk, disk.next_partnum, UEFI_GRUB_SIZE_BYTES, flag='boot')
+                self.add_mount(self.add_filesystem(part, 'fat32'), '/boot/efi')
+            else:
+                part = self.add_partition(
+                    disk, disk.next_partnum, BIOS_GRUB_SIZE_BYTES,
+                    flag='bios_grub')
+            disk.grub_device = True
+        return part
+
+    @journaled
+    def preserve_existing(self, disk, uefi=False):
+        """Configure disk to keep the partitions and filesystems on it.
+
+        Any configuration of disk is thrown away. The existing
+        partitions and any filesystems subiquity knows how to handle
+        are added as preserved objects, which can then be mounted as
+        they are or reformatted but not resized or deleted. On a UEFI
+        system an existing ESP is mounted at /boot/efi, if nothing else
+        is.
+        """
+        info = disk._info
+        if info.ptable is None:
+            raise Exception("%s has no partition table" % (disk.path,))
+        self._unuse_disk(disk)
+        disk.reset()
+        disk.ptable = info.ptable
+        disk.preserve = True
+        self._use_disk(disk)
+        extents = disk._free_extents()
+        for existing in info.partitions:
+            p = Partition(
+                device=disk, number=existing.number, size=existing.size,
+                offset=existing.offset, flag=existing.flag, preserve=True)
+            extents.reserve(p.offset, p.size)
+            disk._add_partition(p)
+            if p.flag in ('boot', 'bios_grub'):
+                disk.grub_device = True
+            self._partitions[p.id] = p
+            self._objects[p.id] = p
+            if existing.fstype is not None:
+                p._fs = fs = Filesystem(
+                    volume=p, fstype=existing.fstype, uuid=existing.uuid,
+                    label=existing.label, preserve=True)
+                self._filesystems[fs.id] = fs
+                self._objects[fs.id] = fs
+                mounts = self.get_mountpoint_to_devpath_mapping()
+                is_esp = p.flag == 'boot' and fs.fstype == 'fat32'
+                if uefi and is_esp and '/boot/efi' not in mounts:
+                    self.add_mount(fs, '/boot/efi')
+
+    @journaled
+    def add_partition(self, disk, partnum, size, flag="", fit='first'):
         if size > disk.free:
             raise Exception("%s > %s", size, disk.free)
-        real_size = align_up(size)
-        log.debug("add_partition: rounded size from %s to %s", size, real_size)
-        self._use_disk(disk)
         if disk._fs is not None:
             raise Exception("%s is already formatted" % (disk.path,))
-        p = Partition(device=disk, number=partnum, size=real_size, flag=flag)
-        disk._partitions.append(p)
-        self._partitions.append(p)
+        real_size = align_up(size, disk.alignment)
+        log.debug("add_partition: rounded size from %s to %s", size, real_size)
+        offset = disk._free_extents().allocate(real_size, fit)
+        if offset is None:
+            raise Exception(
+                "no gap of %s on %s" % (real_size, disk.path))
+        self._use_disk(disk)
+        p = Partition(
+            device=disk, number=partnum, size=real_size, offset=offset,
+            flag=flag)
+        disk._add_partition(p)
+        self._partitions[p.id] = p
+        self._objects[p.id] = p
         return p
 
+    @journaled
+    def update_partition(self, part, partnum, size):
+        disk = part.device
+        if part.preserve:
+            # Existing partitions are kept exactly as they are.
+            if (partnum, size) != (part.number, part.size):
+                raise Exception(
+                    "cannot resize or renumber %s, it is preserved" % (
+                        part.path,))
+            return
+        if size - part.size > disk.free:
+            raise Exception("%s > %s", size - part.size, disk.free)
+        real_size = align_up(size, disk.alignment)
+        log.debug(
+            "update_partition: rounded size from %s to %s", size, real_size)
+        # Keep the partition where it is if it fits there, otherwise
+        # move it to the first gap that is big enough.
+        extents = disk._free_extents()
+        extents.release(part.offset, part.size)
+        offset = extents.allocate(real_size, at=part.offset)
+        if offset is None:
+            offset = extents.allocate(real_size)
+        if offset is None:
+            extents.allocate(part.size, at=part.offset)
+            raise Exception(
+                "no gap of %s on %s" % (real_size, disk.path))
+        disk._remove_partition(part)
+        part.number = partnum
+        part.size = real_size
+        part.offset = offset
+        disk._add_partition(part)
+
+    @journaled
+    def remove_partition(self, part):
+        if part.preserve:
+            # Its range and number stay in the rendered partition table
+            # (and an extended partition holds its logical ones), so
+            # they cannot be handed out again.
+            raise Exception("cannot delete %s, it is preserved" % (part.path,))
+        self._remove_partition(part)
+
+    def _remove_partition(self, part):
+        if part._constructed_device is not None:
+            self._remove_constructed_device(part._constructed_device, part)
+        if part._fs is not None:
+            self.remove_filesystem(part._fs)
+        part.device._remove_partition(part)
+        part.device._free_extents().release(part.offset, part.size)
+        del self._partitions[part.id]
+        del self._objects[part.id]
+
+    raid_levels = [str(level) for level in RAID_LEVELS]
+
+    def _is_empty(self, device):
+        return (device.available and device._fs is None
+                and device._constructed_device is None
+                and not getattr(device, '_partitions', None))
+
+    def get_empty_disk_names(self):
+        return [d.path for d in self.all_disks() if self._is_empty(d)]
+
+    def get_empty_partition_names(self):
+        return [p.path for p in self._partitions.values() if self._is_empty(p)]
+
+    def get_empty_device_names(self):
+        """Paths of everything a RAID, bcache or volume group could use."""
+        names = self.get_empty_disk_names() + self.get_empty_partition_names()
+        for obj in self.all_raids() + self.all_bcaches():
+            if self._is_empty(obj):
+                names.append(obj.path)
+        return names
+
+    def get_device(self, path):
+        """Find an available disk, or a partition, RAID or bcache, by path."""
+        disk = self._available_disks.get(path)
+        if disk is not None:
+            return disk
+        for obj in self._partitions.values():
+            if obj.path == path:
+                return obj
+        for obj in self._raids.values():
+            if obj.path == path:
+                return obj
+        for obj in self._bcaches.values():
+            if obj.path == path:
+                return obj
+        return None
+
+    def all_raids(self):
+        return list(self._raids.values())
+
+    def _next_raid_name(self):
+        names = set(raid.name for raid in self._raids.values())
+        i = 0
+        while "md%d" % i in names:
+            i += 1
+        return "md%d" % i
+
+    @journaled
+    def add_raid(self, level, devices, spare_devices=(), name=None):
+        devices = list(devices)
+        spare_devices = list(spare_devices)
+        for device in devices + spare_devices:
+            if not self._is_empty(device):
+                raise Exception("{} is not available".format(device.path))
+        # Check the level and number of devices make sense.
+        raid_size(level, [d.size for d in devices])
+        if name is None:
+            name = self._next_raid_name()
+        raid = Raid(
+            name=name, raidlevel=level, devices=devices,
+            spare_devices=spare_devices)
+        for device in devices + spare_devices:
+            if isinstance(device, Disk):
+                self._use_disk(device)
+            device._constructed_device = raid
+        self._raids[raid.id] = raid
+        self._objects[raid.id] = raid
+        return raid
+
+    def add_raid_device(self, result):
+        """Create a RAID from the result of RaidView."""
+        devices = [self.get_device(path) for path in result['devices']]
+        spares = result.get('hot_spares') or 0
+        if spares and spares >= len(devices):
+            raise ValueError("too many hot spares")
+        n = len(devices) - spares
+        active, spare = devices[:n], devices[n:]
+        return self.add_raid(int(result['raid_level']), active, spare)
+
+    @journaled
+    def remove_raid(self, raid):
+        if raid._constructed_device is not None:
+            self._remove_constructed_device(raid._constructed_device, raid)
+        if raid._fs is not None:
+            self.remove_filesystem(raid._fs)
+        for device in raid.devices + raid.spare_devices:
+            device._constructed_device = None
+        del self._raids[raid.id]
+        del self._objects[raid.id]
+
+    def _remove_constructed_device(self, device, member):
+        # Remove what is built on member, which is being removed.
+        if isinstance(device, Raid):
+            self.remove_raid(device)
+        elif isinstance(device, Bcache):
+            for bcache in list(self._bcaches.values()):
+                if member in (bcache.backing_device, bcache.cache_device):
+                    self.remove_bcache(bcache)
+        else:
+            self.remove_volgroup(device)
+
+    @property
+    def bcache_devices(self):
+        return collections.OrderedDict(
+            (b.name, b) for b in self._bcaches.values())
+
+    def all_bcaches(self):
+        return list(self._bcaches.values())
+
+    def _is_cache_device(self, device):
+        holder = device._constructed_device
+        return isinstance(holder, Bcache) and holder.cache_device is device
+
+    def get_bcache_cachedevs(self):
+        """Paths of devices already caching a bcache, which can be shared."""
+        return sorted(set(
+            b.cache_device.path for b in self._bcaches.values()))
+
+    def _next_bcache_name(self):
+        names = set(b.name for b in self._bcaches.values())
+        i = 0
+        while "bcache%d" % i in names:
+            i += 1
+        return "bcache%d" % i
+
+    @journaled
+    def add_bcache(self, backing_device, cache_device, cache_mode=None):
+        if cache_mode is not None and cache_mode not in BCACHE_CACHE_MODES:
+            raise ValueError("unknown cache mode {!r}".format(cache_mode))
+        if backing_device is cache_device:
+            raise ValueError("backing and cache device must differ")
+        if not self._is_empty(backing_device):
+            raise Exception(
+                "{} is not available".format(backing_device.path))
+        if not (self._is_empty(cache_device)
+                or self._is_cache_device(cache_device)):
+            raise Exception("{} is not available".format(cache_device.path))
+        bcache = Bcache(
+            name=self._next_bcache_name(), backing_device=backing_device,
+            cache_device=cache_device, cache_mode=cache_mode)
+        for device in backing_device, cache_device:
+            if isinstance(device, Disk):
+                self._use_disk(device)
+            if device._constructed_device is None:
+                device._constructed_device = bcache
+        self._bcaches[bcache.id] = bcache
+        self._objects[bcache.id] = bcache
+        return bcache
+
+    def add_bcache_device(self, result):
+        """Create a bcache device from the result of BcacheView."""
+        return self.add_bcache(
+            self.get_device(result['backing_device']),
+            self.get_device(result['cache_device']),
+            result.get('cache_mode'))
+
+    @journaled
+    def remove_bcache(self, bcache):
+        if bcache._constructed_device is not None:
+            self.remove_volgroup(bcache._constructed_device)
+        if bcache._fs is not None:
+            self.remove_filesystem(bcache._fs)
+        del self._bcaches[bcache.id]
+        del self._objects[bcache.id]
+        bcache.backing_device._constructed_device = None
+        cache = bcache.cache_device
+        if cache._constructed_device is bcache:
+            # Hand the cache device over to another bcache sharing it.
+            cache._constructed_device = None
+            for other in self._bcaches.values():
+                if other.cache_device is cache:
+                    cache._constructed_device = other
+                    break
+
+    def all_volgroups(self):
+        return list(self._volgroups.values())
+
+    def all_logical_volumes(self):
+        return list(self._logical_volumes.values())
+
+    @journaled
+    def add_volgroup(self, name, devices, extent_size=LVM_EXTENT_SIZE):
+        devices = list(devices)
+        if not devices:
+            raise ValueError("a volume group needs at least one device")
+        if any(vg.name == name for vg in self._volgroups.values()):
+            raise ValueError("volume group {} already exists".format(name))
+        for device in devices:
+            if not self._is_empty(device):
+                raise Exception("{} is not available".format(device.path))
+        vg = LVMVolGroup(name=name, devices=devices, extent_size=extent_size)
+        for device in devices:
+            if isinstance(device, Disk):
+                self._use_disk(device)
+            device._constructed_device = vg
+        self._volgroups[vg.id] = vg
+        self._objects[vg.id] = vg
+        return vg
+
+    def add_lvm_volgroup(self, result):
+        """Create a volume group from the result of LVMVolumeGroupView."""
+        devices = [self.get_device(path) for path in result['devices']]
+        return self.add_volgroup(result['volgroup'], devices)
+
+    @journaled
+    def remove_volgroup(self, vg):
+        for lv in vg.volumes():
+            self.remove_logical_volume(lv)
+        for device in vg.devices:
+            device._constructed_device = None
+        del self._volgroups[vg.id]
+        del self._objects[vg.id]
+
+    @journaled
+    def add_logical_volume(self, vg, name, size):
+        if any(lv.name == name for lv in vg.volumes()):
+            raise ValueError("{} already has a volume called {}".format(
+                vg.name, name))
+        extents = -(-size // vg._extent_size)
+        allocation = vg._allocate(extents)
+        if allocation is None:
+            raise Exception("{} does not have room for {}".format(
+                vg.name, humanize_size(size)))
+        vg._take(allocation)
+        lv = LVMLogicalVolume(
+            name=name, volgroup=vg, size=extents * vg._extent_size,
+            allocation=allocation)
+        record(vg, '_volumes')
+        vg._volumes[lv.id] = lv
+        self._logical_volumes[lv.id] = lv
+        self._objects[lv.id] = lv
+        return lv
+
+    @journaled
+    def remove_logical_volume(self, lv):
+        if lv._fs is not None:
+            self.remove_filesystem(lv._fs)
+        lv.volgroup._release(lv._allocation)
+        record(lv.volgroup, '_volumes')
+        del lv.volgroup._volumes[lv.id]
+        del self._logical_volumes[lv.id]
+        del self._objects[lv.id]
+
+    @journaled
     def add_filesystem(self, volume, fstype):
         log.debug("adding %s to %s", fstype, volume)
         if not volume.available:
@@ -364,19 +1759,140 @@ class FilesystemModel(object):
         if volume._fs is not None:
             raise Exception("%s is already formatted")
         volume._fs = fs = Filesystem(volume=volume, fstype=fstype)
-        self._filesystems.append(fs)
+        self._filesystems[fs.id] = fs
+        self._objects[fs.id] = fs
+        self._tune_filesystem(fs)
+        return fs
+
+    def _tune_filesystem(self, fs):
+        if fs.preserve:
+            return
+        mountpoint = None
+        if fs._mount is not None:
+            mountpoint = fs._mount.path
+        if mountpoint in self.mkfs_overrides:
+            options = self.mkfs_overrides[mountpoint]
+            if isinstance(options, str):
+                options = shlex.split(options)
+            options = list(options)
+        else:
+            options = mkfs_options(fs.fstype, fs.volume, mountpoint)
+        options = options or None
+        if options != fs.extra_options:
+            fs.extra_options = options
+
+    @journaled
+    def set_format(self, volume, fstype, path=None, profile=None,
+                   keep=False):
+        """Format volume as fstype and mount it at path.
+
+        fstype None leaves volume unformatted and a false path leaves it
+        unmounted. An existing filesystem that is preserved is only kept
+        if keep is true and it is of type fstype, in which case just its
+        mount changes; otherwise volume is formatted afresh.
+        """
+        fs = volume.fs()
+        if fs is not None:
+            if fs.preserve:
+                same = keep and fs.fstype == fstype
+            else:
+                same = fs.fstype == fstype
+            if not same:
+                self.remove_filesystem(fs)
+                fs = None
+        if fstype is None:
+            return None
+        if fs is None:
+            fs = self.add_filesystem(volume, fstype)
+        mount = fs.mount()
+        if mount is not None:
+            if mount.path == path and mount.profile() == profile:
+                return fs
+            self.remove_mount(mount)
+        if path:
+            self.add_mount(fs, path, profile)
         return fs
 
-    def add_mount(self, fs, path):
+    @journaled
+    def remove_filesystem(self, fs):
+        if fs._mount is not None:
+            self.remove_mount(fs._mount)
+        fs.volume._fs = None
+        del self._filesystems[fs.id]
+        del self._objects[fs.id]
+
+    @journaled
+    def add_mount(self, fs, path, profile=None):
         if fs._mount is not None:
             raise Exception("%s is already mounted")
-        fs._mount = m = Mount(device=fs, path=path)
-        self._mounts.append(m)
+        options = mount_options(
+            profile or suggest_mount_profile(fs.volume, path), fs.fstype)
+        fs._mount = m = Mount(
+            device=fs, path=path, options=options or None, profile=profile)
+        self._mounts[m.id] = m
+        self._mounts_by_depth = None
+        self._objects[m.id] = m
+        self._tune_filesystem(fs)
         return m
 
+    @journaled
+    def remove_mount(self, mount):
+        mount.device._mount = None
+        del self._mounts[mount.id]
+        self._mounts_by_depth = None
+        del self._objects[mount.id]
+        self._tune_filesystem(mount.device)
+
+    def suggested_swap_size(self, disk_size):
+        return swap_size(
+            self.swap_policy, self.memtotal, disk_size, self.swap_fixed_size)
+
+    @journaled
+    def add_swap(self, disk, size):
+        """Give the install size bytes of swap, as swap_kind says.
+
+        A swap partition goes in the free space left on disk; a swap
+        file is created on / by curtin once it is installed.
+        """
+        if size <= 0:
+            return None
+        if self.swap_kind == 'file':
+            record(self, '_swapfile_size')
+            self._swapfile_size = size
+            return None
+        size = min(size, disk.free)
+        if size <= 0:
+            log.debug("no room left on %s for swap", disk.path)
+            return None
+        part = self.add_partition(disk, disk.next_partnum, size)
+        return self.add_filesystem(part, 'swap')
+
+    def swapfile_size(self):
+        if '/' not in self.get_mountpoint_to_devpath_mapping():
+            return 0
+        return self._swapfile_size
+
+    def render_swap(self):
+        """curtin's swap config, or None to leave curtin's default.
+
+        curtin creates a swap file of its own choosing unless told
+        otherwise, so this only says anything if a swap file was added
+        or the swap policy is to have no swap at all.
+        """
+        size = self.swapfile_size()
+        if size:
+            return {'filename': '/swap.img', 'size': size}
+        if self.swap_policy == 'none':
+            return {'size': 0}
+        return None
+
+    def disk_sizes(self):
+        """The size of each disk in the configuration, by id."""
+        return {d.id: d._info.size for d in self._disks.values()}
+
     def get_mountpoint_to_devpath_mapping(self):
         r = {}
-        for m in self._mounts:
+        for m in self._mounts.values():
             r[m.path] = m.device.volume.path
         return r
 
@@ -389,7 +1905,7 @@ class FilesystemModel(object):
 
     def bootable(self):
         ''' true if one disk has a boot partition '''
-        for p in self._partitions:
+        for p in self._partitions.values():
             if p.flag == 'bios_grub' or p.flag == 'boot':
                 return True
         return False
@@ -0,0 +1,135 @@
+# Copyright 2018 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Choose mkfs options to suit the device a filesystem is created on.
+# The volumes passed in are the objects from subiquity.models.filesystem
+# and are told apart by their curtin 'type'.
+
+FS_BLOCK_SIZE = 4096
+HUGE_FILESYSTEM = 1 << 40
+DATA_MOUNTPOINTS = ('/srv', '/data', '/var/lib/')
+DATA_BYTES_PER_INODE = 65536
+# mdadm's default chunk size, which curtin always creates arrays with.
+RAID_DEFAULT_CHUNK = 512 << 10
+
+
+def disks_under(volume):
+    """The disks that volume is ultimately stored on."""
+    t = volume.type
+    if t == 'disk':
+        return [volume]
+    elif t == 'partition':
+        return [volume.device]
+    elif t == 'raid':
+        devices = volume.devices
+    elif t == 'lvm_partition':
+        devices = volume.volgroup.devices
+    elif t == 'bcache':
+        devices = [volume.backing_device]
+    else:
+        return []
+    r = []
+    for device in devices:
+        r.extend(disks_under(device))
+    return r
+
+
+def is_ssd(volume):
+    """True if volume is entirely on disks known to be non-rotational."""
+    if volume.type == 'bcache':
+        return False
+    disks = disks_under(volume)
+    return bool(disks) and all(
+        d._info is not None and d._info.rotational is False for d in disks)
+
+
+def stripe_geometry(volume):
+    """Return (stripe unit in bytes, data devices) or None."""
+    t = volume.type
+    if t == 'raid':
+        n = len(volume.devices)
+        data_devices = {0: n, 5: n - 1, 6: n - 2, 10: n // 2}.get(
+            volume.raidlevel)
+        if data_devices:
+            return RAID_DEFAULT_CHUNK, data_devices
+    return None
+
+
+def is_data_mountpoint(path):
+    if path is None:
+        return False
+    return path.startswith(DATA_MOUNTPOINTS)
+
+
+def mkfs_options(fstype, volume, mountpoint=None):
+    """Extra arguments for mkfs.<fstype> when formatting volume."""
+    r = []
+    geometry = stripe_geometry(volume)
+    if fstype == 'ext4':
+        extended = []
+        if geometry is not None:
+            unit, data_devices = geometry
+            stride = max(unit // FS_BLOCK_SIZE, 1)
+            extended.append('stride=%d' % stride)
+            extended.append('stripe_width=%d' % (stride * data_devices))
+        if is_ssd(volume):
+            extended.append('discard')
+        if volume.size >= HUGE_FILESYSTEM:
+            extended.append('lazy_itable_init=1')
+            extended.append('lazy_journal_init=1')
+        if extended:
+            r.extend(['-E', ','.join(extended)])
+        if is_data_mountpoint(mountpoint):
+            r.extend(['-i', str(DATA_BYTES_PER_INODE)])
+    elif fstype == 'xfs':
+        if geometry is not None:
+            unit, data_devices = geometry
+            r.extend(['-d', 'su=%d,sw=%d' % (unit, data_devices)])
+        if not is_ssd(volume):
+            # Discarding blocks only slows mkfs down on spinning disks.
+            r.append('-K')
+    return r
+
+
+# Named sets of mount options. The options that make up a profile
+# depend a little on the filesystem, see mount_options().
+MOUNT_PROFILES = ['defaults', 'ssd', 'bulk-data']
+BULK_DATA_COMMIT_INTERVAL = 60
+
+
+def mount_options(profile, fstype):
+    """The options string for mounting an fstype filesystem with profile."""
+    if profile not in MOUNT_PROFILES:
+        raise ValueError("unknown mount profile {!r}".format(profile))
+    if profile == 'defaults' or fstype in (None, 'swap', 'fat32'):
+        return ''
+    options = ['noatime']
+    if profile == 'ssd':
+        if fstype == 'btrfs':
+            options.append('discard=async')
+        else:
+            options.append('discard')
+    elif profile == 'bulk-data' and fstype in ('ext4', 'btrfs'):
+        options.append('commit=%d' % BULK_DATA_COMMIT_INTERVAL)
+    return ','.join(options)
+
+
+def suggest_mount_profile(volume, mountpoint):
+    """Pick a mount profile for volume when it is mounted at mountpoint."""
+    if is_ssd(volume):
+        return 'ssd'
+    if is_data_mountpoint(mountpoint):
+        return 'bulk-data'
+    return 'defaults'
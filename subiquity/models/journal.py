@@ -0,0 +1,260 @@
+# Copyright 2018 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import contextlib
+import functools
+import itertools
+import logging
+
+
+log = logging.getLogger('subiquity.models.journal')
+
+JOURNAL_LIMIT = 200
+
+# The step being recorded, if any. There is only ever one model being
+# edited at a time, so this does not need to be any cleverer.
+_active = None
+
+# Saved in place of a key or attribute that was not there.
+_ABSENT = object()
+# Passed to record() to save all of an object's attributes.
+_WHOLE = object()
+
+
+class JournaledDict(collections.OrderedDict):
+    """An OrderedDict whose changes are saved key by key."""
+
+    _missing = object()
+
+    def __init__(self, *args, **kw):
+        # When each key was added, so that undoing a deletion can put
+        # the key back where it was.
+        self._serials = {}
+        self._counter = itertools.count()
+        super().__init__(*args, **kw)
+
+    def __setitem__(self, key, value):
+        record(self, key)
+        if key not in self:
+            self._serials[key] = next(self._counter)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        record(self, key)
+        super().__delitem__(key)
+        del self._serials[key]
+
+    def pop(self, key, default=_missing):
+        # OrderedDict.pop does not go through __delitem__.
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default is self._missing:
+            raise KeyError(key)
+        return default
+
+    def _save(self, key):
+        if key in self:
+            return (self[key], self._serials[key])
+        return _ABSENT
+
+    def _restore(self, key, state):
+        if state is _ABSENT:
+            if key in self:
+                collections.OrderedDict.__delitem__(self, key)
+                del self._serials[key]
+            return False
+        value, serial = state
+        moved = key not in self
+        collections.OrderedDict.__setitem__(self, key, value)
+        self._serials[key] = serial
+        return moved
+
+    def _reorder(self):
+        for key in sorted(self, key=self._serials.__getitem__):
+            self.move_to_end(key)
+
+
+def record(obj, key=_WHOLE):
+    """Save key of obj, if a step is being recorded.
+
+    Call this before changing obj in place. A JournaledDict calls it
+    for each key it changes and objects using CachedRender call it from
+    __setattr__, so only changes to the contents of their mutable
+    attributes need an explicit call, naming the attribute.
+
+    With no key, all of obj's attributes are saved unless it has a
+    _journal_fields attribute naming the ones to save. Attributes named
+    in _journal_skip are not the user's to change, such as what was
+    probed from the hardware: they are never saved or restored.
+    Attributes named in _journal_caches are not saved either, and are
+    set to None when obj is restored.
+    """
+    if _active is not None:
+        _active.save(obj, key)
+
+
+def _copy(v):
+    if isinstance(v, (dict, list)) and not isinstance(v, JournaledDict):
+        v = v.copy()
+    return v
+
+
+def _not_journaled(obj):
+    return (
+        getattr(obj, '_journal_skip', ()) +
+        getattr(obj, '_journal_caches', ()))
+
+
+def _snapshot(obj, key):
+    if isinstance(obj, JournaledDict):
+        return obj._save(key)
+    if key is not _WHOLE:
+        return _copy(vars(obj).get(key, _ABSENT))
+    fields = getattr(obj, '_journal_fields', None)
+    skip = _not_journaled(obj)
+    state = {}
+    for k, v in vars(obj).items():
+        if k in skip or (fields is not None and k not in fields):
+            continue
+        state[k] = _copy(v)
+    return state
+
+
+def _restore(obj, key, state):
+    if isinstance(obj, JournaledDict):
+        return obj._restore(key, state)
+    d = vars(obj)
+    if key is not _WHOLE:
+        if state is _ABSENT:
+            d.pop(key, None)
+        else:
+            d[key] = state
+    else:
+        if getattr(obj, '_journal_fields', None) is None:
+            skip = _not_journaled(obj)
+            for k in list(d):
+                if k not in state and k not in skip:
+                    del d[k]
+        d.update(state)
+    # Caches are rebuilt on demand.
+    for k in getattr(obj, '_journal_caches', ()):
+        d[k] = None
+    return False
+
+
+class _Step:
+    """The values some keys and attributes had before a change was made.
+
+    Only what was changed is saved, and the values refer to rather than
+    copy the objects they mention, so a step costs about as much as the
+    change it records.
+    """
+
+    def __init__(self):
+        # {(id(obj), key): (obj, key, state)}
+        self._saved = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._saved)
+
+    def save(self, obj, key=_WHOLE):
+        if key is not _WHOLE and key in _not_journaled(obj):
+            return
+        if (id(obj), key) not in self._saved:
+            self._saved[id(obj), key] = (obj, key, _snapshot(obj, key))
+
+    def restore(self):
+        """Put everything back as it was and return the inverse step."""
+        inverse = _Step()
+        reorder = {}
+        for obj, key, state in reversed(list(self._saved.values())):
+            inverse.save(obj, key)
+            if _restore(obj, key, state):
+                reorder[id(obj)] = obj
+        for obj in reorder.values():
+            obj._reorder()
+        return inverse
+
+
+class Journal:
+    """Undo and redo history for a model.
+
+    Changes are grouped into steps with step(); any changes to a
+    JournaledDict or a CachedRender object made while a step is open
+    can then be undone and redone together.
+    """
+
+    def __init__(self, limit=JOURNAL_LIMIT):
+        self.limit = limit
+        self._undo = []
+        self._redo = []
+
+    @contextlib.contextmanager
+    def step(self):
+        """Record the changes made in the with block as one step.
+
+        Steps nest: an inner step is part of the outer one. If the
+        block raises, its changes are rolled back.
+        """
+        global _active
+        if _active is not None:
+            yield
+            return
+        step = _active = _Step()
+        try:
+            yield
+        except Exception:
+            _active = None
+            step.restore()
+            raise
+        _active = None
+        if len(step) > 0:
+            self._undo.append(step)
+            del self._undo[:-self.limit]
+            del self._redo[:]
+
+    def can_undo(self):
+        return len(self._undo) > 0
+
+    def can_redo(self):
+        return len(self._redo) > 0
+
+    def undo(self):
+        if not self._undo:
+            return False
+        self._redo.append(self._undo.pop().restore())
+        return True
+
+    def redo(self):
+        if not self._redo:
+            return False
+        self._undo.append(self._redo.pop().restore())
+        return True
+
+    def clear(self):
+        self._undo = []
+        self._redo = []
+
+
+def journaled(meth):
+    """Make a method of a model with a journal attribute one step."""
+    @functools.wraps(meth)
+    def wrapper(self, *args, **kw):
+        with self.journal.step():
+            return meth(self, *args, **kw)
+    return wrapper
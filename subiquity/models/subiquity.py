@@ -114,6 +114,10 @@ class SubiquityModel:
                 },
             }
 
+        swap = self.filesystem.render_swap()
+        if swap is not None:
+            config['swap'] = swap
+
         config.update(self.network.render())
 
         return config
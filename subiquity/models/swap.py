@@ -0,0 +1,90 @@
+# Copyright 2018 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Decide how much swap an install should get from the amount of RAM
+# in the machine and the size of the disk being installed to.
+
+import logging
+import math
+
+
+log = logging.getLogger('subiquity.models.swap')
+
+GiB = 1 << 30
+MiB = 1 << 20
+
+SWAP_POLICIES = ['none', 'fixed', 'ratio', 'hibernate']
+SWAP_KINDS = ['partition', 'file']
+# Never let swap take more than this fraction of the disk, and do not
+# bother with swap at all on disks smaller than MIN_DISK_FOR_SWAP.
+MAX_DISK_FRACTION = 4
+MIN_DISK_FOR_SWAP = 8 * GiB
+MAX_RATIO_SWAP = 8 * GiB
+
+
+def read_memtotal(path='/proc/meminfo'):
+    """Return MemTotal in bytes, or None if it cannot be read."""
+    try:
+        with open(path) as fp:
+            for line in fp:
+                if line.startswith('MemTotal:'):
+                    value, unit = line.split()[1:3]
+                    if unit.lower() != 'kb':
+                        break
+                    return int(value) * 1024
+    except (OSError, ValueError, IndexError):
+        log.exception("could not read %s", path)
+    return None
+
+
+def ratio_swap_size(memtotal):
+    """Swap proportional to RAM, shrinking as RAM grows.
+
+    Small machines get twice their RAM so they are not killed by the
+    OOM killer; large machines get a modest fixed amount rather than
+    gigabytes of swap they will never use.
+    """
+    if memtotal < 2 * GiB:
+        return 2 * memtotal
+    elif memtotal < 8 * GiB:
+        return memtotal
+    return min(max(4 * GiB, memtotal // 8), MAX_RATIO_SWAP)
+
+
+def hibernate_swap_size(memtotal):
+    """Enough swap to hold an image of RAM, plus some headroom."""
+    return memtotal + int(math.sqrt(memtotal / GiB) * GiB)
+
+
+def swap_size(policy, memtotal, disk_size, fixed_size=None):
+    """The bytes of swap to create on a disk of disk_size bytes.
+
+    memtotal may be None if the amount of RAM is not known, in which
+    case only the 'none' and 'fixed' policies give a non-zero answer.
+    """
+    if policy not in SWAP_POLICIES:
+        raise ValueError("unknown swap policy {!r}".format(policy))
+    if policy == 'none' or disk_size < MIN_DISK_FOR_SWAP:
+        return 0
+    if policy == 'fixed':
+        size = fixed_size or 0
+    elif memtotal is None:
+        return 0
+    elif policy == 'ratio':
+        size = ratio_swap_size(memtotal)
+    else:
+        size = hibernate_swap_size(memtotal)
+    size = min(size, disk_size // MAX_DISK_FRACTION)
+    return size - size % MiB
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+
+from subiquity.models.blockindex import BlockIndex
+
+
+class TestBlockIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = self.tmpdir.name
+        self.sys_block = os.path.join(self.root, 'class')
+        os.makedirs(self.sys_block)
+
+    def add_device(self, name, parent=None, holders=()):
+        if parent is None:
+            devdir = os.path.join(self.root, 'devices', name)
+        else:
+            devdir = os.path.join(self.root, 'devices', parent, name)
+        os.makedirs(os.path.join(devdir, 'holders'))
+        if parent is not None:
+            open(os.path.join(devdir, 'partition'), 'w').close()
+        for holder in holders:
+            open(os.path.join(devdir, 'holders', holder), 'w').close()
+        os.symlink(devdir, os.path.join(self.sys_block, name))
+
+    def make_index(self, mounts='', swaps=''):
+        proc_mounts = os.path.join(self.root, 'mounts')
+        with open(proc_mounts, 'w') as fp:
+            fp.write(mounts)
+        proc_swaps = os.path.join(self.root, 'swaps')
+        with open(proc_swaps, 'w') as fp:
+            fp.write('Filename Type Size Used Priority\n' + swaps)
+        return BlockIndex(self.sys_block, proc_mounts, proc_swaps)
+
+    def test_partitions(self):
+        self.add_device('sda')
+        self.add_device('sda1', parent='sda')
+        self.add_device('sda2', parent='sda')
+        index = self.make_index()
+        self.assertEqual(['sda1', 'sda2'], sorted(index.get('sda').partitions))
+        self.assertEqual('sda', index.get('/dev/sda2').parent)
+
+    def test_mounted_partition(self):
+        self.add_device('sda')
+        self.add_device('sda1', parent='sda')
+        self.add_device('sdb')
+        index = self.make_index(mounts='/dev/sda1 / ext4 rw 0 0\n')
+        self.assertEqual({'/dev/sda'}, index.in_use_disks())
+
+    def test_in_use_via_holders(self):
+        self.add_device('sda')
+        self.add_device('sda1', parent='sda', holders=['md0'])
+        self.add_device('sdb', holders=['md0'])
+        self.add_device('md0', holders=['dm-0'])
+        self.add_device('dm-0')
+        self.add_device('sdc')
+        index = self.make_index(swaps='/dev/dm-0 partition 1024 0 -2\n')
+        self.assertEqual(
+            {'/dev/sda', '/dev/sdb', '/dev/md0', '/dev/dm-0'},
+            index.in_use_disks())
+        self.assertEqual(['md0'], index.holders('/dev/sda'))
@@ -0,0 +1,79 @@
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+from subiquity.models import diskbench
+from subiquity.models.diskbench import (
+    benchmark_device,
+    BenchmarkResult,
+    DiskBenchmarks,
+    )
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def make_device(self, size):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(os.urandom(size))
+        return path
+
+    def test_measures_without_writing(self):
+        path = self.make_device(8 << 20)
+        with open(path, 'rb') as fp:
+            before = fp.read()
+        mtime = os.stat(path).st_mtime_ns
+        # The temporary directory may not support O_DIRECT.
+        result = benchmark_device(
+            path, 8 << 20, direct=False, rng=random.Random(0))
+        self.assertIsNone(result.error)
+        self.assertGreater(result.sequential, 0)
+        self.assertGreater(result.random_iops, 0)
+        self.assertIsNotNone(result.random_latency_p99)
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), before)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+
+    def test_errors(self):
+        self.assertEqual(
+            benchmark_device('/nonexistent', 8 << 20).error,
+            'No such file or directory')
+        self.assertEqual(
+            benchmark_device('/nonexistent', 4096).error,
+            'too small to measure')
+
+
+class TestDiskBenchmarks(unittest.TestCase):
+
+    def test_failed_run_not_left_running(self):
+        benchmarks = DiskBenchmarks()
+        with mock.patch.object(
+                diskbench, 'benchmark_device', side_effect=OSError("boom")):
+            fut = benchmarks.start('/dev/fakea', 8 << 20)
+            with self.assertRaises(OSError):
+                fut.result()
+        self.assertFalse(benchmarks.running('/dev/fakea'))
+        self.assertIsNone(benchmarks.get('/dev/fakea'))
+        # It can be tried again.
+        with mock.patch.object(diskbench, 'benchmark_device') as bench:
+            benchmarks.start('/dev/fakea', 8 << 20).result()
+        bench.assert_called_once_with('/dev/fakea', 8 << 20)
+        self.assertIs(benchmarks.get('/dev/fakea'), bench.return_value)
+
+    def test_failed_result_measured_again(self):
+        benchmarks = DiskBenchmarks()
+        failed = BenchmarkResult(error="No such file or directory")
+        with mock.patch.object(
+                diskbench, 'benchmark_device', return_value=failed):
+            benchmarks.start('/dev/fakea', 8 << 20).result()
+        self.assertIs(benchmarks.get('/dev/fakea'), failed)
+        with mock.patch.object(diskbench, 'benchmark_device') as bench:
+            bench.return_value = BenchmarkResult(
+                sequential=1, random_iops=1, random_latency=1)
+            benchmarks.start('/dev/fakea', 8 << 20).result()
+        bench.assert_called_once_with('/dev/fakea', 8 << 20)
+        self.assertIs(benchmarks.get('/dev/fakea'), bench.return_value)
+        self.assertIsNone(benchmarks.start('/dev/fakea', 8 << 20))
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from subiquity.models import diskdetails
+from subiquity.models.diskdetails import (
+    DiskDetailsService,
+    gather_disk_details,
+    )
+
+
+class TestDiskDetails(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = self.tmpdir.name
+        self.sys_block = os.path.join(self.root, 'class')
+        os.makedirs(self.sys_block)
+
+    def write(self, path, content):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write(content + '\n')
+
+    def add_sata_disk(self, name):
+        port = 'devices/pci0000:00/ata3'
+        self.write(port + '/link3/ata_link/link3/sata_spd', '6.0 Gbps')
+        device = port + '/host2/target2:0:0/2:0:0:0'
+        devdir = device + '/block/' + name
+        self.write(devdir + '/queue/rotational', '0')
+        self.write(devdir + '/queue/logical_block_size', '512')
+        self.write(devdir + '/queue/scheduler', 'none [mq-deadline] kyber')
+        self.write(devdir + '/queue/discard_max_bytes', '2147450880')
+        os.symlink(
+            os.path.join(self.root, device),
+            os.path.join(self.root, devdir, 'device'))
+        os.symlink(
+            os.path.join(self.root, devdir),
+            os.path.join(self.sys_block, name))
+
+    def test_gather(self):
+        self.add_sata_disk('sdz')
+        details = gather_disk_details('sdz', self.sys_block)
+        self.assertIs(details.rotational, False)
+        self.assertEqual(details.logical_block_size, 512)
+        self.assertIsNone(details.physical_block_size)
+        self.assertEqual(details.scheduler, 'mq-deadline')
+        self.assertIs(details.discard, True)
+        self.assertEqual(details.link_speed, 'SATA 6.0 Gbps')
+        self.assertIsNone(details.smart)
+
+    def test_service_caches(self):
+        self.add_sata_disk('sdz')
+        service = DiskDetailsService(self.sys_block)
+        self.assertIsNone(service.get('sdz'))
+        fut = service.lookup('sdz')
+        self.assertIs(fut.result(), service.get('sdz'))
+        self.assertIsNone(service.lookup('sdz'))
+
+    def fake_smartctl(self, version):
+        path = os.path.join(self.root, 'smartctl')
+        with open(path, 'w') as fp:
+            fp.write('#!/bin/sh\necho "smartctl {} 2019-12-30 r5022"\n'.format(
+                version))
+        os.chmod(path, 0o755)
+        diskdetails._smartctl.cache_clear()
+        self.addCleanup(diskdetails._smartctl.cache_clear)
+        p = mock.patch.object(diskdetails.shutil, 'which', return_value=path)
+        p.start()
+        self.addCleanup(p.stop)
+        return path
+
+    def test_old_smartctl_not_used(self):
+        self.fake_smartctl('6.6')
+        self.assertIsNone(diskdetails._smartctl())
+
+    def test_smartctl(self):
+        path = self.fake_smartctl('7.1')
+        self.assertEqual(diskdetails._smartctl(), path)
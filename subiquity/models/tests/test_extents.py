@@ -0,0 +1,53 @@
+import unittest
+
+from subiquity.models.extents import FreeExtents
+
+
+class TestFreeExtents(unittest.TestCase):
+
+    def test_release_coalesces(self):
+        e = FreeExtents(0, 100)
+        a = e.allocate(10)
+        b = e.allocate(10)
+        c = e.allocate(10)
+        self.assertEqual((a, b, c), (0, 10, 20))
+        e.release(a, 10)
+        e.release(c, 10)
+        self.assertEqual(list(e), [(0, 10), (20, 100)])
+        e.release(b, 10)
+        self.assertEqual(list(e), [(0, 100)])
+        self.assertEqual(e.total, 100)
+
+    def test_best_fit(self):
+        e = FreeExtents(0, 100)
+        for i in range(5):
+            e.allocate(10)
+        e.release(0, 10)
+        e.release(20, 5)
+        self.assertEqual(e.allocate(5, 'best'), 20)
+        self.assertEqual(e.allocate(5, 'first'), 0)
+        self.assertIsNone(e.allocate(60))
+
+    def test_allocate_at(self):
+        e = FreeExtents(0, 100)
+        self.assertEqual(e.allocate(10, at=40), 40)
+        self.assertEqual(list(e), [(0, 40), (50, 100)])
+        self.assertIsNone(e.allocate(20, at=30))
+        self.assertEqual(e.free_around(40, 10), 100)
+
+    def test_reserve(self):
+        e = FreeExtents(10, 100)
+        e.allocate(10, at=50)
+        self.assertEqual(e.reserve(0, 20), 10)
+        self.assertEqual(e.reserve(40, 30), 20)
+        self.assertEqual(list(e), [(20, 40), (70, 100)])
+        self.assertEqual(e.total, 50)
+
+    def test_aligned(self):
+        e = FreeExtents(0, 100, grain=8, skew=2)
+        e.reserve(0, 13)
+        self.assertEqual(e.allocate(8), 18)
+        self.assertEqual(list(e), [(13, 18), (26, 100)])
+        self.assertEqual(e.largest(), 72)
+        # The aligned end is 98, so this does not fit.
+        self.assertIsNone(e.allocate(80))
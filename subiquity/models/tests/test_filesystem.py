@@ -1,7 +1,16 @@
 
 import unittest
 
-from subiquity.models.filesystem import dehumanize_size
+from probert.storage import StorageInfo
+
+from subiquity.models.blockindex import BlockDevice, BlockIndex
+from subiquity.models.filesystem import (
+    asdict,
+    dehumanize_size,
+    DiskInfo,
+    FilesystemModel,
+    raid_size,
+    )
 
 class TestDehumanizeSize(unittest.TestCase):
 
@@ -62,3 +71,789 @@ class TestDehumanizeSize(unittest.TestCase):
                 else:
                     self.fail("dehumanize_size({!r}) did not error".format(input))
                 self.assertEqual(expected_error, actual_error)
+
+
+def fake_disk_data(name, size=10 << 30):
+    return {
+        'DEVNAME': name,
+        'DEVPATH': '/devices/pci0000:00/' + name[5:],
+        'DEVTYPE': 'disk',
+        'ID_SERIAL': 'serial-' + name[5:],
+        'MAJOR': '8',
+        'attrs': {
+            'ro': '0',
+            'size': str(size),
+            },
+        }
+
+
+class FakeProber:
+
+    storage_is_live = False
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get_storage(self):
+        return self.storage
+
+    def get_storage_info(self, path, data=None):
+        if data is None:
+            data = self.storage[path]
+        return StorageInfo({path: data})
+
+    def release_storage(self):
+        pass
+
+
+class TestFilesystemModelDeviceEvents(unittest.TestCase):
+
+    def make_model(self, *names):
+        storage = {name: fake_disk_data(name) for name in names}
+        model = FilesystemModel(FakeProber(storage))
+        model.probe()
+        return model
+
+    def test_host_block_devices_ignored(self):
+        # The fake disks are not this machine's, so nothing about the
+        # host's block devices or mounts should leak into the model.
+        model = self.make_model('/dev/fakea')
+        self.assertEqual({}, model.block_index.devices)
+        model.new_device('/dev/fakeb', fake_disk_data('/dev/fakeb'))
+        self.assertEqual({}, model.block_index.devices)
+
+    def test_new_device(self):
+        model = self.make_model('/dev/fakea')
+        data = fake_disk_data('/dev/fakeb')
+        model.new_device('/dev/fakeb', data)
+        self.assertEqual(
+            ['/dev/fakea', '/dev/fakeb'],
+            sorted(d.path for d in model.all_disks()))
+
+    def test_del_device_forgets_configuration(self):
+        model = self.make_model('/dev/fakea', '/dev/fakeb')
+        disk = model.get_disk('/dev/fakea')
+        part = model.add_partition(disk, 1, 1 << 30)
+        fs = model.add_filesystem(part, 'ext4')
+        model.add_mount(fs, '/')
+        model.del_device('/dev/fakea')
+        self.assertIsNone(model.get_disk('/dev/fakea'))
+        self.assertEqual([], model.render())
+
+    def event(self, model, path, data, action='new_device'):
+        # As UdevStorageObserver does, update the storage data first.
+        model.prober.storage[path] = data
+        getattr(model, action)(path, data)
+
+    def test_size_change(self):
+        model = FilesystemModel(FakeProber({
+            '/dev/fakea': fake_disk_data('/dev/fakea', 0)}))
+        model.probe()
+        disk = model.get_disk('/dev/fakea')
+        self.assertEqual(disk.free, 0)
+        self.event(
+            model, '/dev/fakea', fake_disk_data('/dev/fakea', 32 << 30),
+            'update_device')
+        self.assertGreater(disk.free, 30 << 30)
+        part = model.add_partition(disk, 1, 10 << 30)
+        self.assertEqual(part.size, 10 << 30)
+
+    def test_hotplugged_disk_with_partitions(self):
+        model = self.make_model('/dev/fakea')
+        data = fake_disk_data('/dev/fakeb')
+        data['ID_PART_TABLE_TYPE'] = 'gpt'
+        part = {
+            'DEVPATH': data['DEVPATH'] + '/fakeb1',
+            'DEVTYPE': 'partition',
+            'ID_PART_ENTRY_NUMBER': '1',
+            'ID_PART_ENTRY_OFFSET': '2048',
+            'ID_PART_ENTRY_SIZE': '2097152',
+            'ID_FS_TYPE': 'ext4',
+            }
+        # The disk is reported before its partitions.
+        self.event(model, '/dev/fakeb', data)
+        disk = model.get_disk('/dev/fakeb')
+        self.assertEqual(disk._info.partitions, ())
+        self.event(model, '/dev/fakeb1', part)
+        [existing] = disk._info.partitions
+        self.assertEqual(
+            (existing.offset, existing.size, existing.fstype),
+            (1 << 20, 1 << 30, 'ext4'))
+        model.preserve_existing(disk)
+        [p] = disk.partitions()
+        self.assertEqual(p.fs().fstype, 'ext4')
+        # The partition table is rewritten behind the model's back.
+        part = dict(part, ID_PART_ENTRY_SIZE='4194304')
+        self.event(model, '/dev/fakeb1', part, 'update_device')
+        [p] = disk.partitions()
+        self.assertEqual(p.size, 2 << 30)
+        self.assertTrue(p.preserve)
+        self.assertFalse(model.journal.can_undo())
+
+
+class TestDiskSpaceAccounting(unittest.TestCase):
+
+    def make_disk(self):
+        model = FilesystemModel(FakeProber({
+            '/dev/fakea': fake_disk_data('/dev/fakea', 10 << 30)}))
+        model.probe()
+        return model, model.get_disk('/dev/fakea')
+
+    def test_add_remove(self):
+        model, disk = self.make_disk()
+        p1 = model.add_partition(disk, disk.next_partnum, 1 << 30)
+        p2 = model.add_partition(disk, disk.next_partnum, 2 << 30)
+        self.assertEqual((p1.number, p2.number), (1, 2))
+        self.assertEqual(disk.used, 3 << 30)
+        self.assertEqual(disk.next_partnum, 3)
+        model.remove_partition(p1)
+        self.assertEqual(disk.used, 2 << 30)
+        self.assertEqual(disk.next_partnum, 1)
+
+    def test_update_partition(self):
+        model, disk = self.make_disk()
+        p = model.add_partition(disk, disk.next_partnum, 1 << 30)
+        model.update_partition(p, 3, 4 << 30)
+        self.assertEqual(disk.used, 4 << 30)
+        self.assertEqual(disk.next_partnum, 1)
+
+    def test_remove_partition_cascades(self):
+        model, disk = self.make_disk()
+        p = model.add_partition(disk, disk.next_partnum, 1 << 30)
+        fs = model.add_filesystem(p, 'ext4')
+        m = model.add_mount(fs, '/')
+        self.assertIs(model.get_object(m.id), m)
+        model.remove_partition(p)
+        self.assertEqual([], model.all_filesystems())
+        self.assertEqual([], model.all_mounts())
+        self.assertIsNone(model.get_object(fs.id))
+        self.assertEqual([asdict(disk)], model.render())
+
+    def test_render_cache_invalidated_on_change(self):
+        model, disk = self.make_disk()
+        p = model.add_partition(disk, disk.next_partnum, 1 << 30)
+        before = model.render()
+        self.assertIs(before[1], model.render()[1])
+        model.update_partition(p, 2, 2 << 30)
+        after = model.render()[1]
+        self.assertEqual((after['number'], after['size']), (2, 2 << 30))
+
+    def test_mount_order_follows_path_changes(self):
+        model, disk = self.make_disk()
+        fs1 = model.add_filesystem(
+            model.add_partition(disk, 1, 1 << 30), 'ext4')
+        fs2 = model.add_filesystem(
+            model.add_partition(disk, 2, 1 << 30), 'ext4')
+        m1 = model.add_mount(fs1, '/')
+        m2 = model.add_mount(fs2, '/srv/data')
+        mounts = [a['path'] for a in model.render() if a['type'] == 'mount']
+        self.assertEqual(mounts, ['/', '/srv/data'])
+        m1.path = '/srv/data/more'
+        m2.path = '/'
+        mounts = [a['path'] for a in model.render() if a['type'] == 'mount']
+        self.assertEqual(mounts, ['/', '/srv/data/more'])
+
+    def test_partitions_placed_in_gaps(self):
+        model, disk = self.make_disk()
+        p1 = model.add_partition(disk, 1, 1 << 30)
+        p2 = model.add_partition(disk, 2, 1 << 30)
+        self.assertEqual(p2.offset, p1.offset + p1.size)
+        model.remove_partition(p1)
+        p3 = model.add_partition(disk, 1, 512 << 20)
+        self.assertEqual(p3.offset, p1.offset)
+        self.assertEqual(model.render()[2]['offset'], p3.offset)
+
+    def test_partitions_follow_disk_topology(self):
+        model, disk = self.make_disk()
+        disk._info.optimal_io_size = 768 << 10
+        disk._info.alignment_offset = 3584
+        self.assertEqual(disk.alignment, 3 << 20)
+        p1 = model.add_partition(disk, 1, 1 << 30)
+        p2 = model.add_partition(disk, 2, 1 << 30)
+        for p in p1, p2:
+            self.assertEqual(p.offset % (3 << 20), 3584)
+            self.assertEqual(p.size % (3 << 20), 0)
+
+
+class TestGuidedDiskChoice(unittest.TestCase):
+
+    def make_model(self):
+        storage = {
+            '/dev/sda': fake_disk_data('/dev/sda', 2000 << 30),
+            '/dev/sdb': fake_disk_data('/dev/sdb', 500 << 30),
+            '/dev/sdc': fake_disk_data('/dev/sdc', 4000 << 30),
+            '/dev/nvme0n1': fake_disk_data('/dev/nvme0n1', 250 << 30),
+            }
+        storage['/dev/sda']['ID_ATA_ROTATION_RATE_RPM'] = '7200'
+        storage['/dev/sdb']['ID_ATA_ROTATION_RATE_RPM'] = '0'
+        storage['/dev/sdc']['ID_BUS'] = 'usb'
+        model = FilesystemModel(FakeProber(storage))
+        model.probe()
+        return model
+
+    def test_ranking(self):
+        model = self.make_model()
+        self.assertEqual(
+            ['/dev/nvme0n1', '/dev/sdb', '/dev/sda', '/dev/sdc'],
+            [d.path for d in model.ranked_disks()])
+
+    def test_policies(self):
+        model = self.make_model()
+        self.assertEqual('/dev/nvme0n1', model.guided_disk('fastest').path)
+        self.assertEqual('/dev/sda', model.guided_disk('largest').path)
+        self.assertEqual('/dev/sdb', model.guided_disk('largest-ssd').path)
+
+    def test_virtio_bus(self):
+        prober = FakeProber({})
+        vda = fake_disk_data('/dev/vda')
+        vda['DEVPATH'] = '/devices/pci0000:00/0000:00:04.0/virtio1/block/vda'
+        vda['MAJOR'] = '252'
+        info = DiskInfo.from_storage_info(
+            prober.get_storage_info('/dev/vda', vda))
+        self.assertEqual(info.bus, 'virtio')
+        dm = fake_disk_data('/dev/dm-0')
+        dm['DEVPATH'] = '/devices/virtual/block/dm-0'
+        dm['MAJOR'] = '253'
+        info = DiskInfo.from_storage_info(
+            prober.get_storage_info('/dev/dm-0', dm))
+        self.assertIsNone(info.bus)
+
+    def test_queue_attrs_from_probe_data(self):
+        data = fake_disk_data('/dev/vda', 100 << 30)
+        data['attrs'].update({
+            'queue/rotational': '0',
+            'queue/physical_block_size': '4096',
+            'queue/minimum_io_size': '4096',
+            'queue/optimal_io_size': '0',
+            'alignment_offset': '0',
+            })
+        model = FilesystemModel(FakeProber({'/dev/vda': data}))
+        model.probe()
+        info = model.get_disk('/dev/vda')._info
+        self.assertIs(info.rotational, False)
+        self.assertEqual(info.physical_block_size, 4096)
+        self.assertEqual(info.optimal_io_size, 0)
+        self.assertEqual(info.alignment_offset, 0)
+
+
+def make_model_with_disks(*sizes):
+    storage = {}
+    for i, size in enumerate(sizes):
+        name = '/dev/fake' + 'abcdefgh'[i]
+        storage[name] = fake_disk_data(name, size)
+    model = FilesystemModel(FakeProber(storage))
+    model.probe()
+    return model
+
+
+class TestRaid(unittest.TestCase):
+
+    def test_raid_size(self):
+        member = (10 << 30) - (8 << 20)
+        self.assertEqual(raid_size(1, [10 << 30, 20 << 30]), member)
+        self.assertEqual(raid_size(0, [10 << 30] * 3), member * 3)
+        self.assertEqual(raid_size(5, [10 << 30] * 4), member * 3)
+        self.assertEqual(raid_size(6, [10 << 30] * 4), member * 2)
+        self.assertEqual(raid_size(10, [10 << 30] * 4), member * 2)
+        with self.assertRaises(ValueError):
+            raid_size(5, [10 << 30] * 2)
+
+    def test_add_raid_renders(self):
+        model = make_model_with_disks(10 << 30, 10 << 30, 10 << 30)
+        disks = model.all_disks()
+        parts = [model.add_partition(d, 1, 5 << 30) for d in disks]
+        raid = model.add_raid(1, parts[:2], parts[2:])
+        self.assertEqual(raid.path, '/dev/md0')
+        self.assertEqual(model.get_empty_partition_names(), [])
+        fs = model.add_filesystem(raid, 'ext4')
+        config = model.render()
+        raid_config = [c for c in config if c['type'] == 'raid'][0]
+        self.assertEqual(
+            raid_config['devices'], [parts[0].id, parts[1].id])
+        self.assertEqual(raid_config['spare_devices'], [parts[2].id])
+        self.assertLess(
+            config.index(raid_config),
+            config.index(fs.render()))
+
+    def test_remove_member_removes_raid(self):
+        model = make_model_with_disks(10 << 30, 10 << 30)
+        raid = model.add_raid(1, model.all_disks())
+        model.add_filesystem(raid, 'ext4')
+        model.del_device('/dev/fakea')
+        self.assertEqual(model.all_raids(), [])
+        self.assertEqual(model.all_filesystems(), [])
+        self.assertIsNone(model.get_disk('/dev/fakeb').constructed_device())
+
+
+class TestLVM(unittest.TestCase):
+
+    def test_extent_accounting(self):
+        model = make_model_with_disks(10 << 30, 10 << 30, 10 << 30)
+        vg = model.add_volgroup('vg0', model.all_disks())
+        per_pv = ((10 << 30) - (2 << 20) - (1 << 20)) // (4 << 20)
+        self.assertEqual(vg.extents, 3 * per_pv)
+        lv = model.add_logical_volume(vg, 'data', (12 << 30) + 1)
+        self.assertEqual(lv.size, (12 << 30) + (4 << 20))
+        self.assertEqual(
+            [vg.pv_free_extents(pv) for pv in vg.devices],
+            [0, 2 * per_pv - lv.size // (4 << 20), per_pv])
+        with self.assertRaises(Exception):
+            model.add_logical_volume(vg, 'big', 25 << 30)
+        model.remove_logical_volume(lv)
+        self.assertEqual(vg.free_extents, vg.extents)
+
+    def test_render(self):
+        model = make_model_with_disks(10 << 30, 10 << 30)
+        vg = model.add_volgroup('vg0', model.all_disks())
+        lv = model.add_logical_volume(vg, 'root', 4 << 30)
+        model.add_mount(model.add_filesystem(lv, 'ext4'), '/')
+        types = [c['type'] for c in model.render()]
+        self.assertEqual(
+            types,
+            ['disk', 'disk', 'lvm_volgroup', 'lvm_partition', 'format',
+             'mount'])
+        self.assertEqual(lv.path, '/dev/vg0/root')
+        model.del_device('/dev/fakeb')
+        self.assertEqual(model.all_volgroups(), [])
+        self.assertEqual(model.all_mounts(), [])
+
+
+class TestBcache(unittest.TestCase):
+
+    def test_shared_cache(self):
+        model = make_model_with_disks(100 << 30, 100 << 30, 10 << 30)
+        hdd1, hdd2, ssd = model.all_disks()
+        b1 = model.add_bcache(hdd1, ssd, 'writeback')
+        b2 = model.add_bcache(hdd2, ssd)
+        self.assertEqual((b1.path, b2.path), ('/dev/bcache0', '/dev/bcache1'))
+        self.assertEqual(model.get_bcache_cachedevs(), [ssd.path])
+        fs = model.add_filesystem(b1, 'ext4')
+        config = [c for c in model.render() if c['type'] == 'bcache']
+        self.assertEqual(
+            config[0],
+            {'id': b1.id, 'type': 'bcache', 'name': 'bcache0',
+             'backing_device': hdd1.id, 'cache_device': ssd.id,
+             'cache_mode': 'writeback'})
+        model.remove_bcache(b1)
+        self.assertIs(ssd.constructed_device(), b2)
+        self.assertIsNone(hdd1.constructed_device())
+        self.assertNotIn(fs, model.all_filesystems())
+        model.del_device(ssd.path)
+        self.assertEqual(model.all_bcaches(), [])
+        self.assertIsNone(hdd2.constructed_device())
+
+
+class TestMkfsTuning(unittest.TestCase):
+
+    def test_raid5_ext4(self):
+        model = make_model_with_disks(*[10 << 30] * 4)
+        raid = model.add_raid(5, model.all_disks())
+        fs = model.add_filesystem(raid, 'ext4')
+        self.assertEqual(
+            fs.extra_options, ['-E', 'stride=128,stripe_width=384'])
+        model.add_mount(fs, '/srv')
+        self.assertEqual(
+            fs.render()['extra_options'],
+            ['-E', 'stride=128,stripe_width=384', '-i', '65536'])
+
+    def test_override(self):
+        model = make_model_with_disks(10 << 30)
+        model.mkfs_overrides = {'/': '-m 1'}
+        disk = model.all_disks()[0]
+        disk._info.rotational = False
+        fs = model.add_filesystem(disk, 'xfs')
+        self.assertIsNone(fs.extra_options)
+        model.add_mount(fs, '/')
+        self.assertEqual(fs.extra_options, ['-m', '1'])
+
+
+class TestMountProfiles(unittest.TestCase):
+
+    def test_suggested_and_explicit(self):
+        model = make_model_with_disks(10 << 30, 10 << 30)
+        ssd, hdd = model.all_disks()
+        ssd._info.rotational = False
+        hdd._info.rotational = True
+        m1 = model.add_mount(model.add_filesystem(ssd, 'btrfs'), '/')
+        m2 = model.add_mount(model.add_filesystem(hdd, 'ext4'), '/srv')
+        self.assertEqual(m1.options, 'noatime,discard=async')
+        self.assertEqual(m2.render()['options'], 'noatime,commit=60')
+        model.remove_mount(m2)
+        m2 = model.add_mount(hdd.fs(), '/srv', 'defaults')
+        self.assertNotIn('options', m2.render())
+
+
+class TestPreserveExisting(unittest.TestCase):
+
+    def make_model(self):
+        disk = fake_disk_data('/dev/fakea', 100 << 30)
+        disk['ID_PART_TABLE_TYPE'] = 'gpt'
+        devpath = disk['DEVPATH']
+        storage = {
+            '/dev/fakea': disk,
+            '/dev/fakea1': {
+                'DEVPATH': devpath + '/fakea1',
+                'DEVTYPE': 'partition',
+                'ID_PART_ENTRY_NUMBER': '1',
+                'ID_PART_ENTRY_OFFSET': '2048',
+                'ID_PART_ENTRY_SIZE': '1048576',
+                'ID_PART_ENTRY_TYPE': 'c12a7328-f81f-11d2-ba4b-00a0c93ec93b',
+                'ID_FS_TYPE': 'vfat',
+                'ID_FS_VERSION': 'FAT32',
+                },
+            '/dev/fakea2': {
+                'DEVPATH': devpath + '/fakea2',
+                'DEVTYPE': 'partition',
+                'ID_PART_ENTRY_NUMBER': '2',
+                'ID_PART_ENTRY_OFFSET': '1050624',
+                'ID_PART_ENTRY_SIZE': '104857600',
+                'ID_FS_TYPE': 'ext4',
+                'ID_FS_UUID': 'data-uuid',
+                },
+            }
+        model = FilesystemModel(FakeProber(storage))
+        model.probe()
+        return model
+
+    def test_preserve_existing(self):
+        model = self.make_model()
+        disk = model.get_disk('/dev/fakea')
+        model.preserve_existing(disk)
+        esp, data = disk.partitions()
+        self.assertEqual((esp.flag, esp.fs().fstype), ('boot', 'fat32'))
+        self.assertEqual((data.offset, data.size), (1050624 * 512, 50 << 30))
+        model.add_mount(data.fs(), '/srv')
+        config = model.render()
+        self.assertTrue(config[0]['preserve'])
+        self.assertEqual(
+            [c.get('preserve', False) for c in config],
+            [True, True, True, True, True, False])
+        self.assertEqual(config[4]['uuid'], 'data-uuid')
+        self.assertEqual(disk.free, disk.size - esp.size - data.size)
+        p = model.add_partition(disk, disk.next_partnum, 10 << 30)
+        self.assertEqual(p.offset, data.offset + data.size)
+
+    def test_keep_or_reformat_preserved_filesystem(self):
+        model = self.make_model()
+        disk = model.get_disk('/dev/fakea')
+        model.preserve_existing(disk)
+        data = disk.partitions()[1]
+        fs = data.fs()
+        model.update_partition(data, data.number, data.size)
+        self.assertIs(model.set_format(data, 'ext4', '/srv', keep=True), fs)
+        self.assertIs(model.set_format(data, 'ext4', '/home', keep=True), fs)
+        [rendered] = [c for c in model.render() if c['id'] == fs.id]
+        self.assertTrue(rendered['preserve'])
+        self.assertEqual(
+            model.get_mountpoint_to_devpath_mapping(),
+            {'/home': data.path})
+        # Formatting it as the same type still reformats it.
+        new_fs = model.set_format(data, 'ext4', '/')
+        self.assertIsNot(new_fs, fs)
+        [rendered] = [c for c in model.render() if c['id'] == new_fs.id]
+        self.assertFalse(rendered.get('preserve', False))
+        self.assertEqual(
+            model.get_mountpoint_to_devpath_mapping(), {'/': data.path})
+        self.assertIsNone(model.set_format(data, None))
+        self.assertIsNone(data.fs())
+
+    def test_preserved_partitions_keep_their_place(self):
+        model = self.make_model()
+        disk = model.get_disk('/dev/fakea')
+        model.preserve_existing(disk)
+        esp, data = disk.partitions()
+        with self.assertRaises(Exception):
+            model.remove_partition(data)
+        with self.assertRaises(Exception):
+            model.update_partition(data, data.number, 10 << 30)
+        with self.assertRaises(Exception):
+            model.update_partition(data, 5, data.size)
+        self.assertEqual(disk.partitions(), [esp, data])
+        p = model.add_partition(disk, disk.next_partnum, 10 << 30)
+        self.assertEqual(p.offset, data.offset + data.size)
+        # Starting over still clears the disk.
+        model.preserve_existing(disk)
+        self.assertEqual(len(disk.partitions()), 2)
+
+    def test_new_partitions_aligned_after_preserved(self):
+        model = self.make_model()
+        disk = model.get_disk('/dev/fakea')
+        disk._info.optimal_io_size = 4 << 20
+        self.assertEqual(disk.alignment, 4 << 20)
+        model.preserve_existing(disk)
+        esp, data = disk.partitions()
+        # The existing partitions do not follow the disk's alignment.
+        self.assertNotEqual((data.offset + data.size) % (4 << 20), 0)
+        p = model.add_partition(disk, disk.next_partnum, 10 << 30)
+        self.assertEqual(p.offset % (4 << 20), 0)
+        self.assertGreaterEqual(p.offset, data.offset + data.size)
+        self.assertEqual(disk.largest_free_extent % (4 << 20), 0)
+        rest = model.add_partition(
+            disk, disk.next_partnum, disk.largest_free_extent)
+        self.assertEqual(rest.offset % (4 << 20), 0)
+
+    def test_uefi_mounts_esp(self):
+        model = self.make_model()
+        disk = model.get_disk('/dev/fakea')
+        model.preserve_existing(disk)
+        self.assertEqual(model.get_mountpoint_to_devpath_mapping(), {})
+        model.preserve_existing(disk, uefi=True)
+        esp = disk.partitions()[0]
+        self.assertEqual(
+            model.get_mountpoint_to_devpath_mapping(),
+            {'/boot/efi': esp.path})
+        self.assertTrue(esp.fs().preserve)
+
+
+class TestMultipath(unittest.TestCase):
+
+    def test_paths_grouped_under_map(self):
+        wwid = '3600508b400105e210000900000490000'
+        storage = {}
+        for name in '/dev/fakea', '/dev/fakeb':
+            data = storage[name] = fake_disk_data(name)
+            data['ID_SERIAL'] = wwid
+            data['DM_MULTIPATH_DEVICE_PATH'] = '1'
+        storage['/dev/fakec'] = fake_disk_data('/dev/fakec')
+        mpath = storage['/dev/dm-0'] = fake_disk_data('/dev/dm-0')
+        mpath['DEVPATH'] = '/devices/virtual/block/dm-0'
+        mpath['DM_UUID'] = 'mpath-' + wwid
+        mpath['DM_NAME'] = 'mpatha'
+        prober = FakeProber(storage)
+        fetched = []
+        get_storage_info = prober.get_storage_info
+
+        def record(path, data=None):
+            fetched.append(path)
+            return get_storage_info(path, data)
+        prober.get_storage_info = record
+        model = FilesystemModel(prober)
+        model.probe()
+        self.assertEqual(
+            sorted(d.path for d in model.all_disks()),
+            ['/dev/dm-0', '/dev/fakec'])
+        self.assertEqual(sorted(fetched), ['/dev/dm-0', '/dev/fakec'])
+        disk = model.get_disk('/dev/dm-0')
+        self.assertEqual(disk._info.paths, ('/dev/fakea', '/dev/fakeb'))
+        model.del_device('/dev/fakea')
+        self.assertEqual(disk._info.paths, ('/dev/fakeb',))
+
+    def test_hotplugged_path_joins_map(self):
+        wwid = '3600508b400105e210000900000490000'
+        storage = {'/dev/fakea': fake_disk_data('/dev/fakea')}
+        mpath = storage['/dev/dm-0'] = fake_disk_data('/dev/dm-0')
+        mpath['DEVPATH'] = '/devices/virtual/block/dm-0'
+        mpath['DM_UUID'] = 'mpath-' + wwid
+        mpath['DM_NAME'] = 'mpatha'
+        model = FilesystemModel(FakeProber(storage))
+        model.probe()
+        # Only the map holding the new path says which LUN it leads to.
+        index = BlockIndex(None, None, None)
+        index.devices['fakeb'] = BlockDevice(name='fakeb', holders=['dm-0'])
+        model._scan_block_devices = lambda: index
+        data = storage['/dev/fakeb'] = fake_disk_data('/dev/fakeb')
+        model.new_device('/dev/fakeb', data)
+        self.assertEqual(
+            sorted(d.path for d in model.all_disks()),
+            ['/dev/dm-0', '/dev/fakea'])
+        self.assertEqual(
+            model.get_disk('/dev/dm-0')._info.paths, ('/dev/fakeb',))
+
+    def test_same_serial_not_grouped(self):
+        storage = {}
+        for name in '/dev/sda', '/dev/sdb':
+            data = storage[name] = fake_disk_data(name)
+            data['ID_BUS'] = 'usb'
+            data['ID_SERIAL'] = 'Generic_External_000000000001'
+            data['ID_WWN'] = '0x5000000000000001'
+        model = FilesystemModel(FakeProber(storage))
+        model.probe()
+        self.assertEqual(
+            sorted(d.path for d in model.all_disks()),
+            ['/dev/sda', '/dev/sdb'])
+        for disk in model.all_disks():
+            self.assertIsNone(disk._info.wwid)
+
+    def test_partition_paths(self):
+        storage = {
+            '/dev/sda': fake_disk_data('/dev/sda'),
+            '/dev/nvme0n1': fake_disk_data('/dev/nvme0n1'),
+            '/dev/dm-0': fake_disk_data('/dev/dm-0'),
+            }
+        mpath = storage['/dev/dm-0']
+        mpath['DEVPATH'] = '/devices/virtual/block/dm-0'
+        mpath['DM_UUID'] = 'mpath-3600508b400105e210000900000490000'
+        mpath['DM_NAME'] = 'mpatha'
+        model = FilesystemModel(FakeProber(storage))
+        model.probe()
+        paths = {}
+        for disk in model.all_disks():
+            paths[disk.path] = model.add_partition(disk, 1, 1 << 30).path
+        self.assertEqual(paths, {
+            '/dev/sda': '/dev/sda1',
+            '/dev/nvme0n1': '/dev/nvme0n1p1',
+            '/dev/dm-0': '/dev/mapper/mpatha-part1',
+            })
+
+
+class TestSwap(unittest.TestCase):
+
+    def test_swap_partition(self):
+        model = make_model_with_disks(100 << 30)
+        disk = model.all_disks()[0]
+        part = model.add_partition(disk, 1, disk.free - (4 << 30))
+        model.add_mount(model.add_filesystem(part, 'ext4'), '/')
+        fs = model.add_swap(disk, 4 << 30)
+        self.assertEqual(fs.fstype, 'swap')
+        self.assertEqual(fs.volume.number, 2)
+        self.assertIsNone(model.render_swap())
+
+    def test_swapfile(self):
+        model = make_model_with_disks(100 << 30)
+        model.swap_kind = 'file'
+        disk = model.all_disks()[0]
+        self.assertIsNone(model.add_swap(disk, 4 << 30))
+        # No swap file without a / to put it on.
+        self.assertIsNone(model.render_swap())
+        part = model.add_partition(disk, 1, disk.free)
+        model.add_mount(model.add_filesystem(part, 'ext4'), '/')
+        self.assertEqual(
+            model.render_swap(), {'filename': '/swap.img', 'size': 4 << 30})
+        model.reset()
+        self.assertIsNone(model.render_swap())
+
+    def test_no_swap_policy(self):
+        model = make_model_with_disks(100 << 30)
+        self.assertIsNone(model.render_swap())
+        model.swap_policy = 'none'
+        self.assertEqual(model.render_swap(), {'size': 0})
+
+
+class TestJournal(unittest.TestCase):
+
+    def build(self, model):
+        disk1, disk2 = model.all_disks()
+        p1 = model.add_partition(disk1, 1, 10 << 30)
+        p2 = model.add_partition(disk2, 1, 10 << 30)
+        model.add_mount(model.add_filesystem(p1, 'ext4'), '/')
+        raid = model.add_raid(1, [model.add_partition(disk1, 2, 5 << 30),
+                                  model.add_partition(disk2, 2, 5 << 30)])
+        vg = model.add_volgroup('vg0', [raid])
+        lv = model.add_logical_volume(vg, 'lv0', 1 << 30)
+        model.add_mount(model.add_filesystem(lv, 'xfs'), '/srv')
+        model.remove_partition(p2)
+        model.update_partition(p1, 1, 12 << 30)
+
+    def state(self, model):
+        return (
+            model.render(),
+            [(d.path, d.free, d.next_partnum) for d in model.all_disks()],
+            model.get_mountpoint_to_devpath_mapping(),
+            )
+
+    def test_undo_redo_all(self):
+        model = make_model_with_disks(100 << 30, 100 << 30)
+        before = self.state(model)
+        self.build(model)
+        after = self.state(model)
+        undone = 0
+        while model.undo():
+            undone += 1
+        self.assertEqual(undone, 13)
+        self.assertEqual(self.state(model), before)
+        while model.redo():
+            pass
+        self.assertEqual(self.state(model), after)
+
+    def test_undo_reset(self):
+        model = make_model_with_disks(100 << 30, 100 << 30)
+        self.build(model)
+        after = self.state(model)
+        model.reset()
+        self.assertEqual(model.render(), [])
+        model.undo()
+        self.assertEqual(self.state(model), after)
+
+    def test_failed_step_rolled_back(self):
+        model = make_model_with_disks(100 << 30)
+        disk = model.all_disks()[0]
+        before = self.state(model)
+        with self.assertRaises(Exception):
+            with model.journal.step():
+                model.add_partition(disk, 1, 10 << 30)
+                model.add_partition(disk, 2, 1 << 40)
+        self.assertEqual(self.state(model), before)
+        self.assertFalse(model.journal.can_undo())
+
+    def test_step_size_independent_of_model_size(self):
+        sizes = []
+        for count in 1, 50:
+            model = make_model_with_disks(1 << 40, 100 << 30)
+            big, small = model.all_disks()
+            for i in range(count):
+                model.add_partition(big, i + 1, 1 << 30)
+            model.add_partition(small, 1, 1 << 30)
+            sizes.append(len(model.journal._undo[-1]))
+        self.assertEqual(sizes[0], sizes[1])
+
+    def test_device_events_not_undone(self):
+        model = make_model_with_disks(10 << 30)
+        disk = model.all_disks()[0]
+        model.add_partition(disk, 1, 1 << 30)
+        model.update_device(disk.path, fake_disk_data(disk.path, 20 << 30))
+        model.undo()
+        self.assertEqual(disk._info.size, 20 << 30)
+        self.assertEqual(disk.free, disk.size)
+
+
+class TestLayout(unittest.TestCase):
+
+    template = {
+        'disks': [
+            {'name': 'os', 'match': {'max-size': '100G'}, 'boot': True,
+             'partitions': [
+                 {'size': '20G', 'fstype': 'ext4', 'mount': '/'},
+                 {'size': '10%', 'fstype': 'swap'},
+                 {'size': 'rest', 'name': 'os-rest'},
+                 ]},
+            {'match': {'min-size': '1T', 'serial': 'serial-fake*'},
+             'count': 'all', 'partitions': [{'name': 'member'}]},
+            ],
+        'raids': [{'name': 'md0', 'level': 5, 'devices': ['member']}],
+        'volgroups': [
+            {'name': 'vg0', 'devices': ['md0'], 'volumes': [
+                {'name': 'srv', 'size': 'rest', 'fstype': 'xfs',
+                 'mount': '/srv'},
+                {'name': 'home', 'size': '100G', 'fstype': 'ext4',
+                 'mount': '/home'},
+                ]},
+            ],
+        }
+
+    def test_apply(self):
+        model = make_model_with_disks(2 << 40, 50 << 30, 2 << 40, 2 << 40)
+        model.apply_layout(self.template)
+        os_disk = model.get_disk('/dev/fakeb')
+        self.assertTrue(os_disk.grub_device)
+        self.assertEqual(
+            [p.flag for p in os_disk.partitions()],
+            ['bios_grub', '', '', ''])
+        self.assertEqual(os_disk.free, 0)
+        raid, = model.all_raids()
+        self.assertEqual(
+            sorted(p.device.path for p in raid.devices),
+            ['/dev/fakea', '/dev/fakec', '/dev/faked'])
+        self.assertEqual(
+            sorted(model.get_mountpoint_to_devpath_mapping()),
+            ['/', '/home', '/srv'])
+        vg, = model.all_volgroups()
+        self.assertEqual(vg.free, 0)
+
+    def test_no_match_leaves_model_alone(self):
+        model = make_model_with_disks(2 << 40, 50 << 30)
+        disk = model.all_disks()[0]
+        model.add_partition(disk, 1, 1 << 30)
+        before = model.render()
+        with self.assertRaises(Exception):
+            model.apply_layout(self.template)
+        self.assertEqual(model.render(), before)
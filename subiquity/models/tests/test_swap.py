@@ -0,0 +1,27 @@
+import unittest
+
+from subiquity.models.swap import GiB, swap_size
+
+
+class TestSwapSize(unittest.TestCase):
+
+    disk = 1000 * GiB
+
+    def test_ratio_shrinks_with_ram(self):
+        self.assertEqual(swap_size('ratio', 1 * GiB, self.disk), 2 * GiB)
+        self.assertEqual(swap_size('ratio', 4 * GiB, self.disk), 4 * GiB)
+        self.assertEqual(swap_size('ratio', 32 * GiB, self.disk), 4 * GiB)
+        self.assertEqual(swap_size('ratio', 512 * GiB, self.disk), 8 * GiB)
+
+    def test_hibernate_holds_ram(self):
+        self.assertEqual(swap_size('hibernate', 16 * GiB, self.disk), 20 * GiB)
+
+    def test_limits(self):
+        self.assertEqual(swap_size('none', 1 * GiB, self.disk), 0)
+        self.assertEqual(swap_size('ratio', 1 * GiB, 4 * GiB), 0)
+        self.assertEqual(swap_size('ratio', 4 * GiB, 10 * GiB), 2560 << 20)
+        self.assertEqual(swap_size('ratio', None, self.disk), 0)
+        self.assertEqual(
+            swap_size('fixed', None, self.disk, fixed_size=3 * GiB), 3 * GiB)
+        with self.assertRaises(ValueError):
+            swap_size('lots', 1 * GiB, self.disk)
@@ -0,0 +1,81 @@
+import unittest
+
+from subiquity.models.validation import StorageValidator
+
+
+def disk(id, **kw):
+    return dict(id=id, type='disk', ptable='gpt', path='/dev/' + id, **kw)
+
+
+def part(id, device, number, offset, size, **kw):
+    return dict(
+        id=id, type='partition', device=device, number=number,
+        offset=offset, size=size, **kw)
+
+
+def fs(id, volume, fstype='ext4'):
+    return dict(id=id, type='format', volume=volume, fstype=fstype)
+
+
+def mount(id, device, path):
+    return dict(id=id, type='mount', device=device, path=path)
+
+
+class TestStorageValidator(unittest.TestCase):
+
+    validator = StorageValidator()
+
+    def bios_config(self):
+        return [
+            disk('sda', grub_device=True),
+            part('p1', 'sda', 1, 1 << 20, 1 << 20, flag='bios_grub'),
+            part('p2', 'sda', 2, 2 << 20, 10 << 20),
+            fs('fs1', 'p2'),
+            mount('m1', 'fs1', '/'),
+            ]
+
+    def test_valid(self):
+        self.assertEqual(
+            self.validator.validate(
+                self.bios_config(), disk_sizes={'sda': 100 << 20}), [])
+
+    def test_schema(self):
+        config = self.bios_config()
+        del config[2]['size']
+        config[3]['colour'] = 'red'
+        errors = self.validator.validate(config)
+        self.assertEqual(len(errors), 2)
+        self.assertIn("'size' is a required property", errors[0])
+        self.assertIn("'colour' was unexpected", errors[1])
+
+    def test_references(self):
+        config = self.bios_config()
+        config.append(mount('m2', 'p1', '/boot'))
+        config.append(fs('fs2', 'p9'))
+        self.assertEqual(self.validator.validate(config), [
+            "m2 device: p1 is a partition, not a format",
+            "fs2 volume: p9 is not defined before it",
+            ])
+
+    def test_sizes(self):
+        config = self.bios_config()
+        config.append(part('p3', 'sda', 3, 5 << 20, 10 << 20))
+        self.assertEqual(
+            self.validator.validate(config, disk_sizes={'sda': 12 << 20}), [
+                "p3 overlaps p2",
+                "p3 ends 3145728 bytes past the end of sda",
+                ])
+
+    def test_mounts_and_boot(self):
+        config = self.bios_config()
+        del config[0]['grub_device']
+        config[-1]['path'] = '/srv'
+        config.append(mount('m2', 'fs1', '/srv'))
+        self.assertEqual(self.validator.validate(config), [
+            "/srv is mounted 2 times",
+            "nothing is mounted at /",
+            "no disk has grub_device set",
+            ])
+        self.assertEqual(
+            self.validator.validate(self.bios_config(), uefi=True),
+            ["there is no EFI system partition mounted at /boot/efi"])
@@ -0,0 +1,256 @@
+# Copyright 2018 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Check a curtin storage config before curtin is run with it, so that
+# mistakes are reported while the user can still fix them rather than
+# part of the way through an install.
+#
+# The schemas follow the storage config format documented by curtin.
+
+import collections
+import logging
+
+import jsonschema
+
+
+log = logging.getLogger('subiquity.models.validation')
+
+_id = {'type': 'string', 'minLength': 1}
+_ids = {'type': 'array', 'items': _id}
+_size = {
+    'oneOf': [
+        {'type': 'integer', 'minimum': 0},
+        {'type': 'string', 'pattern': r'^[0-9]+(\.[0-9]+)?[BKMGTPbkmgtp]?$'},
+        ],
+    }
+_common = {
+    'id': _id,
+    'type': {'type': 'string'},
+    'name': {'type': 'string'},
+    'preserve': {'type': 'boolean'},
+    }
+
+
+def _entry(required, **properties):
+    return {
+        'type': 'object',
+        'required': ['id', 'type'] + required,
+        'properties': dict(_common, **properties),
+        'additionalProperties': False,
+        }
+
+
+STORAGE_SCHEMAS = {
+    'disk': _entry(
+        [],
+        ptable={'enum': ['gpt', 'msdos', 'vtoc', 'unsupported']},
+        serial={'type': 'string'},
+        path={'type': 'string'},
+        model={'type': 'string'},
+        wipe={'enum': ['superblock', 'superblock-recursive', 'zero',
+                       'random', 'pvremove']},
+        grub_device={'type': 'boolean'},
+        ),
+    'partition': _entry(
+        ['device', 'size'],
+        number={'type': 'integer', 'minimum': 1},
+        device=_id,
+        size=_size,
+        offset=_size,
+        wipe={'enum': ['superblock', 'superblock-recursive', 'zero',
+                       'random', 'pvremove']},
+        flag={'enum': ['logical', 'extended', 'boot', 'bios_grub', 'swap',
+                       'lvm', 'raid', 'home', 'prep', 'msftres']},
+        ),
+    'raid': _entry(
+        ['name', 'raidlevel', 'devices'],
+        raidlevel={'enum': [0, 1, 4, 5, 6, 10]},
+        devices=dict(_ids, minItems=1),
+        spare_devices=_ids,
+        ),
+    'bcache': _entry(
+        ['backing_device', 'cache_device'],
+        backing_device=_id,
+        cache_device=_id,
+        cache_mode={'enum': ['writethrough', 'writeback', 'writearound',
+                             'none']},
+        ),
+    'lvm_volgroup': _entry(
+        ['name', 'devices'],
+        devices=dict(_ids, minItems=1),
+        ),
+    'lvm_partition': _entry(
+        ['name', 'volgroup'],
+        volgroup=_id,
+        size=_size,
+        ),
+    'format': _entry(
+        ['fstype', 'volume'],
+        fstype={'type': 'string', 'minLength': 1},
+        volume=_id,
+        label={'type': 'string'},
+        uuid={'type': 'string'},
+        extra_options={'type': 'array', 'items': {'type': 'string'}},
+        ),
+    'mount': _entry(
+        ['device', 'path'],
+        device=_id,
+        path={'type': 'string', 'pattern': '^(/|none$)'},
+        options={'type': 'string'},
+        ),
+    }
+
+# The keys of each type of entry that refer to other entries, and the
+# types of entry they may refer to.
+_VOLUMES = ('disk', 'partition', 'raid', 'bcache', 'lvm_partition')
+REFERENCES = {
+    'partition': {'device': ('disk', 'raid')},
+    'raid': {'devices': _VOLUMES, 'spare_devices': _VOLUMES},
+    'bcache': {'backing_device': _VOLUMES, 'cache_device': _VOLUMES},
+    'lvm_volgroup': {'devices': _VOLUMES},
+    'lvm_partition': {'volgroup': ('lvm_volgroup',)},
+    'format': {'volume': _VOLUMES},
+    'mount': {'device': ('format',)},
+    }
+
+
+class StorageValidator:
+    """Checks storage configs against the schemas and for consistency.
+
+    Compiling the schemas takes a moment, so make one of these when
+    starting up and use it for every check.
+    """
+
+    def __init__(self):
+        self._validators = {}
+        for entry_type, schema in STORAGE_SCHEMAS.items():
+            jsonschema.Draft4Validator.check_schema(schema)
+            self._validators[entry_type] = jsonschema.Draft4Validator(schema)
+
+    def validate(self, config, uefi=False, disk_sizes=None):
+        """Return a list of the problems with the storage config.
+
+        config is the list of entries under storage: config. disk_sizes,
+        if given, maps disk ids to their size in bytes.
+        """
+        errors = []
+        by_id = collections.OrderedDict()
+        for entry in config:
+            errors.extend(self._check_entry(entry, by_id))
+            if isinstance(entry, dict) and 'id' in entry:
+                by_id.setdefault(entry['id'], entry)
+        if errors:
+            # The checks below assume every entry is well formed.
+            return errors
+        errors.extend(self._check_partitions(by_id, disk_sizes or {}))
+        errors.extend(self._check_mounts(by_id))
+        errors.extend(self._check_boot(by_id, uefi))
+        return errors
+
+    def _check_entry(self, entry, by_id):
+        if not isinstance(entry, dict):
+            return ["{!r} is not a mapping".format(entry)]
+        validator = self._validators.get(entry.get('type'))
+        eid = entry.get('id', '?')
+        if validator is None:
+            return ["{}: unknown type {!r}".format(eid, entry.get('type'))]
+        errors = []
+        for error in validator.iter_errors(entry):
+            where = '.'.join(str(p) for p in error.path)
+            if where:
+                where = ' ' + where
+            errors.append("{}{}: {}".format(eid, where, error.message))
+        if errors:
+            return errors
+        if eid in by_id:
+            errors.append("{}: id is used more than once".format(eid))
+        for key, types in REFERENCES.get(entry['type'], {}).items():
+            refs = entry.get(key, [])
+            if not isinstance(refs, list):
+                refs = [refs]
+            for ref in refs:
+                target = by_id.get(ref)
+                if target is None:
+                    errors.append(
+                        "{} {}: {} is not defined before it".format(
+                            eid, key, ref))
+                elif target['type'] not in types:
+                    errors.append(
+                        "{} {}: {} is a {}, not a {}".format(
+                            eid, key, ref, target['type'],
+                            ' or '.join(types)))
+        return errors
+
+    def _check_partitions(self, by_id, disk_sizes):
+        errors = []
+        extents = collections.defaultdict(list)
+        for entry in by_id.values():
+            if entry['type'] != 'partition':
+                continue
+            offset, size = entry.get('offset'), entry['size']
+            if not isinstance(offset, int) or not isinstance(size, int):
+                continue
+            # Logical partitions live inside the extended one, so they
+            # are only compared with each other.
+            logical = entry.get('flag') == 'logical'
+            extents[entry['device'], logical].append(
+                (offset, offset + size, entry['id']))
+        for (device, logical), parts in extents.items():
+            parts.sort()
+            for (s1, e1, id1), (s2, e2, id2) in zip(parts, parts[1:]):
+                if s2 < e1:
+                    errors.append("{} overlaps {}".format(id2, id1))
+            disk_size = disk_sizes.get(device)
+            if disk_size is not None:
+                for start, end, pid in parts:
+                    if end > disk_size:
+                        errors.append(
+                            "{} ends {} bytes past the end of {}".format(
+                                pid, end - disk_size, device))
+        return errors
+
+    def _check_mounts(self, by_id):
+        errors = []
+        paths = collections.Counter(
+            e['path'] for e in by_id.values()
+            if e['type'] == 'mount' and e['path'] != 'none')
+        for path, count in sorted(paths.items()):
+            if count > 1:
+                errors.append("{} is mounted {} times".format(path, count))
+        if paths['/'] == 0:
+            errors.append("nothing is mounted at /")
+        formats = collections.Counter(
+            e['volume'] for e in by_id.values() if e['type'] == 'format')
+        for volume, count in sorted(formats.items()):
+            if count > 1:
+                errors.append(
+                    "{} is formatted {} times".format(volume, count))
+        return errors
+
+    def _check_boot(self, by_id, uefi):
+        if uefi:
+            for e in by_id.values():
+                if e['type'] != 'mount' or e['path'] != '/boot/efi':
+                    continue
+                fs = by_id[e['device']]
+                volume = by_id[fs['volume']]
+                if (fs['fstype'] == 'fat32' and
+                        volume.get('flag') == 'boot'):
+                    return []
+            return ["there is no EFI system partition mounted at /boot/efi"]
+        for e in by_id.values():
+            if e['type'] == 'disk' and e.get('grub_device'):
+                return []
+        return ["no disk has grub_device set"]
@@ -19,12 +19,13 @@ from .filesystem import (FilesystemView,  # NOQA
                          DiskPartitionView,
                          DiskInfoView,
                          GuidedDiskSelectionView,
-                         GuidedFilesystemView)
+                         GuidedFilesystemView,
+                         ProbingView)
 from .bcache import BcacheView  # NOQA
 from .raid import RaidView  # NOQA
 from .ceph import CephDiskView  # NOQA
 from .iscsi import IscsiDiskView  # NOQA
-from .lvm import LVMVolumeGroupView  # NOQA
+from .lvm import LVMVolumeGroupView, LogicalVolumeView  # NOQA
 from .identity import IdentityView  # NOQA
 from .installpath import InstallpathView  # NOQA
 from .installprogress import ProgressView  # NOQA
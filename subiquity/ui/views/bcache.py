@@ -22,7 +22,7 @@ from subiquitycore.ui.container import ListBox, Pile
 from subiquitycore.ui.interactive import Selector
 from subiquitycore.ui.utils import Color, Padding
 
-from subiquity.models.filesystem import humanize_size
+from subiquity.models.filesystem import BCACHE_CACHE_MODES, humanize_size
 
 log = logging.getLogger('subiquity.ui.bcache')
 
@@ -35,11 +35,17 @@ class BcacheView(BaseView):
             'CACHE': None,
             'BACKING': None,
         }
+        self.cache_mode = Selector(BCACHE_CACHE_MODES)
         body = [
             Padding.center_50(self._build_disk_selection(section='CACHE')),
             Padding.line_break(""),
             Padding.center_50(self._build_disk_selection(section='BACKING')),
             Padding.line_break(""),
+            Padding.center_50(Pile([
+                Text("CACHE MODE"),
+                Color.string_input(self.cache_mode),
+                ])),
+            Padding.line_break(""),
             Padding.fixed_10(self._build_buttons())
         ]
         super().__init__(ListBox(body))
@@ -66,8 +72,8 @@ class BcacheView(BaseView):
 
         avail_devs = self._get_available_devs(section)
         if len(avail_devs) == 0:
-            return items.append(
-                [Color.info_minor(Text("No available disks."))])
+            items.append(Color.info_minor(Text("No available disks.")))
+            return Pile(items)
 
         selector = Selector(avail_devs)
         self.selected_disks[section] = selector
@@ -78,10 +84,8 @@ class BcacheView(BaseView):
     def _get_available_devs(self, section):
         devs = []
 
-        # bcache can use empty whole disks, or empty partitions
-        avail_disks = self.model.get_empty_disk_names()
-        avail_parts = self.model.get_empty_partition_names()
-        input_disks = avail_disks + avail_parts
+        # bcache can use empty whole disks, partitions, RAIDs and bcaches
+        input_disks = self.model.get_empty_device_names()
         if section == 'CACHE':
             input_disks += self.model.get_bcache_cachedevs()
 
@@ -96,19 +100,13 @@ class BcacheView(BaseView):
                              if dev not in filter_disks])
 
         for dname in avail_devs:
-            device = self.model.get_disk(dname)
-            if device.path != dname:
-                # we've got a partition
-                bcachedev = device.get_partition(dname)
-            else:
-                bcachedev = device
-
+            bcachedev = self.model.get_device(dname)
             disk_sz = humanize_size(bcachedev.size)
             disk_string = "{}     {},     {}".format(dname,
                                                      disk_sz,
-                                                     device.model)
+                                                     bcachedev.desc())
             log.debug('bcache: disk_string={}'.format(disk_string))
-            devs.append(disk_string)
+            devs.append((disk_string, True, dname))
 
         return devs
 
@@ -124,6 +122,7 @@ class BcacheView(BaseView):
         result = {
             'backing_device': self.backing_disk,
             'cache_device': self.cache_disk,
+            'cache_mode': self.cache_mode.value,
         }
         if not result['backing_device']:
             log.debug('Must select a backing device to create a bcache dev')
@@ -136,10 +135,8 @@ class BcacheView(BaseView):
             return
 
         log.debug('bcache_done: result = {}'.format(result))
-        self.model.add_bcache_device(result)
-
-        self.signal.prev_signal()
+        self.signal.emit_signal('filesystem:add-bcache-dev', result)
 
     def cancel(self, button):
         log.debug('bcache: button_cancel')
-        self.signal.prev_signal()
+        self.signal.emit_signal('filesystem:manual')
@@ -25,3 +25,4 @@ from .disk_partition import DiskPartitionView
 from .filesystem import FilesystemView
 from .guided import GuidedDiskSelectionView, GuidedFilesystemView
 from .partition import FormatEntireView, PartitionView
+from .probing import ProbingView
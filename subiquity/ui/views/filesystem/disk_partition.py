@@ -100,6 +100,12 @@ class DiskPartitionView(BaseView):
                 (9, Text(free_space, align="right")),
                 Text("free space"),
             ], 2))
+        if self.disk._info.partitions and not self.disk.preserve:
+            text = ("Use the {} existing partitions".format(
+                len(self.disk._info.partitions)))
+            partitioned_disks.append(Text(""))
+            partitioned_disks.append(
+                menu_btn(label=text, on_press=self.preserve_existing))
         if len(self.disk.partitions()) == 0 and \
            self.disk.available:
             text = ("Format or create swap on entire "
@@ -133,6 +139,9 @@ class DiskPartitionView(BaseView):
     def format_entire(self, result):
         self.controller.format_entire(self.disk)
 
+    def preserve_existing(self, result):
+        self.controller.preserve_existing(self.disk)
+
     def done(self, result):
         ''' Return to FilesystemView '''
         self.controller.manual()
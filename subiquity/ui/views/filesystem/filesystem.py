@@ -39,7 +39,7 @@ from subiquitycore.ui.container import Columns, ListBox, Pile
 from subiquitycore.ui.utils import button_pile, Color, Padding
 from subiquitycore.view import BaseView
 
-from subiquity.models.filesystem import humanize_size
+from subiquity.models.filesystem import Disk, LVMVolGroup, humanize_size
 
 
 log = logging.getLogger('subiquity.ui.filesystem.filesystem')
@@ -74,21 +74,31 @@ class FilesystemConfirmationView(WidgetWrap):
 
 
 class FilesystemView(BaseView):
-    def __init__(self, model, controller):
+    def __init__(self, model, controller, errors=()):
         log.debug('FileSystemView init start()')
         self.model = model
         self.controller = controller
         self.items = []
-        self.body = [
+        self.filesystem_list = self._build_filesystem_list()
+        self.available_inputs = self._build_available_inputs()
+        self.menu = self._build_menu()
+        self.body = []
+        if errors:
+            self.body.append(Color.info_error(Text(
+                _("The configuration cannot be installed:"))))
+            for error in errors:
+                self.body.append(Color.info_error(Text("  " + error)))
+            self.body.append(Text(""))
+        self.body += [
             Text(_("FILE SYSTEM SUMMARY")),
             Text(""),
-            Padding.push_4(self._build_filesystem_list()),
+            Padding.push_4(self.filesystem_list),
             Text(""),
             Text(_("AVAILABLE DEVICES")),
             Text(""),
-            Padding.push_4(self._build_available_inputs()),
-            #self._build_menu(),
-            #Text(""),
+            Padding.push_4(self.available_inputs),
+            Text(""),
+            Padding.push_4(self.menu),
             #Text("USED DISKS"),
             #Text(""),
             #self._build_used_disks(),
@@ -110,6 +120,15 @@ class FilesystemView(BaseView):
         super().__init__(self.frame)
         log.debug('FileSystemView init complete()')
 
+    def refresh_model_inputs(self):
+        self.filesystem_list.contents[:] = (
+            self._build_filesystem_list().contents)
+        self.available_inputs.contents[:] = (
+            self._build_available_inputs().contents)
+        self.menu.contents[:] = self._build_menu().contents
+        self.footer.contents[1] = (
+            self._build_buttons(), self.footer.options())
+
     def _build_used_disks(self):
         log.debug('FileSystemView: building used disks')
         return Color.info_minor(Text("No disks have been used to create a constructed disk."))
@@ -118,7 +137,7 @@ class FilesystemView(BaseView):
         log.debug('FileSystemView: building part list')
         cols = []
         longest_path = len("MOUNT POINT")
-        for m in sorted(self.model._mounts, key=lambda m:m.path):
+        for m in sorted(self.model.all_mounts(), key=lambda m: m.path):
             path = m.path
             longest_path = max(longest_path, len(path))
             for p, *_ in reversed(cols):
@@ -126,9 +145,14 @@ class FilesystemView(BaseView):
                     path = [('info_minor', p), path[len(p):]]
                     break
             cols.append((m.path, path, humanize_size(m.device.volume.size), m.device.fstype, m.device.volume.desc()))
-        for fs in self.model._filesystems:
+        for fs in self.model.all_filesystems():
             if fs.fstype == 'swap':
                 cols.append((None, 'SWAP', humanize_size(fs.volume.size), fs.fstype, fs.volume.desc()))
+        swapfile_size = self.model.swapfile_size()
+        if swapfile_size:
+            cols.append((
+                None, 'SWAP', humanize_size(swapfile_size), 'swap',
+                'file on /'))
 
         if len(cols) == 0:
             return Pile([Color.info_minor(
@@ -168,60 +192,47 @@ class FilesystemView(BaseView):
         def col1(col1):
             inputs.append(Columns([(40, col1)], 1))
 
+        def fs_label(label, fs):
+            if fs is None:
+                return label + "unformatted"
+            if fs.mount():
+                return label + "%-*s"%(self.model.longest_fs_name+2, fs.fstype+',') + fs.mount().path
+            return label + fs.fstype
+
         col3(Text("DEVICE"), Text("SIZE", align="center"), Text("TYPE"))
 
-        for disk in self.model.all_disks():
-            disk_label = Text(disk.serial)
-            size = Text(humanize_size(disk.size).rjust(9))
-            typ = Text(disk.desc())
-            col3(disk_label, size, typ)
-            fs = disk.fs()
+        for device in self.model.all_devices():
+            if isinstance(device, Disk):
+                device_label = Text(device.serial)
+            else:
+                device_label = Text(device.path)
+            size = Text(humanize_size(device.size).rjust(9))
+            typ = Text(device.desc())
+            col3(device_label, size, typ)
+            fs = getattr(device, 'fs', lambda: None)()
             if fs is not None:
-                label = "entire device, "
+                label = fs_label("entire device, ", fs)
                 fs_obj = self.model.fs_by_name[fs.fstype]
-                if fs.mount():
-                    label += "%-*s"%(self.model.longest_fs_name+2, fs.fstype+',') + fs.mount().path
-                else:
-                    label += fs.fstype
                 if fs_obj.label and fs_obj.is_mounted and not fs.mount():
-                    disk_btn = menu_btn(label=label, on_press=self.click_disk, user_arg=disk)
-                    disk_btn = disk_btn
+                    disk_btn = menu_btn(
+                        label=label, on_press=self.click_volume,
+                        user_arg=device)
                 else:
                     disk_btn = Color.info_minor(Text("  " + label))
                 col1(disk_btn)
-            for partition in disk.partitions():
-                label = "partition {}, ".format(partition.number)
-                fs = partition.fs()
-                if fs is not None:
-                    if fs.mount():
-                        label += "%-*s"%(self.model.longest_fs_name+2, fs.fstype+',') + fs.mount().path
-                    else:
-                        label += fs.fstype
-                else:
-                    label += "unformatted"
-                size = Text("{:>9} ({}%)".format(humanize_size(partition.size), int(100*partition.size/disk.size)))
-                if partition.available:
-                    part_btn = menu_btn(label=label, on_press=self.click_partition, user_arg=partition)
-                    col2(part_btn, size)
-                else:
-                    part_btn = Color.info_minor(Text("  " + label))
-                    size = Color.info_minor(size)
-                    col2(part_btn, size)
-            size = disk.size
-            free = disk.free
-            percent = int(100*free/size)
-            if disk.available and disk.used > 0 and percent > 0:
-                label = _("Add/Edit Partitions")
-                size = "{:>9} ({}%) free".format(humanize_size(free), percent)
-            elif disk.available and percent > 0:
-                label = _("Add First Partition")
-                size = ""
-            else:
-                label = _("Edit Partitions")
-                size = ""
-            col2(
-                menu_btn(label=label, on_press=self.click_disk, user_arg=disk),
-                Text(size))
+            holder = getattr(device, '_constructed_device', None)
+            if holder is not None:
+                col1(Color.info_minor(Text("  used by " + holder.path)))
+            if isinstance(device, Disk):
+                self._disk_rows(device, fs_label, col2)
+            elif isinstance(device, LVMVolGroup):
+                self._volgroup_rows(device, fs_label, col2)
+            elif fs is None and holder is None:
+                col2(
+                    menu_btn(
+                        label=_("Format/Mount"), on_press=self.click_volume,
+                        user_arg=device),
+                    Text(""))
 
         if len(inputs) == 1:
             return Pile([Color.info_minor(
@@ -229,32 +240,110 @@ class FilesystemView(BaseView):
 
         return Pile(inputs)
 
+    def _disk_rows(self, disk, fs_label, col2):
+        for partition in disk.partitions():
+            label = "partition {}, ".format(partition.number)
+            holder = partition.constructed_device()
+            if holder is not None:
+                label += "used by " + holder.path
+            else:
+                label = fs_label(label, partition.fs())
+            size = Text("{:>9} ({}%)".format(humanize_size(partition.size), int(100*partition.size/disk.size)))
+            if partition.available:
+                part_btn = menu_btn(label=label, on_press=self.click_partition, user_arg=partition)
+                col2(part_btn, size)
+            else:
+                part_btn = Color.info_minor(Text("  " + label))
+                size = Color.info_minor(size)
+                col2(part_btn, size)
+        size = disk.size
+        free = disk.free
+        percent = int(100*free/size)
+        if disk.available and disk.used > 0 and percent > 0:
+            label = _("Add/Edit Partitions")
+            size = "{:>9} ({}%) free".format(humanize_size(free), percent)
+        elif disk.available and percent > 0:
+            label = _("Add First Partition")
+            size = ""
+        else:
+            label = _("Edit Partitions")
+            size = ""
+        col2(
+            menu_btn(label=label, on_press=self.click_disk, user_arg=disk),
+            Text(size))
+
+    def _volgroup_rows(self, vg, fs_label, col2):
+        for lv in vg.volumes():
+            label = fs_label(
+                "logical volume {}, ".format(lv.name), lv.fs())
+            size = Text("{:>9} ({}%)".format(
+                humanize_size(lv.size), int(100 * lv.size / vg.size)))
+            if lv.available:
+                col2(
+                    menu_btn(
+                        label=label, on_press=self.click_volume, user_arg=lv),
+                    size)
+            else:
+                col2(
+                    Color.info_minor(Text("  " + label)),
+                    Color.info_minor(size))
+        if vg.free > 0:
+            percent = int(100 * vg.free / vg.size)
+            col2(
+                menu_btn(
+                    label=_("Add Logical Volume"),
+                    on_press=self.click_volgroup, user_arg=vg),
+                Text("{:>9} ({}%) free".format(
+                    humanize_size(vg.free), percent)))
+
     def click_disk(self, sender, disk):
         self.controller.partition_disk(disk)
 
     def click_partition(self, sender, partition):
         self.controller.format_mount_partition(partition)
 
+    def click_volume(self, sender, volume):
+        self.controller.format_volume(volume)
+
+    def click_volgroup(self, sender, vg):
+        self.controller.add_logical_volume(vg)
+
     def _build_menu(self):
         log.debug('FileSystemView: building menu')
         opts = []
-        #avail_disks = self.model.get_available_disk_names()
+        avail_devs = self.model.get_empty_device_names()
 
+        # (label, controller method, devices needed)
         fs_menu = [
-            # ('Connect iSCSI network disk',         'filesystem:connect-iscsi-disk'),
-            # ('Connect Ceph network disk',          'filesystem:connect-ceph-disk'),
-            # ('Create volume group (LVM2)',           'menu:filesystem:main:create-volume-group'),
-            # ('Create software RAID (MD)',            'menu:filesystem:main:create-raid'),
-            # ('Setup hierarchichal storage (bcache)', 'menu:filesystem:main:setup-bcache'),
+            (_("Create software RAID (md)"),
+             self.controller.create_raid, 2),
+            (_("Create volume group (LVM)"),
+             self.controller.create_volume_group, 1),
+            (_("Create cached device (bcache)"),
+             self.controller.create_bcache, 2),
         ]
 
-        for opt, sig in fs_menu:
-            if len(avail_disks) > 1:
+        for opt, action, needed in fs_menu:
+            if len(avail_devs) >= needed:
                 opts.append(menu_btn(label=opt,
                                      on_press=self.on_fs_menu_press,
-                                     user_data=sig))
+                                     user_arg=action))
         return Pile(opts)
 
+    def on_fs_menu_press(self, sender, action):
+        action()
+
+    def keypress(self, size, key):
+        if key in ['u', 'U']:
+            log.debug('keypress: [{}]'.format(key))
+            self.controller.undo()
+            return None
+        if key in ['ctrl r', 'r', 'R']:
+            log.debug('keypress: [{}]'.format(key))
+            self.controller.redo()
+            return None
+        return super().keypress(size, key)
+
     def cancel(self, button=None):
         self.controller.default()
 
@@ -66,32 +66,59 @@ class GuidedDiskSelectionView(BaseView):
         self.model = model
         self.controller = controller
         cancel = cancel_btn("Cancel", on_press=self.cancel)
-        disks = []
-        for disk in self.model.all_disks():
-            disk_btn = forward_btn(
-                "%-40s %s"%(disk.serial, humanize_size(disk.size).rjust(9)),
-                on_press=self.choose_disk, user_arg=disk)
-            disks.append(disk_btn)
+        measure = ok_btn(_("Measure Disk Speed"), on_press=self.measure)
+        self.disk_list = Pile(self._build_disk_buttons())
         lb = ListBox([
             Padding.center_70(Text("")),
             Padding.center_70(Text(_("Choose the disk to install to:"))),
             Padding.center_70(Text("")),
-            Padding.center_70(Pile(disks)),
+            Padding.center_70(self.disk_list),
             Padding.center_70(Text("")),
-            button_pile([cancel]),
+            button_pile([measure, cancel]),
             ])
         super().__init__(lb)
 
+    def _build_disk_buttons(self):
+        disks = []
+        # The best disk is listed first, so it has the focus initially.
+        for disk in self.model.ranked_disks():
+            label = "%-40s %s  %s" % (
+                disk.serial, humanize_size(disk.size).rjust(9),
+                _("score {}").format(disk._info.score()))
+            speed = self.controller.benchmark_summary(disk)
+            if speed is not None:
+                label += "\n    " + speed
+            disk_btn = forward_btn(
+                label, on_press=self.choose_disk, user_arg=disk)
+            disks.append(disk_btn)
+        if len(disks) == 0:
+            disks.append(Text(_("No disks available.")))
+        return disks
+
+    def refresh_model_inputs(self):
+        self.disk_list.contents[:] = [
+            (w, self.disk_list.options()) for w in self._build_disk_buttons()]
+
+    def measure(self, btn):
+        self.controller.benchmark_disks()
+        self.refresh_model_inputs()
+
     def cancel(self, btn=None):
         self.controller.default()
 
     def choose_disk(self, btn, disk):
-        self.model.reset()
-        result = {
-            "partnum": 1,
-            "size": disk.free,
-            "fstype": self.model.fs_by_name["ext4"],
-            "mount": "/",
-        }
-        self.controller.partition_disk_handler(disk, None, result)
+        with self.model.journal.step():
+            self.model.reset()
+            swap_size = self.model.suggested_swap_size(disk.free)
+            root_size = disk.free
+            if self.model.swap_kind == 'partition':
+                root_size -= swap_size
+            result = {
+                "partnum": 1,
+                "size": root_size,
+                "fstype": self.model.fs_by_name["ext4"],
+                "mount": "/",
+            }
+            self.controller.partition_disk_handler(disk, None, result)
+            self.model.add_swap(disk, swap_size)
         self.controller.manual()
@@ -40,6 +40,7 @@ from subiquity.models.filesystem import (
     dehumanize_size,
     humanize_size,
     )
+from subiquity.models.fstuning import MOUNT_PROFILES
 from subiquity.ui.mount import MountField
 
 
@@ -50,6 +51,21 @@ class FSTypeField(FormField):
     def _make_widget(self, form):
         return Selector(opts=FilesystemModel.supported_filesystems)
 
+
+class ExistingFSField(FormField):
+    def _make_widget(self, form):
+        return Selector(opts=[
+            (_("format it"), True, False),
+            (_("keep it"), True, True),
+            ])
+
+
+class MountProfileField(FormField):
+    def _make_widget(self, form):
+        opts = [(_("automatic"), True, None)]
+        opts.extend((profile, True, profile) for profile in MOUNT_PROFILES)
+        return Selector(opts=opts)
+
 class SizeWidget(StringEditor):
     def __init__(self, form):
         self.form = form
@@ -78,26 +94,47 @@ class SizeField(FormField):
 
 class PartitionForm(Form):
 
-    def __init__(self, mountpoint_to_devpath_mapping, max_size, initial={}):
+    def __init__(self, mountpoint_to_devpath_mapping, max_size, initial={},
+                 existing_fs=None):
         self.mountpoint_to_devpath_mapping = mountpoint_to_devpath_mapping
+        self.existing_fs = existing_fs
+        self.max_size = max_size
         if max_size is not None:
-            self.max_size = max_size
             self.size_str = humanize_size(max_size)
             self.size.caption = "Size (max {})".format(self.size_str)
-        else:
+        super().__init__(initial)
+        # Fields can only be removed once they are bound.
+        if max_size is None:
             self.remove_field('partnum')
             self.remove_field('size')
-        super().__init__(initial)
+        if existing_fs is None:
+            self.remove_field('existing')
+        else:
+            self.existing.caption = "Existing {}".format(existing_fs.fstype)
         connect_signal(self.fstype.widget, 'select', self.select_fstype)
         self.select_fstype(None, self.fstype.widget.value)
+        if existing_fs is not None:
+            connect_signal(
+                self.existing.widget, 'select', self.select_existing)
+            self.select_existing(None, self.existing.widget.value)
 
     def select_fstype(self, sender, fs):
         self.mount.enabled = fs.is_mounted
+        self.mount_profile.enabled = fs.is_mounted
+
+    def select_existing(self, sender, keep):
+        # A kept filesystem stays the type it is.
+        if keep:
+            self.fstype.value = FilesystemModel.fs_by_name[
+                self.existing_fs.fstype]
+        self.fstype.enabled = not keep
 
     partnum = IntegerField("Partition number")
     size = SizeField()
+    existing = ExistingFSField("Existing")
     fstype = FSTypeField("Format")
     mount = MountField("Mount")
+    mount_profile = MountProfileField("Mount options")
 
     def clean_size(self, val):
         if not val:
@@ -132,19 +169,26 @@ class PartitionFormatView(BaseView):
     def __init__(self, size, existing, initial, back):
 
         mountpoint_to_devpath_mapping = self.model.get_mountpoint_to_devpath_mapping()
+        existing_fs = None
         if existing is not None:
             fs = existing.fs()
             if fs is not None:
-                if existing.flag != "boot":
+                if fs.preserve:
+                    # Only keep what is there if asked to.
+                    existing_fs = fs
+                    initial['existing'] = True
+                if getattr(existing, 'flag', None) != "boot":
                     initial['fstype'] = self.model.fs_by_name[fs.fstype]
                 mount = fs.mount()
                 if mount is not None:
                     initial['mount'] = mount.path
+                    initial['mount_profile'] = mount.profile()
                     if mount.path in mountpoint_to_devpath_mapping:
                         del mountpoint_to_devpath_mapping[mount.path]
             else:
                 initial['fstype'] = self.model.fs_by_name[None]
-        self.form = self.form_cls(mountpoint_to_devpath_mapping, size, initial)
+        self.form = self.form_cls(
+            mountpoint_to_devpath_mapping, size, initial, existing_fs)
         self.back = back
 
         connect_signal(self.form, 'submit', self.done)
@@ -179,12 +223,11 @@ class PartitionView(PartitionFormatView):
         self.disk = disk
         self.partition = partition
 
-        max_size = disk.free
+        max_size = disk.max_partition_size(partition)
         if partition is None:
             initial = {'partnum': disk.next_partnum}
             label = _("Create")
         else:
-            max_size += partition.size
             initial = {
                 'partnum': partition.number,
                 'size': humanize_size(partition.size),
@@ -198,12 +241,16 @@ class PartitionView(PartitionFormatView):
             self.form.fstype.widget.index = 0
             self.form.mount.enabled = False
             self.form.fstype.enabled = False
+        if partition is not None and partition.preserve:
+            # Existing partitions can only be reformatted or mounted.
+            self.form.partnum.enabled = False
+            self.form.size.enabled = False
 
     def make_body(self):
         body = super().make_body()
         if self.partition is not None:
             btn = delete_btn(_("Delete"), on_press=self.delete)
-            if self.partition.flag == "boot":
+            if self.partition.flag == "boot" or self.partition.preserve:
                 btn = WidgetDisable(Color.info_minor(btn.original_widget))
             body.extend([
                 Text(""),
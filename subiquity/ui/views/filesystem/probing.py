@@ -0,0 +1,41 @@
+# Copyright 2018 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from urwid import (
+    Text,
+    )
+
+from subiquitycore.ui.buttons import back_btn
+from subiquitycore.ui.container import ListBox
+from subiquitycore.ui.utils import button_pile, Padding
+from subiquitycore.view import BaseView
+
+
+class ProbingView(BaseView):
+
+    def __init__(self, controller):
+        self.controller = controller
+        back = back_btn(_("Back"), on_press=self.cancel)
+        lb = ListBox([
+            Padding.center_70(Text("")),
+            Padding.center_70(
+                Text(_("Probing storage devices, please wait..."))),
+            Padding.center_70(Text("")),
+            button_pile([back]),
+            ])
+        super().__init__(lb)
+
+    def cancel(self, btn=None):
+        self.controller.cancel()
@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+
+from subiquitycore.testing import view_helpers
+
+from subiquity.controllers.filesystem import FilesystemController
+from subiquity.models.tests.test_filesystem import make_model_with_disks
+from subiquity.ui.views.filesystem.filesystem import FilesystemView
+
+
+class FilesystemViewTests(unittest.TestCase):
+
+    def make_view(self, model):
+        controller = mock.create_autospec(spec=FilesystemController)
+        return FilesystemView(model, controller)
+
+    def test_constructed_devices_listed(self):
+        model = make_model_with_disks(
+            100 << 30, 100 << 30, 100 << 30, 100 << 30)
+        a, b, c, d = model.all_disks()
+        raid = model.add_raid(1, [a, b])
+        bcache = model.add_bcache(c, d)
+        view = self.make_view(model)
+        but = view_helpers.find_button_matching(view, "^Format/Mount")
+        view_helpers.click(but)
+        view.controller.format_volume.assert_called_with(raid)
+        model.add_filesystem(raid, 'ext4')
+        view.refresh_model_inputs()
+        but = view_helpers.find_button_matching(view, "^entire device, ext4")
+        view_helpers.click(but)
+        view.controller.format_volume.assert_called_with(raid)
+        but = view_helpers.find_button_matching(view, "^Format/Mount")
+        view_helpers.click(but)
+        view.controller.format_volume.assert_called_with(bcache)
+
+    def test_logical_volumes(self):
+        model = make_model_with_disks(100 << 30)
+        disk, = model.all_disks()
+        vg = model.add_volgroup('vg0', [disk])
+        lv = model.add_logical_volume(vg, 'lv0', 10 << 30)
+        view = self.make_view(model)
+        but = view_helpers.find_button_matching(view, "^logical volume lv0")
+        view_helpers.click(but)
+        view.controller.format_volume.assert_called_with(lv)
+        but = view_helpers.find_button_matching(view, "^Add Logical Volume")
+        view_helpers.click(but)
+        view.controller.add_logical_volume.assert_called_with(vg)
+
+    def test_create_menu(self):
+        model = make_model_with_disks(100 << 30)
+        view = self.make_view(model)
+        self.assertIsNone(view_helpers.find_button_matching(view, ".*RAID"))
+        but = view_helpers.find_button_matching(view, ".*volume group")
+        view_helpers.click(but)
+        view.controller.create_volume_group.assert_called_with()
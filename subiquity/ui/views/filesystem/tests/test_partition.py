@@ -3,14 +3,14 @@ from unittest import mock
 
 import urwid
 
-from probert.storage import StorageInfo
-
 from subiquitycore.testing import view_helpers
 
 from subiquity.controllers.filesystem import FilesystemController
 from subiquity.models.filesystem import (
     dehumanize_size,
     Disk,
+    DiskInfo,
+    Filesystem,
     FilesystemModel,
     Partition,
     )
@@ -24,11 +24,8 @@ class PartitionViewTests(unittest.TestCase):
         controller = mock.create_autospec(spec=FilesystemController)
         model = mock.create_autospec(spec=FilesystemModel)
         model.fs_by_name = FilesystemModel.fs_by_name
-        info = mock.create_autospec(spec=StorageInfo)
-        info.name = 'disk-name'
-        info.size = 100
-        info.free = 50
-        disk = Disk.from_info(info)
+        info = DiskInfo(name='disk-name', size=100)
+        disk = Disk(info=info, path=info.name)
         return PartitionView(model, controller, disk, partition)
 
     def test_initial_focus(self):
@@ -62,6 +59,39 @@ class PartitionViewTests(unittest.TestCase):
         else:
             self.fail("Delete button not disabled")
 
+    def test_preserved_partition_cannot_be_resized_or_deleted(self):
+        view = self.make_view(Partition(size=50, preserve=True))
+        self.assertFalse(view.form.size.enabled)
+        self.assertFalse(view.form.partnum.enabled)
+        but, path = view_helpers.find_button_matching(
+            view, "Delete", return_path=True)
+        self.assertIsNotNone(but)
+        for w in path:
+            if isinstance(w, urwid.WidgetDisable):
+                return
+        else:
+            self.fail("Delete button not disabled")
+
+    def test_preserved_filesystem_kept_or_formatted(self):
+        partition = Partition(size=50, preserve=True)
+        partition._fs = Filesystem(
+            volume=partition, fstype='xfs', preserve=True)
+        view = self.make_view(partition)
+        self.assertTrue(view.form.existing.value)
+        self.assertEqual(view.form.fstype.value.label, 'xfs')
+        self.assertFalse(view.form.fstype.enabled)
+        view.form.existing.value = False
+        self.assertTrue(view.form.fstype.enabled)
+        view.form.fstype.value = FilesystemModel.fs_by_name['ext4']
+        view_helpers.click(view.form.done_btn.base_widget)
+        spec = view.controller.partition_disk_handler.call_args[0][2]
+        self.assertFalse(spec['existing'])
+        self.assertEqual(spec['fstype'].label, 'ext4')
+
+    def test_ordinary_partition_has_no_keep_choice(self):
+        view = self.make_view(Partition(size=50))
+        self.assertNotIn('existing', view.form.as_data())
+
     def test_click_delete_button(self):
         partition = Partition(size=50)
         view = self.make_view(partition)
@@ -79,6 +109,7 @@ class PartitionViewTests(unittest.TestCase):
         view_helpers.enter_data(view.form, valid_data)
         view_helpers.click(view.form.done_btn.base_widget)
         valid_data['mount'] = '/'
+        valid_data['mount_profile'] = None
         valid_data['size'] = dehumanize_size(valid_data['size'])
         view.controller.partition_disk_handler.assert_called_once_with(
             view.disk, None, valid_data)
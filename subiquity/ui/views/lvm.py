@@ -19,10 +19,19 @@ from urwid import Text, CheckBox
 from subiquitycore.view import BaseView
 from subiquitycore.ui.buttons import cancel_btn, done_btn
 from subiquitycore.ui.container import Columns, ListBox, Pile
+from subiquitycore.ui.form import StringField
 from subiquitycore.ui.interactive import UsernameEditor
 from subiquitycore.ui.utils import Color, Padding
 
 from subiquity.models.filesystem import humanize_size
+from subiquity.ui.mount import MountField
+from subiquity.ui.views.filesystem.partition import (
+    FSTypeField,
+    MountProfileField,
+    PartitionForm,
+    PartitionFormatView,
+    SizeField,
+    )
 
 
 log = logging.getLogger('subiquitycore.ui.lvm')
@@ -34,6 +43,7 @@ class LVMVolumeGroupView(BaseView):
         self.signal = signal
         self.volgroup = UsernameEditor()
         self.selected_disks = []
+        self.selected_names = []
         body = [
             Padding.center_50(self._build_disk_selection()),
             Padding.line_break(""),
@@ -49,28 +59,21 @@ class LVMVolumeGroupView(BaseView):
             Text("DISK SELECTION")
         ]
 
-        # lvm can use empty whole disks, or empty partitions
-        avail_disks = self.model.get_empty_disk_names()
-        avail_parts = self.model.get_empty_partition_names()
-        avail_devs = sorted(avail_disks + avail_parts)
+        # lvm can use empty whole disks, partitions, RAIDs and bcaches
+        avail_devs = sorted(self.model.get_empty_device_names())
         if len(avail_devs) == 0:
-            return items.append(
-                [Color.info_minor(Text("No available disks."))])
+            items.append(Color.info_minor(Text("No available disks.")))
+            return Pile(items)
 
         for dname in avail_devs:
-            device = self.model.get_disk(dname)
-            if device.path != dname:
-                # we've got a partition
-                lvmdev = device.get_partition(dname)
-            else:
-                lvmdev = device
-
+            lvmdev = self.model.get_device(dname)
             disk_sz = humanize_size(lvmdev.size)
             disk_string = "{}     {},     {}".format(dname,
                                                      disk_sz,
-                                                     device.model)
+                                                     lvmdev.desc())
             log.debug('lvm: disk_string={}'.format(disk_string))
             self.selected_disks.append(CheckBox(disk_string))
+            self.selected_names.append(dname)
 
         items += self.selected_disks
 
@@ -105,17 +108,45 @@ class LVMVolumeGroupView(BaseView):
 
     def done(self, result):
         result = {
-            'devices': [x.get_label() for x in self.selected_disks if x.state],
+            'devices': [name for (name, x) in zip(self.selected_names,
+                                                  self.selected_disks)
+                        if x.state],
             'volgroup': self.volgroup.value,
         }
         log.debug('lvm_done: result = {}'.format(result))
-        self.model.add_lvm_volgroup(result)
-        self.signal.prev_signal()
+        self.signal.emit_signal('filesystem:add-lvm-volgroup', result)
 
     def cancel(self, button):
         log.debug('lvm: button_cancel')
-        self.signal.prev_signal()
+        self.signal.emit_signal('filesystem:manual')
+
+
+class LogicalVolumeForm(PartitionForm):
+
+    name = StringField("Name")
+    size = SizeField()
+    fstype = FSTypeField("Format")
+    mount = MountField("Mount")
+    mount_profile = MountProfileField("Mount options")
 
+    def validate_name(self):
+        if not self.name.value:
+            return "A logical volume needs a name"
 
-class AddLVMPartitionView(BaseView):
-    pass
+
+class LogicalVolumeView(PartitionFormatView):
+
+    form_cls = LogicalVolumeForm
+
+    def __init__(self, model, controller, volgroup):
+        log.debug('LogicalVolumeView: volgroup=[{}]'.format(volgroup.name))
+        self.model = model
+        self.controller = controller
+        self.volgroup = volgroup
+        super().__init__(volgroup.free, None, {}, self.controller.manual)
+        self.form.buttons.base_widget[0].set_label(_("Create"))
+
+    def done(self, form):
+        log.debug("Add Logical Volume Result: {}".format(form.as_data()))
+        self.controller.add_logical_volume_handler(
+            self.volgroup, form.as_data())
@@ -19,8 +19,7 @@ from urwid import Text, CheckBox
 from subiquitycore.view import BaseView
 from subiquitycore.ui.buttons import cancel_btn, done_btn
 from subiquitycore.ui.container import Columns, ListBox, Pile
-from subiquitycore.ui.interactive import (StringEditor, IntegerEditor,
-                                          Selector)
+from subiquitycore.ui.interactive import IntegerEditor, Selector
 from subiquitycore.ui.utils import Color, Padding
 
 from subiquity.models.filesystem import humanize_size
@@ -34,8 +33,8 @@ class RaidView(BaseView):
         self.signal = signal
         self.raid_level = Selector(self.model.raid_levels)
         self.hot_spares = IntegerEditor()
-        self.chunk_size = StringEditor(edit_text="4K")
         self.selected_disks = []
+        self.selected_names = []
         body = [
             Padding.center_50(self._build_disk_selection()),
             Padding.line_break(""),
@@ -51,28 +50,21 @@ class RaidView(BaseView):
             Text("DISK SELECTION")
         ]
 
-        # raid can use empty whole disks, or empty partitions
-        avail_disks = self.model.get_empty_disk_names()
-        avail_parts = self.model.get_empty_partition_names()
-        avail_devs = sorted(avail_disks + avail_parts)
+        # raid can use empty whole disks, partitions, RAIDs and bcaches
+        avail_devs = sorted(self.model.get_empty_device_names())
         if len(avail_devs) == 0:
-            return items.append(
-                [Color.info_minor(Text("No available disks."))])
+            items.append(Color.info_minor(Text("No available disks.")))
+            return Pile(items)
 
         for dname in avail_devs:
-            device = self.model.get_disk(dname)
-            if device.path != dname:
-                # we've got a partition
-                raiddev = device.get_partition(dname)
-            else:
-                raiddev = device
-
+            raiddev = self.model.get_device(dname)
             disk_sz = humanize_size(raiddev.size)
             disk_string = "{}     {},     {}".format(dname,
                                                      disk_sz,
-                                                     device.model)
+                                                     raiddev.desc())
             log.debug('raid: disk_string={}'.format(disk_string))
             self.selected_disks.append(CheckBox(disk_string))
+            self.selected_names.append(dname)
 
         items += self.selected_disks
 
@@ -97,13 +89,6 @@ class RaidView(BaseView):
                 ],
                 dividechars=4
             ),
-            Columns(
-                [
-                    ("weight", 0.2, Text("Chunk size", align="right")),
-                    ("weight", 0.3, Color.string_input(self.chunk_size))
-                ],
-                dividechars=4
-            )
         ]
         return Pile(items)
 
@@ -120,14 +105,15 @@ class RaidView(BaseView):
 
     def done(self, result):
         result = {
-            'devices': [x.get_label() for x in self.selected_disks if x.state],
+            'devices': [name for (name, x) in zip(self.selected_names,
+                                                  self.selected_disks)
+                        if x.state],
             'raid_level': self.raid_level.value,
             'hot_spares': self.hot_spares.value,
-            'chunk_size': self.chunk_size.value,
         }
         log.debug('raid_done: result = {}'.format(result))
         self.signal.emit_signal('filesystem:add-raid-dev', result)
 
     def cancel(self, button):
         log.debug('raid: button_cancel')
-        self.signal.prev_signal()
+        self.signal.emit_signal('filesystem:manual')
@@ -0,0 +1,32 @@
+import unittest
+from unittest import mock
+
+from subiquitycore.testing import view_helpers
+
+from subiquity.controllers.filesystem import FilesystemController
+from subiquity.models.filesystem import FilesystemModel
+from subiquity.models.tests.test_filesystem import make_model_with_disks
+from subiquity.ui.views.lvm import LogicalVolumeView
+
+
+class LogicalVolumeViewTests(unittest.TestCase):
+
+    def test_create_logical_volume(self):
+        model = make_model_with_disks(100 << 30)
+        vg = model.add_volgroup('vg0', model.all_disks())
+        controller = mock.create_autospec(spec=FilesystemController)
+        view = LogicalVolumeView(model, controller, vg)
+        view_helpers.enter_data(view.form, {
+            'name': 'lv0',
+            'size': '10G',
+            'fstype': FilesystemModel.fs_by_name['xfs'],
+            'mount': '/srv',
+            })
+        view_helpers.click(view.form.done_btn.base_widget)
+        controller.add_logical_volume_handler.assert_called_once_with(vg, {
+            'name': 'lv0',
+            'size': 10 << 30,
+            'fstype': FilesystemModel.fs_by_name['xfs'],
+            'mount': '/srv',
+            'mount_profile': None,
+            })
@@ -53,11 +53,25 @@ class BaseController(ABC):
         exception will be logged.
         """
         fut = self.pool.submit(func)
+        self.call_when_done(fut, callback)
+
+    def call_when_done(self, fut, callback):
+        """Call callback on UI thread once fut has completed.
+
+        callback will be passed fut. The result of callback is
+        discarded. Any exception will be logged.
+        """
         def in_main_thread(ignored):
             try:
                 callback(fut)
             except:
-                log.exception("callback %s after calling %s failed", callback, func)
+                log.exception(
+                    "callback %s after %s completed failed", callback, fut)
+            # The pipe is only ever written to once. Returning False
+            # removes the watch and closes the read end; the write end
+            # is ours to close.
+            os.close(pipe)
+            return False
         pipe = self.loop.watch_pipe(in_main_thread)
         def in_random_thread(ignored):
             os.write(pipe, b'x')
@@ -13,27 +13,155 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from concurrent import futures
+import json
 import logging
-import yaml
 import os
+import threading
+import yaml
+import pyudev
 from probert.network import (StoredDataObserver, UdevObserver)
 from probert.storage import (Storage,
                              StorageInfo)
 
 log = logging.getLogger('subiquitycore.prober')
 
+# Prefer libyaml's parser when PyYAML was built with it.
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+PROBE_CACHE_DIR = '/run/subiquity'
+PROBE_CACHE_FILE = 'storage-probe.json'
+UEVENT_SEQNUM = '/sys/kernel/uevent_seqnum'
+SYS_BLOCK = '/sys/block'
+
+# The queue limits of a disk that subiquity ranks and aligns by. udev
+# does not report these, so they are added to the probe data under
+# attrs as, for example, 'queue/rotational'.
+QUEUE_ATTRS = (
+    'rotational',
+    'physical_block_size',
+    'minimum_io_size',
+    'optimal_io_size',
+    )
+
 
 class ProberException(Exception):
     '''Base Prober Exception'''
     pass
 
 
+def udev_storage_data(device):
+    """Return the probe data for a pyudev block Device.
+
+    This has the same shape as the entries returned by
+    probert.storage.Storage.probe(): the udev properties plus the sysfs
+    attributes under the key 'attrs'.
+    """
+    data = dict(device.properties)
+    attrs = {}
+    for attr in device.attributes.available_attributes:
+        try:
+            attrs[attr] = device.attributes.asstring(attr)
+        except (KeyError, OSError, UnicodeDecodeError, ValueError):
+            pass
+    if data.get('DEVTYPE') == 'disk':
+        for attr in QUEUE_ATTRS:
+            try:
+                attrs['queue/' + attr] = device.attributes.asstring(
+                    'queue/' + attr)
+            except (KeyError, OSError, UnicodeDecodeError, ValueError):
+                pass
+    # sysfs gives the size in 512 byte sectors; probert reports bytes.
+    if 'size' in attrs:
+        try:
+            attrs['size'] = str(int(attrs['size']) * 512)
+        except ValueError:
+            del attrs['size']
+    data['attrs'] = attrs
+    return data
+
+
+def add_queue_attrs(storage, sys_block=None):
+    """Add the QUEUE_ATTRS of each disk in storage to its attrs."""
+    if sys_block is None:
+        sys_block = SYS_BLOCK
+    for devname, data in storage.items():
+        if data.get('DEVTYPE') != 'disk' or not devname.startswith('/dev/'):
+            continue
+        queue = os.path.join(
+            sys_block, devname[len('/dev/'):].replace('/', '!'), 'queue')
+        attrs = data.setdefault('attrs', {})
+        for attr in QUEUE_ATTRS:
+            try:
+                with open(os.path.join(queue, attr)) as fp:
+                    attrs['queue/' + attr] = fp.read().strip()
+            except OSError:
+                pass
+
+
+class UdevStorageObserver:
+    """Report block devices being added, changed or removed.
+
+    The receiver must provide new_device(path, data),
+    update_device(path, data) and del_device(path) methods. Any storage
+    data held by the prober is updated before the receiver is called.
+    """
+
+    def __init__(self, prober, receiver=None):
+        self.prober = prober
+        self.receiver = receiver
+        self.context = pyudev.Context()
+        self.monitor = None
+
+    def start(self):
+        self.monitor = pyudev.Monitor.from_netlink(self.context)
+        self.monitor.filter_by(subsystem='block')
+        self.monitor.start()
+        return [self.monitor.fileno()]
+
+    def data_ready(self, fd):
+        while True:
+            device = self.monitor.poll(timeout=0)
+            if device is None:
+                return
+            path = device.device_node
+            if path is None:
+                continue
+            log.debug("storage event %s %s", device.action, path)
+            if device.action == 'remove':
+                self.prober.storage_changed(path, None)
+                self.receiver.del_device(path)
+                continue
+            data = udev_storage_data(device)
+            self.prober.storage_changed(path, data)
+            if device.action == 'add':
+                self.receiver.new_device(path, data)
+            else:
+                self.receiver.update_device(path, data)
+
+
 class Prober():
     def __init__(self, opts):
         self.opts = opts
 
         self.probe_data = {}
         self.saved_config = None
+        # One of 'machine-config', 'cache' or 'probe' once storage data
+        # has been loaded.
+        self.storage_source = None
+        self.storage_future = None
+        self._storage_pool = None
+        # The cache key the storage data was saved under, whether the
+        # loaded data has changed since it was saved, and the devices
+        # that have changed while no data was loaded.
+        self._storage_cache_key_saved = None
+        self._storage_dirty = False
+        self._storage_released = False
+        self._storage_changes = {}
+        # The background probe hands its data over under this lock.
+        self._storage_lock = threading.Lock()
+        self._storage_observer = None
+        self._storage_fds = []
 
         if self.opts.machine_config:
             log.debug('User specified machine_config: {}'.format(
@@ -41,13 +169,29 @@ class Prober():
             self.saved_config = \
               self._load_machine_config(self.opts.machine_config)
             self.probe_data = self.saved_config
-        log.debug('Prober() init finished, data:{}'.format(self.saved_config))
+            if 'storage' in self.probe_data:
+                self.storage_source = 'machine-config'
+        if self.saved_config is not None:
+            log.debug('Prober() init finished, machine config sections: %s',
+                      sorted(self.saved_config))
+        else:
+            log.debug('Prober() init finished')
 
     def _load_machine_config(self, machine_config):
+        ''' Load a machine config, which is either JSON or YAML.
+
+        Probe dumps from large machines can be tens of megabytes, so
+        JSON (the usual format) is handed to the json module's C decoder
+        and only other files go to YAML.
+        '''
         with open(machine_config) as mc:
             try:
-                data = yaml.safe_load(mc)
-            except (UnicodeDecodeError, yaml.reader.ReaderError):
+                content = mc.read()
+                if content.lstrip().startswith('{'):
+                    data = json.loads(content)
+                else:
+                    data = yaml.load(content, Loader=YamlLoader)
+            except (UnicodeDecodeError, ValueError, yaml.YAMLError):
                 err = 'Failed to parse machine config'
                 log.exception(err)
                 raise ProberException(err)
@@ -62,16 +206,218 @@ class Prober():
             observer = UdevObserver(receiver)
         return observer, observer.start()
 
+    @property
+    def storage_is_live(self):
+        ''' Does the storage data describe this machine's block devices?
+
+        This is not the case when running from a machine config or in
+        dry-run mode, so the host's mounts and sysfs must be ignored.
+        '''
+        if self.opts.dry_run:
+            return False
+        return self.storage_source in ('cache', 'probe')
+
+    @property
+    def probe_cache_path(self):
+        cache_dir = PROBE_CACHE_DIR
+        if self.opts.dry_run:
+            cache_dir = os.path.abspath('.subiquity')
+        return os.path.join(cache_dir, PROBE_CACHE_FILE)
+
+    def _storage_cache_key(self):
+        ''' Describe the current block device state of the system.
+
+        The key combines the kernel's uevent sequence number, which
+        changes whenever udev processes an event, with the name, device
+        number and size of everything in /sys/block.  A cached probe is
+        only reused if the key still matches.
+        '''
+        try:
+            with open(UEVENT_SEQNUM) as fp:
+                seqnum = fp.read().strip()
+            block = []
+            for name in sorted(os.listdir(SYS_BLOCK)):
+                attrs = [name]
+                for attr in 'dev', 'size':
+                    with open(os.path.join(SYS_BLOCK, name, attr)) as fp:
+                        attrs.append(fp.read().strip())
+                block.append(attrs)
+        except OSError:
+            log.exception('failed to compute storage probe cache key')
+            return None
+        return {'seqnum': seqnum, 'block': block}
+
+    def _load_storage_cache(self, key):
+        path = self.probe_cache_path
+        try:
+            with open(path) as fp:
+                cached = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            log.exception('failed to read storage probe cache %s', path)
+            return None
+        if cached.get('key') != key:
+            log.debug('storage probe cache %s is stale', path)
+            return None
+        return cached.get('storage')
+
+    def _save_storage_cache(self, key, storage):
+        path = self.probe_cache_path
+        tmppath = path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as fp:
+                json.dump({'key': key, 'storage': storage}, fp)
+            os.rename(tmppath, path)
+        except (OSError, TypeError, ValueError):
+            log.exception('failed to write storage probe cache %s', path)
+            return False
+        return True
+
+    def start_storage_probe(self):
+        ''' Start loading storage data in the background, returning a Future.
+
+        The probe runs on a thread of its own, so it does not hold up
+        other background work while it runs. get_storage() waits for
+        this probe rather than starting another.
+
+        Block device events are watched from before the probe starts,
+        so none that happen while it runs are missed.
+        '''
+        if self.storage_future is None:
+            self._start_storage_monitor()
+            if self._storage_pool is None:
+                self._storage_pool = futures.ThreadPoolExecutor(1)
+            self.storage_future = self._storage_pool.submit(self._get_storage)
+        return self.storage_future
+
     def get_storage(self):
-        ''' Load a StorageInfo class.  Probe if it's not present '''
+        ''' Load a StorageInfo class.  Probe if it's not present
+
+        A previous probe saved under probe_cache_path is reused if the
+        block devices on the system have not changed since it was taken.
+        storage_source records where the data came from.
+        '''
+        if self.storage_future is not None:
+            return self.storage_future.result()
+        return self._get_storage()
+
+    def _get_storage(self):
         if 'storage' not in self.probe_data:
-            log.debug('get_storage: no storage in probe_data, fetching')
-            storage = Storage()
-            results = storage.probe()
-            self.probe_data['storage'] = results
+            results = None
+            if self._storage_released:
+                # The system has moved on since the cache was written,
+                # but the changes udev has reported since are known.
+                key = self._storage_cache_key_saved
+                results = self._load_storage_cache(key)
+            self._storage_released = False
+            if results is None:
+                key = self._storage_cache_key()
+                if key is not None:
+                    results = self._load_storage_cache(key)
+            if results is not None:
+                self.storage_source = 'cache'
+            else:
+                log.debug('get_storage: no storage in probe_data, fetching')
+                storage = Storage()
+                results = storage.probe()
+                add_queue_attrs(results)
+                self.storage_source = 'probe'
+                if key is not None and self._save_storage_cache(key, results):
+                    self._storage_cache_key_saved = key
+                else:
+                    self._storage_cache_key_saved = None
+            if self.storage_source == 'cache':
+                self._storage_cache_key_saved = key
+            log.debug('get_storage: storage data from %s', self.storage_source)
+            with self._storage_lock:
+                for path, data in self._storage_changes.items():
+                    if data is None:
+                        results.pop(path, None)
+                    else:
+                        results[path] = data
+                self._storage_dirty = bool(self._storage_changes)
+                self._storage_changes = {}
+                self.probe_data['storage'] = results
 
         return self.probe_data['storage']
 
-    def get_storage_info(self, device):
-        ''' Load a StorageInfo class for specified device '''
-        return StorageInfo({device: self.get_storage().get(device)})
+    def probe_storage_events(self, receiver):
+        ''' Watch for block devices coming and going.
+
+        Returns an observer and the file descriptors to watch; call
+        observer.data_ready(fd) when one is readable.  Nothing is
+        watched when running from a machine config.
+
+        The events are those since start_storage_probe(), so ones from
+        before the probe took its snapshot may be replayed; they come
+        in order, so the data still ends up matching the system.
+        '''
+        if self.opts.machine_config:
+            return None, []
+        self._start_storage_monitor()
+        self._storage_observer.receiver = receiver
+        return self._storage_observer, self._storage_fds
+
+    def _start_storage_monitor(self):
+        if self.opts.machine_config or self._storage_observer is not None:
+            return
+        observer = UdevStorageObserver(self)
+        self._storage_fds = observer.start()
+        self._storage_observer = observer
+
+    def storage_changed(self, path, data):
+        ''' Record that udev reported a change to a block device.
+
+        data is the device's new probe data, or None if it has gone.
+        If no storage data is loaded, because the probe has not finished
+        or the data was released, the change is applied when it is.
+        '''
+        with self._storage_lock:
+            storage = self.probe_data.get('storage')
+            if storage is None:
+                self._storage_changes[path] = data
+                return
+            if data is None:
+                storage.pop(path, None)
+            else:
+                storage[path] = data
+            self._storage_dirty = True
+
+    def release_storage(self):
+        ''' Drop the storage data once it is no longer needed.
+
+        This is only done when the data was saved to the probe cache,
+        from where get_storage() can reload it if it is asked for again.
+        The cache is rewritten first if udev has reported changes since
+        it was saved. Devices reported by udev after this are remembered
+        and applied to the reloaded data, so the cache stays usable even
+        though the system's block devices no longer match its key.
+        '''
+        if 'storage' not in self.probe_data:
+            return
+        key = self._storage_cache_key_saved
+        if key is None:
+            return
+        if self._storage_dirty:
+            if not self._save_storage_cache(key, self.probe_data['storage']):
+                return
+            self._storage_dirty = False
+        log.debug('releasing storage data, it can be reloaded from %s',
+                  self.probe_cache_path)
+        with self._storage_lock:
+            self.probe_data.pop('storage')
+            self._storage_changes = {}
+        self.storage_future = None
+        self._storage_released = True
+
+    def get_storage_info(self, device, data=None):
+        ''' Load a StorageInfo class for specified device
+
+        data is the device's probe data, if the caller already has it.
+        '''
+        if data is None:
+            data = self.get_storage().get(device)
+        return StorageInfo({device: data})
@@ -0,0 +1,40 @@
+import concurrent.futures
+import os
+import unittest
+from unittest import mock
+
+from subiquitycore.controller import BaseController
+
+
+class Controller(BaseController):
+
+    def cancel(self):
+        pass
+
+    def default(self):
+        pass
+
+
+class TestCallWhenDone(unittest.TestCase):
+
+    def test_pipe_released_after_callback(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        loop = mock.Mock()
+        loop.watch_pipe.return_value = w
+        common = dict.fromkeys([
+            'ui', 'signal', 'opts', 'prober', 'controllers', 'pool',
+            'base_model', 'answers', 'input_filter'])
+        common['loop'] = loop
+        controller = Controller(common)
+        callback = mock.Mock()
+        fut = concurrent.futures.Future()
+        controller.call_when_done(fut, callback)
+        fut.set_result(None)
+        self.assertEqual(os.read(r, 1), b'x')
+        [[in_main_thread], _] = loop.watch_pipe.call_args
+        # Returning False tells urwid to drop the watch and its read end.
+        self.assertIs(in_main_thread(b'x'), False)
+        callback.assert_called_once_with(fut)
+        with self.assertRaises(OSError):
+            os.fstat(w)
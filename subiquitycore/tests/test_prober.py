@@ -0,0 +1,295 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import yaml
+
+from subiquitycore import prober as prober_mod
+from subiquitycore.prober import (
+    add_queue_attrs,
+    Prober,
+    UdevStorageObserver,
+    udev_storage_data,
+    )
+
+
+class FakeAttributes:
+
+    def __init__(self, attrs):
+        self.attrs = attrs
+        self.available_attributes = list(attrs)
+
+    def asstring(self, attr):
+        return self.attrs[attr]
+
+
+class FakeUdevDevice:
+
+    def __init__(self, action, node, size_sectors):
+        self.action = action
+        self.device_node = node
+        self.properties = {'DEVNAME': node, 'DEVTYPE': 'disk'}
+        self.attributes = FakeAttributes(
+            {'size': str(size_sectors), 'ro': '0'})
+
+
+class FakeMonitor:
+
+    def __init__(self, devices):
+        self.devices = list(devices)
+
+    def poll(self, timeout):
+        if self.devices:
+            return self.devices.pop(0)
+        return None
+
+
+def make_prober(**opts):
+    opts.setdefault('machine_config', None)
+    opts.setdefault('dry_run', True)
+    return Prober(mock.Mock(**opts))
+
+
+class TestUdevStorage(unittest.TestCase):
+
+    def test_size_in_bytes(self):
+        data = udev_storage_data(FakeUdevDevice('add', '/dev/sdz', 2048))
+        self.assertEqual(data['attrs']['size'], str(2048 * 512))
+
+    def test_hotplugged_disk_size(self):
+        prober = make_prober()
+        prober.probe_data['storage'] = {}
+        receiver = mock.Mock()
+        observer = UdevStorageObserver(prober, receiver)
+        observer.monitor = FakeMonitor(
+            [FakeUdevDevice('add', '/dev/sdz', 20 * 2 ** 21)])
+        observer.data_ready(None)
+        path, data = receiver.new_device.call_args[0]
+        self.assertEqual(path, '/dev/sdz')
+        info = prober.get_storage_info(path, data)
+        self.assertEqual(info.size, 20 << 30)
+        self.assertIs(prober.probe_data['storage']['/dev/sdz'], data)
+
+
+class TestStorageCache(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.root = tmpdir.name
+        self.seqnum = os.path.join(self.root, 'uevent_seqnum')
+        self.sys_block = os.path.join(self.root, 'block')
+        os.mkdir(self.sys_block)
+        self.write_seqnum('100')
+        self.add_block('sda', '8:0', '2048')
+        for name, value in [
+                ('UEVENT_SEQNUM', self.seqnum),
+                ('SYS_BLOCK', self.sys_block),
+                ('PROBE_CACHE_DIR', os.path.join(self.root, 'run')),
+                ]:
+            p = mock.patch.object(prober_mod, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+        p = mock.patch.object(prober_mod, 'Storage')
+        self.Storage = p.start()
+        self.addCleanup(p.stop)
+        p = mock.patch.object(prober_mod, 'UdevStorageObserver')
+        self.Observer = p.start()
+        self.addCleanup(p.stop)
+        self.probes = 0
+
+        def probe():
+            self.probes += 1
+            return {'/dev/sda': {'probe': self.probes}}
+        self.Storage.return_value.probe.side_effect = probe
+
+    def write_seqnum(self, seqnum):
+        with open(self.seqnum, 'w') as fp:
+            fp.write(seqnum + '\n')
+
+    def add_block(self, name, dev, size):
+        os.makedirs(os.path.join(self.sys_block, name), exist_ok=True)
+        for attr, value in ('dev', dev), ('size', size):
+            with open(os.path.join(self.sys_block, name, attr), 'w') as fp:
+                fp.write(value + '\n')
+
+    def get_storage(self):
+        prober = make_prober(dry_run=False)
+        return prober, prober.get_storage()
+
+    def test_cache_hit(self):
+        prober, first = self.get_storage()
+        self.assertEqual(prober.storage_source, 'probe')
+        prober, second = self.get_storage()
+        self.assertEqual(prober.storage_source, 'cache')
+        self.assertEqual(first, second)
+        self.assertEqual(self.probes, 1)
+
+    def test_seqnum_change_invalidates(self):
+        self.get_storage()
+        self.write_seqnum('101')
+        prober, storage = self.get_storage()
+        self.assertEqual(prober.storage_source, 'probe')
+        self.assertEqual(storage['/dev/sda']['probe'], 2)
+
+    def test_sys_block_change_invalidates(self):
+        self.get_storage()
+        self.add_block('sdb', '8:16', '4096')
+        prober, storage = self.get_storage()
+        self.assertEqual(prober.storage_source, 'probe')
+        self.assertEqual(self.probes, 2)
+
+    def test_queue_attrs(self):
+        os.mkdir(os.path.join(self.sys_block, 'sda', 'queue'))
+        with open(os.path.join(
+                self.sys_block, 'sda', 'queue', 'rotational'), 'w') as fp:
+            fp.write('1\n')
+        storage = {
+            '/dev/sda': {'DEVTYPE': 'disk', 'attrs': {}},
+            '/dev/sda1': {'DEVTYPE': 'partition', 'attrs': {}},
+            }
+        add_queue_attrs(storage)
+        self.assertEqual(
+            storage['/dev/sda']['attrs'], {'queue/rotational': '1'})
+        self.assertEqual(storage['/dev/sda1']['attrs'], {})
+
+    def test_storage_is_live(self):
+        prober, _ = self.get_storage()
+        self.assertTrue(prober.storage_is_live)
+        prober = make_prober(dry_run=True)
+        prober.storage_source = 'probe'
+        self.assertFalse(prober.storage_is_live)
+
+    def test_corrupt_cache(self):
+        prober, _ = self.get_storage()
+        with open(prober.probe_cache_path, 'w') as fp:
+            fp.write('{"key": ')
+        prober, storage = self.get_storage()
+        self.assertEqual(prober.storage_source, 'probe')
+        self.assertEqual(storage['/dev/sda']['probe'], 2)
+        # The corrupt file is replaced with the fresh probe.
+        prober, _ = self.get_storage()
+        self.assertEqual(prober.storage_source, 'cache')
+
+    def test_reload_after_release(self):
+        prober, _ = self.get_storage()
+        prober.release_storage()
+        self.assertNotIn('storage', prober.probe_data)
+        # A hotplug moves the seqnum on, so the cache key no longer
+        # matches, but the released data can still be reloaded.
+        self.write_seqnum('102')
+        observer = UdevStorageObserver(prober, mock.Mock())
+        observer.monitor = FakeMonitor(
+            [FakeUdevDevice('add', '/dev/sdz', 2048)])
+        observer.data_ready(None)
+        storage = prober.get_storage()
+        self.assertEqual(self.probes, 1)
+        self.assertEqual(prober.storage_source, 'cache')
+        self.assertEqual(storage['/dev/sda'], {'probe': 1})
+        self.assertEqual(storage['/dev/sdz']['attrs']['size'], '1048576')
+        # The reloaded changes are kept when it is released again, as
+        # are changes reported while it was loaded.
+        observer.monitor = FakeMonitor(
+            [FakeUdevDevice('add', '/dev/sdy', 4096)])
+        observer.data_ready(None)
+        prober.release_storage()
+        self.assertNotIn('storage', prober.probe_data)
+        storage = prober.get_storage()
+        self.assertEqual(self.probes, 1)
+        self.assertIn('/dev/sdz', storage)
+        self.assertIn('/dev/sdy', storage)
+
+    def test_background_probe(self):
+        started = threading.Event()
+        release = threading.Event()
+        probe = self.Storage.return_value.probe.side_effect
+
+        def slow_probe():
+            started.set()
+            release.wait(10)
+            return probe()
+        self.Storage.return_value.probe.side_effect = slow_probe
+        prober = make_prober(dry_run=False)
+        fut = prober.start_storage_probe()
+        self.assertIs(prober.start_storage_probe(), fut)
+        self.assertTrue(started.wait(10))
+        self.assertFalse(fut.done())
+        release.set()
+        storage = prober.get_storage()
+        self.assertIs(storage, fut.result())
+        self.assertEqual(self.probes, 1)
+        self.assertEqual(prober.storage_source, 'probe')
+
+    def test_changes_during_probe_kept(self):
+        release = threading.Event()
+        probe = self.Storage.return_value.probe.side_effect
+        prober = make_prober(dry_run=False)
+
+        def slow_probe():
+            # The monitor is already running when the snapshot is taken.
+            self.Observer.return_value.start.assert_called_once_with()
+            release.wait(10)
+            return probe()
+        self.Storage.return_value.probe.side_effect = slow_probe
+        prober.start_storage_probe()
+        prober.storage_changed('/dev/sdz', {'hotplug': 1})
+        prober.storage_changed('/dev/sda', None)
+        release.set()
+        storage = prober.get_storage()
+        self.assertEqual(storage, {'/dev/sdz': {'hotplug': 1}})
+        # The cache is brought up to date before the data is dropped.
+        prober.release_storage()
+        prober, storage = self.get_storage()
+        self.assertEqual(prober.storage_source, 'cache')
+        self.assertEqual(storage, {'/dev/sdz': {'hotplug': 1}})
+
+    def test_events_from_probe_monitor(self):
+        prober = make_prober(dry_run=False)
+        prober.start_storage_probe()
+        prober.get_storage()
+        receiver = mock.Mock()
+        observer, fds = prober.probe_storage_events(receiver)
+        self.assertIs(observer, self.Observer.return_value)
+        self.assertIs(observer.receiver, receiver)
+        self.assertIs(fds, observer.start.return_value)
+        self.Observer.assert_called_once_with(prober)
+
+    def test_background_probe_failure(self):
+        self.Storage.return_value.probe.side_effect = OSError("boom")
+        prober = make_prober(dry_run=False)
+        prober.start_storage_probe()
+        with self.assertRaises(OSError):
+            prober.get_storage()
+
+
+class TestMachineConfig(unittest.TestCase):
+
+    def write(self, dirname, name, content):
+        path = os.path.join(dirname, name)
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def test_json_and_yaml_match(self):
+        data = {
+            'storage': {
+                '/dev/sda': {
+                    'DEVNAME': '/dev/sda',
+                    'MAJOR': '8',
+                    'attrs': {'size': '10737418240', 'ro': '0'},
+                    },
+                },
+            'network': {'links': [], 'routes': []},
+            }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            from_json = make_prober(machine_config=self.write(
+                tmpdir, 'machine.json', json.dumps(data, indent=4)))
+            from_yaml = make_prober(machine_config=self.write(
+                tmpdir, 'machine.yaml', yaml.safe_dump(data)))
+        self.assertEqual(from_json.probe_data, data)
+        self.assertEqual(from_yaml.probe_data, data)
+        self.assertEqual(from_json.storage_source, 'machine-config')
+        self.assertEqual(from_yaml.storage_source, 'machine-config')